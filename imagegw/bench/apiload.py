@@ -0,0 +1,393 @@
+#!/usr/bin/env python
+# Shifter, Copyright (c) 2017, The Regents of the University of California,
+# through Lawrence Berkeley National Laboratory (subject to receipt of any
+# required approvals from the U.S. Dept. of Energy).  All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#  1. Redistributions of source code must retain the above copyright notice,
+#     this list of conditions and the following disclaimer.
+#  2. Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions and the following disclaimer in the documentation
+#     and/or other materials provided with the distribution.
+#  3. Neither the name of the University of California, Lawrence Berkeley
+#     National Laboratory, U.S. Dept. of Energy nor the names of its
+#     contributors may be used to endorse or promote products derived from this
+#     software without specific prior written permission.`
+#
+# See LICENSE for full text.
+
+"""
+Load test the image gateway REST API.
+
+By default the Flask app is booted in-process with mock authentication, an
+in-memory Mongo (mongomock) and pull dispatch replaced by instantly
+completing tasks, then served on an ephemeral localhost port.  Use
+--mongo-uri to run against a real mongod, or --url to drive an already
+running gateway (e.g. under gunicorn) configured with mock authentication.
+
+Scenarios replay typical request mixes and report latency percentiles per
+endpoint.  With --baseline the run is compared to an earlier --output file
+and the exit status is non-zero if any percentile regressed.
+
+Example:
+    PYTHONPATH=imagegw python imagegw/bench/apiload.py \\
+        --scenarios launch,mixed --clients 16 --requests 2000 \\
+        --output api.json
+"""
+
+import argparse
+import hashlib
+import httplib
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import urllib
+import urlparse
+
+SYSTEM = 'systema'
+USER_AUTH = 'good:user:user::500:500'
+
+
+def _image_tag(index):
+    return 'bench/image%04d:latest' % index
+
+
+def _pull_response(tag):
+    """What a worker hands back for a completed pull of tag."""
+    return {
+        'id': hashlib.sha256(tag).hexdigest(),
+        'entrypoint': ['/bin/sh'],
+        'workdir': '/',
+        'env': ['PATH=/usr/bin:/bin'],
+        'private': False,
+        'tag': tag,
+    }
+
+
+def _make_request(rng, args, choice):
+    """Return (endpoint, method, path) for one request of a kind."""
+    if choice == 'lookup':
+        tag = _image_tag(rng.randint(0, args.images - 1))
+        return ('lookup', 'GET', '/api/lookup/%s/docker/%s/'
+                % (SYSTEM, urllib.quote(tag)))
+    elif choice == 'launch':
+        return ('lookup', 'GET', '/api/lookup/%s/docker/%s/'
+                % (SYSTEM, urllib.quote(_image_tag(0))))
+    elif choice == 'pull':
+        tag = 'bench/pull%04d:latest' % rng.randint(0, args.pull_tags - 1)
+        return ('pull', 'POST', '/api/pull/%s/docker/%s/'
+                % (SYSTEM, urllib.quote(tag)))
+    elif choice == 'list':
+        return ('list', 'GET', '/api/list/%s/' % SYSTEM)
+    raise ValueError('Unknown request kind %s' % choice)
+
+
+# Scenarios are weighted request kinds
+SCENARIOS = {
+    # a large job starting: every node looks up the same image
+    'launch': [(1.0, 'launch')],
+    # users pulling a small set of images at once, mostly duplicates
+    'pullburst': [(1.0, 'pull')],
+    # clients listing every image on the system
+    'listscan': [(1.0, 'list')],
+    # steady state traffic
+    'mixed': [(0.80, 'lookup'), (0.15, 'pull'), (0.05, 'list')],
+}
+
+
+def _percentile(values, pct):
+    """Nearest-rank percentile of a sorted list."""
+    if len(values) == 0:
+        return None
+    rank = int(round(pct / 100.0 * len(values) + 0.5)) - 1
+    return values[max(0, min(rank, len(values) - 1))]
+
+
+def summarize(samples, wall):
+    """Reduce {endpoint: [(seconds, ok), ...]} to latency statistics (ms)."""
+    endpoints = {}
+    for (endpoint, values) in samples.items():
+        times = sorted(x[0] * 1000.0 for x in values)
+        endpoints[endpoint] = {
+            'count': len(values),
+            'errors': len([x for x in values if not x[1]]),
+            'mean': sum(times) / len(times),
+            'p50': _percentile(times, 50),
+            'p90': _percentile(times, 90),
+            'p99': _percentile(times, 99),
+            'max': times[-1],
+        }
+    total = sum(x['count'] for x in endpoints.values())
+    return {
+        'wall': wall,
+        'requests': total,
+        'rps': total / wall if wall > 0 else None,
+        'endpoints': endpoints,
+    }
+
+
+def run_scenario(url, name, args):
+    """Drive one scenario with args.clients concurrent clients."""
+    mix = SCENARIOS[name]
+    weights = [x[0] for x in mix]
+    parsed = urlparse.urlparse(url)
+    samples = {}
+    lock = threading.Lock()
+    remaining = [args.requests]
+
+    def _client(seed):
+        rng = random.Random(seed)
+        conn = httplib.HTTPConnection(parsed.hostname, parsed.port)
+        mine = {}
+        while True:
+            with lock:
+                if remaining[0] <= 0:
+                    break
+                remaining[0] -= 1
+            pick = rng.random() * sum(weights)
+            for (weight, kind) in mix:
+                pick -= weight
+                if pick <= 0:
+                    break
+            (endpoint, method, path) = _make_request(rng, args, kind)
+            start = time.time()
+            try:
+                conn.request(method, path, None,
+                             {'authentication': args.auth})
+                resp = conn.getresponse()
+                resp.read()
+                good = resp.status == 200
+            except (httplib.HTTPException, IOError):
+                conn.close()
+                conn = httplib.HTTPConnection(parsed.hostname, parsed.port)
+                good = False
+            mine.setdefault(endpoint, []).append((time.time() - start,
+                                                  good))
+        conn.close()
+        with lock:
+            for (endpoint, values) in mine.items():
+                samples.setdefault(endpoint, []).extend(values)
+
+    threads = [threading.Thread(target=_client, args=(args.seed + idx,))
+               for idx in xrange(args.clients)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return summarize(samples, time.time() - start)
+
+
+def compare(result, baseline, tolerance, min_delta):
+    """
+    Return a list of regressions of result against baseline.  A percentile
+    regresses if it is more than tolerance (a fraction) and min_delta ms
+    slower than the baseline.
+    """
+    regressions = []
+    for (name, scenario) in result['scenarios'].items():
+        if name not in baseline.get('scenarios', {}):
+            continue
+        base_eps = baseline['scenarios'][name]['endpoints']
+        for (endpoint, stats) in scenario['endpoints'].items():
+            if endpoint not in base_eps:
+                continue
+            for pct in ('p50', 'p90', 'p99'):
+                old = base_eps[endpoint][pct]
+                new = stats[pct]
+                if new > old * (1.0 + tolerance) and new - old > min_delta:
+                    regressions.append('%s %s %s: %.2fms -> %.2fms'
+                                       % (name, endpoint, pct, old, new))
+            if stats['errors'] > base_eps[endpoint]['errors']:
+                regressions.append('%s %s errors: %d -> %d'
+                                   % (name, endpoint,
+                                      base_eps[endpoint]['errors'],
+                                      stats['errors']))
+    return regressions
+
+
+class _FakePull(object):
+    """Stand-in for dopull: tasks succeed after a fixed delay."""
+
+    def __init__(self, delay):
+        self.delay = delay
+
+    def apply_async(self, args, queue=None, kwargs=None, **options):
+        from celery import states
+        from celery.result import EagerResult
+        ready_at = time.time() + self.delay
+        response = _pull_response(args[0]['tag'])
+
+        class _Result(EagerResult):
+            @property
+            def state(self):
+                if time.time() < ready_at:
+                    return states.PENDING
+                return states.SUCCESS
+
+            status = state
+
+            @property
+            def info(self):
+                if time.time() < ready_at:
+                    return None
+                return self._result
+
+        return _Result('%x' % random.getrandbits(64), response,
+                       states.SUCCESS)
+
+
+def boot_app(args):
+    """Start the gateway in-process and return (url, server, manager)."""
+    from werkzeug.serving import make_server
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+
+    config = {
+        'LogLevel': 'error',
+        'DefaultImageFormat': 'squashfs',
+        'PullUpdateTimeout': 300,
+        'ImageExpirationTimeout': '90:00:00:00',
+        'CacheDirectory': tempfile.gettempdir(),
+        'ExpandDirectory': tempfile.gettempdir(),
+        'MongoDBURI': args.mongo_uri or 'mongodb://localhost/',
+        'MongoDB': args.mongo_db,
+        'Metrics': True,
+        'Broker': 'memory://',
+        'Authentication': 'mock',
+        'Locations': {'index.docker.io': {'remotetype': 'dockerv2'}},
+        'Platforms': {
+            SYSTEM: {
+                'accesstype': 'local',
+                'admins': ['root'],
+                'local': {'imageDir': tempfile.gettempdir()}
+            }
+        }
+    }
+    (config_fd, config_fn) = tempfile.mkstemp('.json', 'apiload')
+    with os.fdopen(config_fd, 'w') as config_fp:
+        json.dump(config, config_fp)
+    os.environ['GWCONFIG'] = config_fn
+
+    from shifter_imagegw import imagemngr
+    if args.mongo_uri is None:
+        try:
+            import mongomock
+        except ImportError:
+            raise SystemExit('mongomock is needed unless --mongo-uri is given')
+        imagemngr.MongoClient = mongomock.MongoClient
+    imagemngr.dopull = _FakePull(args.pull_delay)
+    try:
+        from shifter_imagegw import api
+    finally:
+        os.unlink(config_fn)
+
+    mgr = api.mgr
+    mgr.images.drop()
+    if mgr.metrics is not None:
+        mgr.metrics.drop()
+    now = time.time()
+    for idx in xrange(args.images):
+        tag = _image_tag(idx)
+        rec = _pull_response(tag)
+        rec.update({
+            'system': SYSTEM, 'itype': 'docker', 'pulltag': tag,
+            'tag': [tag], 'status': 'READY', 'format': 'squashfs',
+            'last_pull': now, 'expiration': now + 86400,
+            'userACL': [], 'groupACL': [], 'private': False,
+        })
+        # private images still admit the benchmark user, so lookups
+        # exercise the ACL checks without failing
+        if args.private and (idx + 1) % int(1 / args.private) == 0:
+            rec['private'] = True
+            rec['userACL'] = [500, 1000 + idx]
+        mgr.images.insert(rec)
+
+    server = make_server('127.0.0.1', 0, api.app, threaded=args.threaded)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return ('http://127.0.0.1:%d' % server.server_port, server, mgr)
+
+
+def main(argv=None):
+    """Command line entry point."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--scenarios', default=','.join(sorted(SCENARIOS)),
+                        help='comma separated list of %s'
+                             % ', '.join(sorted(SCENARIOS)))
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=1000,
+                        help='requests per scenario')
+    parser.add_argument('--images', type=int, default=200,
+                        help='READY images seeded before the run')
+    parser.add_argument('--private', type=float, default=0.1,
+                        help='fraction of seeded images with ACLs')
+    parser.add_argument('--pull-tags', type=int, default=20,
+                        help='distinct tags requested by pulls')
+    parser.add_argument('--pull-delay', type=float, default=1.0,
+                        help='seconds before a dispatched pull completes')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--auth', default=USER_AUTH,
+                        help='mock authentication string to send')
+    parser.add_argument('--url', help='drive a running gateway instead')
+    parser.add_argument('--mongo-uri', help='use a real mongod')
+    parser.add_argument('--mongo-db', default='ShifterLoadTest')
+    parser.add_argument('--threaded', action='store_true',
+                        help='serve the in-process app with a thread per '
+                             'request')
+    parser.add_argument('--output', help='write JSON results here')
+    parser.add_argument('--baseline', help='results to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed fractional slowdown per percentile')
+    parser.add_argument('--min-delta', type=float, default=1.0,
+                        help='ignore slowdowns smaller than this (ms)')
+    args = parser.parse_args(argv)
+
+    server = None
+    url = args.url
+    if url is None:
+        (url, server, _) = boot_app(args)
+
+    result = {'params': vars(args), 'scenarios': {}}
+    try:
+        for name in args.scenarios.split(','):
+            if name not in SCENARIOS:
+                raise SystemExit('Unknown scenario %s' % name)
+            result['scenarios'][name] = run_scenario(url, name, args)
+    finally:
+        if server is not None:
+            server.shutdown()
+
+    for (name, scenario) in sorted(result['scenarios'].items()):
+        print '%s: %d requests %.1f req/s' % (name, scenario['requests'],
+                                               scenario['rps'])
+        for (endpoint, stats) in sorted(scenario['endpoints'].items()):
+            print '  %-8s n=%-6d err=%-4d p50=%.2fms p90=%.2fms ' \
+                  'p99=%.2fms max=%.2fms' \
+                  % (endpoint, stats['count'], stats['errors'], stats['p50'],
+                     stats['p90'], stats['p99'], stats['max'])
+
+    if args.output is not None:
+        with open(args.output, 'w') as out_fp:
+            json.dump(result, out_fp, indent=2)
+
+    if args.baseline is not None:
+        with open(args.baseline) as base_fp:
+            baseline = json.load(base_fp)
+        regressions = compare(result, baseline, args.tolerance,
+                              args.min_delta)
+        if len(regressions) > 0:
+            sys.stderr.write('Regressions against %s:\n' % args.baseline)
+            for line in regressions:
+                sys.stderr.write('  %s\n' % line)
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,291 @@
+# Shifter, Copyright (c) 2017, The Regents of the University of California,
+# through Lawrence Berkeley National Laboratory (subject to receipt of any
+# required approvals from the U.S. Dept. of Energy).  All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#  1. Redistributions of source code must retain the above copyright notice,
+#     this list of conditions and the following disclaimer.
+#  2. Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions and the following disclaimer in the documentation
+#     and/or other materials provided with the distribution.
+#  3. Neither the name of the University of California, Lawrence Berkeley
+#     National Laboratory, U.S. Dept. of Energy nor the names of its
+#     contributors may be used to endorse or promote products derived from this
+#     software without specific prior written permission.`
+#
+# See LICENSE for full text.
+
+"""
+A small stand-in for a docker v2 registry, used by the benchmarks.
+
+Images are generated from a handful of parameters (layer count, files per
+layer, file size and whiteout density) and written as schema 2 manifests
+with gzipped layer blobs.  The registry serves them anonymously over plain
+http on localhost, so no network or credentials are needed.
+"""
+
+import BaseHTTPServer
+import SocketServer
+import gzip
+import hashlib
+import json
+import os
+import random
+import re
+import tarfile
+import tempfile
+import threading
+import time
+from StringIO import StringIO
+
+_MANIFEST_V2 = 'application/vnd.docker.distribution.manifest.v2+json'
+_CONFIG_V1 = 'application/vnd.docker.container.image.v1+json'
+_LAYER_GZIP = 'application/vnd.docker.image.rootfs.diff.tar.gzip'
+
+
+def _sha256_file(path):
+    """Return the sha256 digest string of a file."""
+    sha = hashlib.sha256()
+    with open(path, 'rb') as in_fp:
+        while True:
+            buff = in_fp.read(1024 * 1024)
+            if not buff:
+                break
+            sha.update(buff)
+    return 'sha256:%s' % sha.hexdigest()
+
+
+def _file_data(seed_block, index, size):
+    """Deterministic, poorly compressible file contents."""
+    offset = (index * 7919) % len(seed_block)
+    data = seed_block[offset:] + seed_block[:offset]
+    while len(data) < size:
+        data += data
+    return data[:size]
+
+
+def build_image(blobdir, layers=4, files=100, size=4096, whiteouts=0.0,
+                seed=0):
+    """
+    Write a synthetic image into blobdir.
+
+    Every layer adds files new regular files of size bytes under its own
+    directory.  whiteouts is the fraction of the files added by the previous
+    layer that each layer deletes again.  Returns a dictionary with the
+    manifest text, its digest and the total size of the blobs.
+    """
+    rng = random.Random(seed)
+    seed_block = ''.join(chr(rng.randint(0, 255)) for _ in xrange(65536))
+    layer_descs = []
+    diff_ids = []
+    previous = []
+    file_index = 0
+    for lidx in xrange(layers):
+        (tar_fd, tar_path) = tempfile.mkstemp('.tar', 'layer', blobdir)
+        os.close(tar_fd)
+        tfp = tarfile.open(tar_path, 'w')
+        dirname = 'layer%03d' % lidx
+        info = tarfile.TarInfo(dirname)
+        info.type = tarfile.DIRTYPE
+        info.mode = 0755
+        tfp.addfile(info)
+
+        ndelete = int(round(len(previous) * whiteouts))
+        for name in rng.sample(previous, ndelete):
+            (parent, base) = os.path.split(name)
+            info = tarfile.TarInfo(os.path.join(parent, '.wh.%s' % base))
+            tfp.addfile(info, StringIO(''))
+
+        current = []
+        for fidx in xrange(files):
+            name = '%s/file%06d' % (dirname, fidx)
+            data = _file_data(seed_block, file_index, size)
+            file_index += 1
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mode = 0644
+            tfp.addfile(info, StringIO(data))
+            current.append(name)
+        tfp.close()
+        previous = current
+
+        diff_ids.append(_sha256_file(tar_path))
+        # compress the plain tar into the layer blob
+        gz_path = tar_path + '.gz'
+        with open(tar_path, 'rb') as in_fp:
+            out_fp = gzip.open(gz_path, 'wb')
+            try:
+                while True:
+                    buff = in_fp.read(1024 * 1024)
+                    if not buff:
+                        break
+                    out_fp.write(buff)
+            finally:
+                out_fp.close()
+        os.unlink(tar_path)
+        digest = _sha256_file(gz_path)
+        os.rename(gz_path, os.path.join(blobdir, digest))
+        layer_descs.append({
+            'mediaType': _LAYER_GZIP,
+            'size': os.path.getsize(os.path.join(blobdir, digest)),
+            'digest': digest
+        })
+
+    config = {
+        'architecture': 'amd64',
+        'os': 'linux',
+        'config': {'Env': ['PATH=/usr/bin:/bin'], 'Entrypoint': None},
+        'rootfs': {'type': 'layers', 'diff_ids': diff_ids},
+    }
+    config_data = json.dumps(config)
+    config_digest = 'sha256:%s' % hashlib.sha256(config_data).hexdigest()
+    with open(os.path.join(blobdir, config_digest), 'w') as out_fp:
+        out_fp.write(config_data)
+
+    manifest = json.dumps({
+        'schemaVersion': 2,
+        'mediaType': _MANIFEST_V2,
+        'config': {'mediaType': _CONFIG_V1, 'size': len(config_data),
+                   'digest': config_digest},
+        'layers': layer_descs,
+    })
+    return {
+        'manifest': manifest,
+        'digest': 'sha256:%s' % hashlib.sha256(manifest).hexdigest(),
+        'bytes': sum(x['size'] for x in layer_descs) + len(config_data),
+    }
+
+
+class _ThreadingHTTPServer(SocketServer.ThreadingMixIn,
+                           BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class _RegistryHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serve /v2/<repo>/manifests/<ref> and /v2/<repo>/blobs/<digest>."""
+
+    protocol_version = 'HTTP/1.1'
+    manifest_re = re.compile(r'^/v2/(.+)/manifests/([^/]+)$')
+    blob_re = re.compile(r'^/v2/(.+)/blobs/(sha256:[0-9a-f]+)$')
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status, body='', headers=None):
+        self.send_response(status)
+        for (key, val) in (headers or {}).items():
+            self.send_header(key, val)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+        self.server.registry.count(len(body))
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_GET(self):
+        registry = self.server.registry
+        if registry.latency > 0:
+            time.sleep(registry.latency)
+        if self.path in ('/v2', '/v2/'):
+            self._send(200, '{}', {'Content-Type': 'application/json'})
+            return
+
+        match = self.manifest_re.match(self.path)
+        if match is not None:
+            image = registry.images.get(match.groups())
+            if image is None:
+                by_digest = [x for x in registry.images.values()
+                             if x['digest'] == match.group(2)]
+                image = by_digest[0] if by_digest else None
+            if image is None:
+                self._send(404)
+                return
+            self._send(200, image['manifest'], {
+                'Content-Type': _MANIFEST_V2,
+                'Docker-Content-Digest': image['digest'],
+            })
+            return
+
+        match = self.blob_re.match(self.path)
+        if match is not None:
+            path = os.path.join(registry.blobdir, match.group(2))
+            if not os.path.exists(path):
+                self._send(404)
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length', str(os.path.getsize(path)))
+            self.end_headers()
+            registry.count(0)
+            if self.command == 'HEAD':
+                return
+            with open(path, 'rb') as in_fp:
+                while True:
+                    buff = in_fp.read(1024 * 1024)
+                    if not buff:
+                        break
+                    self.wfile.write(buff)
+                    registry.count(len(buff), 0)
+            return
+
+        self._send(404)
+
+
+class FakeRegistry(object):
+    """
+    Serve synthetic images on an ephemeral localhost port.  latency adds a
+    fixed delay (in seconds) to every request.
+    """
+
+    def __init__(self, blobdir=None, latency=0.0):
+        self.blobdir = blobdir
+        self.own_blobdir = blobdir is None
+        if self.own_blobdir:
+            self.blobdir = tempfile.mkdtemp(prefix='fakeregistry')
+        self.latency = latency
+        self.images = {}
+        self.bytes_served = 0
+        self.requests = 0
+        self.lock = threading.Lock()
+        self.server = None
+        self.thread = None
+
+    def count(self, nbytes, requests=1):
+        """Account for bytes sent to a client."""
+        with self.lock:
+            self.bytes_served += nbytes
+            self.requests += requests
+
+    def add_image(self, repo, tag, **kwargs):
+        """Generate an image (see build_image) and publish it as repo:tag."""
+        image = build_image(self.blobdir, **kwargs)
+        self.images[(repo, tag)] = image
+        return image
+
+    @property
+    def url(self):
+        """Base url to hand to DockerV2Handle as baseUrl."""
+        return 'http://127.0.0.1:%d' % self.server.server_address[1]
+
+    def start(self):
+        """Start serving in a background thread."""
+        self.server = _ThreadingHTTPServer(('127.0.0.1', 0), _RegistryHandler)
+        self.server.registry = self
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self.url
+
+    def stop(self):
+        """Stop serving and drop generated blobs."""
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+        if self.own_blobdir:
+            for name in os.listdir(self.blobdir):
+                os.unlink(os.path.join(self.blobdir, name))
+            os.rmdir(self.blobdir)
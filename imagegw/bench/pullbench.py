@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+# Shifter, Copyright (c) 2017, The Regents of the University of California,
+# through Lawrence Berkeley National Laboratory (subject to receipt of any
+# required approvals from the U.S. Dept. of Energy).  All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#  1. Redistributions of source code must retain the above copyright notice,
+#     this list of conditions and the following disclaimer.
+#  2. Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions and the following disclaimer in the documentation
+#     and/or other materials provided with the distribution.
+#  3. Neither the name of the University of California, Lawrence Berkeley
+#     National Laboratory, U.S. Dept. of Energy nor the names of its
+#     contributors may be used to endorse or promote products derived from this
+#     software without specific prior written permission.`
+#
+# See LICENSE for full text.
+
+"""
+Benchmark the image gateway pull pipeline against a local fake registry.
+
+A synthetic image is published on a FakeRegistry and pulled through the same
+steps the worker uses: manifest, layer download, extraction, conversion and
+transfer to a local imageDir.  Wall time, CPU time (including child
+processes such as mksquashfs), peak RSS and bytes moved are recorded for each
+stage and written as JSON.
+
+Example:
+    PYTHONPATH=imagegw python imagegw/bench/pullbench.py \\
+        --layers 8 --files 500 --size 16384 --whiteouts 0.1 --runs 3
+"""
+
+import argparse
+import json
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+from shifter_imagegw import dockerv2, converters, transfer
+from fakeregistry import FakeRegistry
+
+
+def _tree_size(path):
+    """Sum of the sizes of regular files under path."""
+    total = 0
+    for (dirpath, _, filenames) in os.walk(path):
+        for fname in filenames:
+            fpath = os.path.join(dirpath, fname)
+            if not os.path.islink(fpath):
+                total += os.path.getsize(fpath)
+    return total
+
+
+class StageTimer(object):
+    """Collect resource usage for named stages of a run."""
+
+    def __init__(self):
+        self.stages = []
+        self.current = None
+
+    def start(self, name):
+        """Begin measuring a stage."""
+        times = os.times()
+        self.current = {
+            'name': name,
+            'wall': time.time(),
+            'cpu': times[0] + times[1],
+            'child_cpu': times[2] + times[3],
+        }
+
+    def stop(self, nbytes=0):
+        """Finish the current stage, recording nbytes moved by it."""
+        times = os.times()
+        stage = self.current
+        stage['wall'] = time.time() - stage['wall']
+        stage['cpu'] = times[0] + times[1] - stage['cpu']
+        stage['child_cpu'] = times[2] + times[3] - stage['child_cpu']
+        # ru_maxrss is in kilobytes on linux
+        stage['maxrss_kb'] = \
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        stage['child_maxrss_kb'] = \
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        stage['bytes'] = nbytes
+        if stage['wall'] > 0:
+            stage['mb_per_sec'] = nbytes / stage['wall'] / (1024.0 * 1024.0)
+        self.stages.append(stage)
+        self.current = None
+        return stage
+
+
+def run_once(registry, args, cachedir, workdir):
+    """Pull the benchmark image once and return the per-stage results."""
+    timer = StageTimer()
+    options = {'baseUrl': registry.url, 'cachedir': cachedir}
+    handle = dockerv2.DockerV2Handle('bench/image:latest', options)
+
+    timer.start('manifest')
+    manifest = handle.get_image_manifest()
+    resp = handle.examine_manifest(manifest)
+    timer.stop(len(json.dumps(manifest)))
+
+    timer.start('fetch')
+    served = registry.bytes_served
+    handle.pull_layers(manifest, cachedir)
+    timer.stop(registry.bytes_served - served)
+
+    expand = os.path.join(workdir, 'expand')
+    os.mkdir(expand)
+    timer.start('extract')
+    handle.extract_docker_layers(expand, handle.get_eldest_layer(),
+                                 cachedir=cachedir)
+    timer.stop(_tree_size(expand))
+
+    image_path = os.path.join(workdir, '%s.%s' % (resp['id'], args.format))
+    timer.start('convert')
+    if not converters.convert(args.format, expand, image_path):
+        raise OSError('Conversion to %s failed' % args.format)
+    timer.stop(os.path.getsize(image_path))
+
+    image_dir = os.path.join(workdir, 'images')
+    os.mkdir(image_dir)
+    system = {'accesstype': 'local', 'local': {'imageDir': image_dir}}
+    timer.start('transfer')
+    if not transfer.transfer(system, image_path):
+        raise OSError('Transfer of %s failed' % image_path)
+    timer.stop(os.path.getsize(image_path))
+
+    return timer.stages
+
+
+def main(argv=None):
+    """Command line entry point."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--layers', type=int, default=4)
+    parser.add_argument('--files', type=int, default=100,
+                        help='files added by each layer')
+    parser.add_argument('--size', type=int, default=4096,
+                        help='size of each file in bytes')
+    parser.add_argument('--whiteouts', type=float, default=0.0,
+                        help='fraction of the previous layer deleted by '
+                             'each layer')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds added to every registry request')
+    parser.add_argument('--format', default='squashfs')
+    parser.add_argument('--runs', type=int, default=1)
+    parser.add_argument('--warm', action='store_true',
+                        help='keep the layer cache between runs')
+    parser.add_argument('--output', help='write JSON here instead of stdout')
+    args = parser.parse_args(argv)
+
+    registry = FakeRegistry(latency=args.latency)
+    image = registry.add_image('bench/image', 'latest', layers=args.layers,
+                               files=args.files, size=args.size,
+                               whiteouts=args.whiteouts, seed=args.seed)
+    registry.start()
+    cachedir = tempfile.mkdtemp(prefix='pullbench-cache')
+    runs = []
+    try:
+        for _ in xrange(args.runs):
+            if not args.warm:
+                shutil.rmtree(cachedir)
+                os.mkdir(cachedir)
+                dockerv2._CONFIG_CACHE.clear()
+            workdir = tempfile.mkdtemp(prefix='pullbench')
+            try:
+                stages = run_once(registry, args, cachedir, workdir)
+            finally:
+                shutil.rmtree(workdir)
+            runs.append({
+                'stages': stages,
+                'wall': sum(x['wall'] for x in stages),
+            })
+    finally:
+        registry.stop()
+        shutil.rmtree(cachedir)
+
+    result = {
+        'params': vars(args),
+        'image': {'digest': image['digest'], 'bytes': image['bytes']},
+        'runs': runs,
+    }
+    if args.output is not None:
+        with open(args.output, 'w') as out_fp:
+            json.dump(result, out_fp, indent=2)
+    else:
+        json.dump(result, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+# Shifter, Copyright (c) 2017, The Regents of the University of California,
+# through Lawrence Berkeley National Laboratory (subject to receipt of any
+# required approvals from the U.S. Dept. of Energy).  All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#  1. Redistributions of source code must retain the above copyright notice,
+#     this list of conditions and the following disclaimer.
+#  2. Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions and the following disclaimer in the documentation
+#     and/or other materials provided with the distribution.
+#  3. Neither the name of the University of California, Lawrence Berkeley
+#     National Laboratory, U.S. Dept. of Energy nor the names of its
+#     contributors may be used to endorse or promote products derived from this
+#     software without specific prior written permission.`
+#
+# See LICENSE for full text.
+
+"""
+Compare squashfs converter profiles on a sample image.
+
+Each profile converts the same unpacked image with mksquashfs.  Conversion
+wall and CPU time, the image size and the time unsquashfs takes to read the
+image back (a stand-in for decompression on the compute nodes) are written
+as JSON.  The image is either an unpacked tree given with --source or a
+synthetic image generated with the fake registry.
+
+Example:
+    PYTHONPATH=imagegw python imagegw/bench/squashbench.py \\
+        --config /etc/shifter/imagemanager.json --source /tmp/ubuntu
+"""
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from shifter_imagegw import dockerv2, converters
+from fakeregistry import FakeRegistry
+from pullbench import _tree_size
+
+DEFAULT_PROFILES = {
+    'default': {},
+    'gzip-1M': {'compressor': 'gzip', 'blockSize': '1M'},
+    'lz4': {'compressor': 'lz4'},
+    'zstd': {'compressor': 'zstd', 'compressionLevel': 3},
+    'xz-1M': {'compressor': 'xz', 'blockSize': '1M'},
+}
+
+
+def synthesize(args, dest):
+    """Unpack a synthetic image from the fake registry into dest."""
+    registry = FakeRegistry()
+    registry.add_image('bench/image', 'latest', layers=args.layers,
+                       files=args.files, size=args.size)
+    registry.start()
+    cachedir = tempfile.mkdtemp(prefix='squashbench-cache')
+    try:
+        options = {'baseUrl': registry.url, 'cachedir': cachedir}
+        handle = dockerv2.DockerV2Handle('bench/image:latest', options)
+        manifest = handle.get_image_manifest()
+        handle.examine_manifest(manifest)
+        handle.pull_layers(manifest, cachedir)
+        handle.extract_docker_layers(dest, handle.get_eldest_layer(),
+                                     cachedir=cachedir)
+    finally:
+        registry.stop()
+        shutil.rmtree(cachedir)
+
+
+def run_profile(source, options, workdir):
+    """Convert a copy of source with options and measure it."""
+    expand = os.path.join(workdir, 'expand')
+    shutil.copytree(source, expand, symlinks=True)
+    image = os.path.join(workdir, 'image.squashfs')
+    result = {}
+    times = os.times()
+    start = time.time()
+    converters.generate_squashfs_image(expand, image, options)
+    after = os.times()
+    result['convert_wall'] = time.time() - start
+    result['convert_cpu'] = after[2] + after[3] - times[2] - times[3]
+    result['bytes'] = os.path.getsize(image)
+
+    readback = os.path.join(workdir, 'readback')
+    start = time.time()
+    try:
+        with open(os.devnull, 'w') as devnull:
+            ret = subprocess.call(['unsquashfs', '-no-progress', '-d',
+                                   readback, image], stdout=devnull)
+        if ret == 0:
+            result['read_wall'] = time.time() - start
+    except OSError:
+        # unsquashfs is not installed
+        pass
+    shutil.rmtree(readback, ignore_errors=True)
+    os.unlink(image)
+    return result
+
+
+def main(argv=None):
+    """Command line entry point."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--source', help='unpacked image to convert')
+    parser.add_argument('--config',
+                        help='imagemanager.json whose ConverterProfiles '
+                             'are compared instead of the built-in ones')
+    parser.add_argument('--profile', action='append',
+                        help='only run the named profile (repeatable)')
+    parser.add_argument('--layers', type=int, default=4)
+    parser.add_argument('--files', type=int, default=500)
+    parser.add_argument('--size', type=int, default=16384)
+    parser.add_argument('--runs', type=int, default=1)
+    parser.add_argument('--output', help='write JSON here instead of stdout')
+    args = parser.parse_args(argv)
+
+    profiles = DEFAULT_PROFILES
+    if args.config is not None:
+        with open(args.config) as config_fp:
+            config = json.load(config_fp)
+        profiles = dict((name, prof.get('squashfs', {})) for (name, prof)
+                        in config.get('ConverterProfiles', {}).items())
+    if args.profile:
+        profiles = dict((name, profiles[name]) for name in args.profile)
+
+    tmpdir = tempfile.mkdtemp(prefix='squashbench')
+    try:
+        source = args.source
+        if source is None:
+            source = os.path.join(tmpdir, 'source')
+            os.mkdir(source)
+            synthesize(args, source)
+        results = {}
+        for (name, options) in sorted(profiles.items()):
+            runs = []
+            for _ in xrange(args.runs):
+                workdir = tempfile.mkdtemp(dir=tmpdir)
+                try:
+                    runs.append(run_profile(source, options, workdir))
+                except OSError as err:
+                    runs.append({'error': str(err)})
+                finally:
+                    shutil.rmtree(workdir)
+            results[name] = {'options': options, 'runs': runs}
+        result = {
+            'source': args.source,
+            'source_bytes': _tree_size(source),
+            'profiles': results,
+        }
+    finally:
+        shutil.rmtree(tmpdir)
+
+    if args.output is not None:
+        with open(args.output, 'w') as out_fp:
+            json.dump(result, out_fp, indent=2)
+    else:
+        json.dump(result, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -16,7 +16,7 @@ for service in $@ ; do
     queue=$(echo $service|sed 's/.*://')
     echo "Worker Queue: $queue"
     export PYTHONPATH=`pwd`
-    celery -c 1 -A shifter_imagegw.imageworker worker -Q $queue --loglevel=info &
+    celery -A shifter_imagegw.imageworker worker -Q $queue --loglevel=info &
   elif  [ "$service"  == "flower" ] ; then
     flower -A imageworker &
   elif  [ $(echo $service|grep -c "munge:") -gt 0 ] ; then
@@ -32,7 +32,7 @@ MUNGEENV = os.environ['MUNGE']
 
 def usage(program):
     """ usage line """
-    print "usage: %s <lookup|pull> system image" % (program)
+    print "usage: %s <lookup|pull> system image [image ...]" % (program)
     sys.exit(1)
 
 def main():
@@ -50,7 +50,28 @@ def main():
         mungetok = MUNGEENV
     url = "http://%s/api"%(SERVER)
 
-    if com == 'lookup' and len(sys.argv) >= 2:
+    if com == 'lookup' and len(sys.argv) > 2:
+        # Several images are resolved with a single batch request
+        system = sys.argv[0]
+        header = {'authentication': mungetok.strip()}
+        uri = "%s/lookup/%s/" % (url, system)
+        body = json.dumps({'imgtype': 'docker', 'tags': sys.argv[1:]})
+        req = requests.post(uri, headers=header, data=body)
+        if req.status_code != 200:
+            print "Lookup failed"
+            sys.exit(1)
+        resp = json.loads(req.text)
+        missing = False
+        for (tag, rec) in sorted(resp['images'].items()):
+            if rec is None:
+                print '%-45.45s  %s' % (tag, 'NOT FOUND')
+                missing = True
+            else:
+                print '%-45.45s  %-12.12s  %s' % (tag, rec['id'],
+                                                  rec['status'])
+        if missing:
+            sys.exit(1)
+    elif com == 'lookup' and len(sys.argv) >= 2:
         (system, image) = sys.argv[0:2]
         header = {'authentication': mungetok.strip()}
         uri = "%s/lookup/%s/docker/%s/" % (url, system, image)
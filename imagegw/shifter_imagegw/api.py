@@ -21,18 +21,27 @@
 This module provides the REST API for the image gateway.
 """
 
+import calendar
 import json
 import os
 import sys
 import logging
+from time import time
 import shifter_imagegw
-from shifter_imagegw.imagemngr import ImageMngr
-from flask import Flask, request, jsonify
+from shifter_imagegw.imagemngr import ImageMngr, AdmissionError
+from shifter_imagegw.metrics import REGISTRY, Counter, Histogram
+from flask import Flask, Response, g, request, jsonify, stream_with_context
+from werkzeug.http import http_date
 
 
 app = Flask(__name__)
 config = {}
 AUTH_HEADER = 'authentication'
+REQUEST_LATENCY = Histogram('shifter_imagegw_request_seconds',
+                            'Latency of API requests', ['route', 'method'])
+REQUESTS = Counter('shifter_imagegw_requests_total',
+                   'API requests by response status',
+                   ['route', 'method', 'status'])
 
 
 if 'GWCONFIG' in os.environ:
@@ -62,6 +71,7 @@ with open(CONFIG_FILE) as config_file:
         else:
             app.logger.critical('Unrecongnized Log Level specified')
 mgr = ImageMngr(config, logger=app.logger)
+mgr.start_scheduler()
 
 
 # For RESTful Service
@@ -79,19 +89,79 @@ def not_found(error=None):
     return resp
 
 
+def too_many_requests(error=None):
+    """ Error function to return a 429 for a pull over the user's limit. """
+    app.logger.warning("429 return")
+    message = {
+        'status': 429,
+        'error': str(error),
+        'message': 'Too Many Requests: ' + request.url,
+    }
+    resp = jsonify(message)
+    resp.status_code = 429
+    return resp
+
+
+@app.before_request
+def start_request_timer():
+    """ Note when the request started for the latency metrics. """
+    g.request_start = time()
+
+
+@app.after_request
+def record_request(response):
+    """ Account the request in the per-route metrics. """
+    if 'request_start' in g:
+        route = 'unmatched'
+        if request.url_rule is not None:
+            route = request.url_rule.rule
+        REQUEST_LATENCY.observe(time() - g.request_start, route=route,
+                                method=request.method)
+        REQUESTS.inc(route=route, method=request.method,
+                     status=response.status_code)
+    return response
+
+
+# Metrics scrape endpoint
+# This exposes the gateway counters and histograms in the Prometheus text
+# format.
+@app.route('/metrics', methods=["GET"])
+def prometheus_metrics():
+    """ Return all metrics for this process. """
+    try:
+        mgr.update_queue_metrics()
+    except:
+        app.logger.exception('Unable to update queue metrics')
+    return Response(REGISTRY.render(),
+                    mimetype='text/plain; version=0.0.4')
+
+
+def not_modified(etag):
+    """ Empty 304 response carrying etag. """
+    return Response(status=304, headers={'ETag': etag})
+
+
+def _timestamp(date):
+    """ Seconds since the epoch for a naive UTC datetime. """
+    return calendar.timegm(date.utctimetuple())
+
+
 @app.route('/')
 def apihelp():
     """ API helper return """
     return "{lookup,pull,expire,list}"
 
 
-def create_response(rec):
+RESPONSE_FIELDS = (
+    'id', 'system', 'itype', 'tag', 'status', 'userACL', 'groupACL',
+    'ENV', 'ENTRY', 'WORKDIR', 'last_pull', 'status_message',
+    'timings',
+)
+
+
+def create_response(rec, fields=RESPONSE_FIELDS):
     """ Helper function to create a formated JSON response. """
     resp = {}
-    fields = (
-        'id', 'system', 'itype', 'tag', 'status', 'userACL', 'groupACL',
-        'ENV', 'ENTRY', 'WORKDIR', 'last_pull', 'status_message',
-    )
     for field in fields:
         try:
             resp[field] = rec[field]
@@ -101,15 +171,39 @@ def create_response(rec):
 
 
 # List images
-# This will list the images for a system
+# This will list the images for a system.  Optional query arguments:
+#   limit=<n> returns at most n images and the position of the next page
+#   after=<next> continues from a previous page
+#   fields=<f1,f2> returns only the named fields
+# Without a limit the whole list is streamed.
 @app.route('/api/list/<system>/', methods=["GET"])
 def imglist(system):
     """ List images for a specific system. """
     auth = request.headers.get(AUTH_HEADER)
     app.logger.debug("list system=%s" % (system))
+    fields = RESPONSE_FIELDS
+    limit = None
+    try:
+        if 'fields' in request.args:
+            fields = tuple(request.args['fields'].split(','))
+            for field in fields:
+                if field not in RESPONSE_FIELDS:
+                    raise ValueError('Unknown field %s' % field)
+        if 'limit' in request.args:
+            limit = int(request.args['limit'])
+            if limit <= 0:
+                raise ValueError('limit must be positive')
+    except ValueError:
+        return not_found('%s' % (sys.exc_value))
     try:
         session = mgr.new_session(auth, system)
-        records = mgr.imglist(session, system)
+        etag = mgr.list_etag(session, system, limit,
+                             request.args.get('after'), ','.join(fields))
+        if request.headers.get('If-None-Match') == etag:
+            return not_modified(etag)
+        records = mgr.imglist_iter(session, system, limit=limit,
+                                   after=request.args.get('after'),
+                                   fields=fields)
         if records is None:
             return not_found('image not found')
     except OSError:
@@ -118,11 +212,32 @@ def imglist(system):
     except:
         app.logger.exception('Unknown Exception in List')
         return not_found('%s' % (sys.exc_value))
-    images = []
-    for rec in records:
-        images.append(create_response(rec))
-    resp = {'list': images}
-    return jsonify(resp)
+
+    if limit is not None:
+        images = []
+        last = None
+        for rec in records:
+            images.append(create_response(rec, fields))
+            last = rec['_id']
+        resp = {'list': images}
+        if len(images) == limit:
+            resp['next'] = str(last)
+        resp = jsonify(resp)
+        resp.headers['ETag'] = etag
+        return resp
+
+    def generate():
+        """ Stream the list one record at a time. """
+        yield '{"list": ['
+        first = True
+        for rec in records:
+            if not first:
+                yield ', '
+            first = False
+            yield json.dumps(create_response(rec, fields))
+        yield ']}\n'
+    return Response(stream_with_context(generate()),
+                    mimetype='application/json', headers={'ETag': etag})
 
 
 # Lookup image
@@ -138,16 +253,70 @@ def lookup(system, imgtype, tag):
            % (system, imgtype, tag, auth)
     app.logger.debug(memo)
     i = {'system': system, 'itype': imgtype, 'tag': tag}
+    client_etag = request.headers.get('If-None-Match')
     try:
         session = mgr.new_session(auth, system)
+        # Nothing changed since the client's copy, skip reading the record
+        if client_etag is not None and \
+                mgr.lookup_unchanged(session, i, client_etag):
+            return not_modified(client_etag)
         rec = mgr.lookup(session, i)
         if rec is None:
             app.logger.debug("Image lookup failed.")
             return not_found('image not found')
+        etag = mgr.lookup_etag(session, i, rec)
     except:
         app.logger.exception('Exception in lookup')
         return not_found('%s %s' % (sys.exc_type, sys.exc_value))
-    return jsonify(create_response(rec))
+    # The version moved on but this record did not
+    if client_etag is not None and \
+            client_etag.split('-')[1:3] == etag.split('-')[1:3]:
+        return not_modified(etag)
+    last_pull = rec.get('last_pull')
+    if client_etag is None and last_pull is not None and \
+            request.if_modified_since is not None and \
+            int(last_pull) <= _timestamp(request.if_modified_since):
+        return not_modified(etag)
+    resp = jsonify(create_response(rec))
+    resp.headers['ETag'] = etag
+    if last_pull is not None:
+        resp.headers['Last-Modified'] = http_date(last_pull)
+    return resp
+
+
+# Batch lookup
+# This will lookup the status of several images with one request.  The body
+# is a JSON object with a list of "tags" and an optional "imgtype" (docker).
+@app.route('/api/lookup/<system>/', methods=["POST"])
+def lookup_batch(system):
+    """ Lookup several images for a system and return their records """
+    auth = request.headers.get(AUTH_HEADER)
+    try:
+        data = json.loads(request.get_data())
+        imgtype = data.get('imgtype', 'docker')
+        tags = data['tags']
+        if not isinstance(tags, list):
+            raise ValueError('tags must be a list')
+    except:
+        app.logger.warn("Unable to parse lookup data '%s'" %
+                        (request.get_data()))
+        return not_found('Invalid lookup request')
+    if imgtype == 'docker':
+        tags = [tag if tag.find(':') >= 0 else '%s:latest' % tag
+                for tag in tags]
+    memo = 'batch lookup system=%s imgtype=%s tags=%d' \
+           % (system, imgtype, len(tags))
+    app.logger.debug(memo)
+    try:
+        session = mgr.new_session(auth, system)
+        recs = mgr.lookup_batch(session, system, imgtype, tags)
+    except:
+        app.logger.exception('Exception in batch lookup')
+        return not_found('%s %s' % (sys.exc_type, sys.exc_value))
+    images = {}
+    for (tag, rec) in recs.items():
+        images[tag] = create_response(rec) if rec is not None else None
+    return jsonify({'images': images})
 
 
 # Get Metrics
@@ -199,18 +368,53 @@ def pull(system, imgtype, tag):
         # Convert to integers
         i['groupACL'] = map(lambda x: int(x),
                             data['allowed_gids'].split(','))
+    if 'callback' in data:
+        i['callback'] = data['callback']
+    if 'class' in data:
+        # e.g. refresh for pulls made ahead of time by a prefetcher
+        i['class'] = data['class']
     try:
         app.logger.debug(i)
         session = mgr.new_session(auth, system)
         app.logger.debug(session)
         rec = mgr.pull(session, i)
         app.logger.debug(rec)
+    except AdmissionError as err:
+        return too_many_requests(err)
     except:
         app.logger.exception('Exception in pull')
         return not_found('%s %s' % (sys.exc_type, sys.exc_value))
     return jsonify(create_response(rec))
 
 
+# Wait for a pull
+# This will block until the status of a pull changes from the status given
+# or the pull finishes, at most timeout seconds.
+@app.route('/api/wait/<system>/<imgtype>/<path:tag>/', methods=["GET"])
+def wait(system, imgtype, tag):
+    """ Long poll for a state change of an image pull. """
+    if imgtype == "docker" and tag.find(':') == -1:
+        tag = '%s:latest' % (tag)
+
+    auth = request.headers.get(AUTH_HEADER)
+    memo = 'wait system=%s imgtype=%s tag=%s' % (system, imgtype, tag)
+    app.logger.debug(memo)
+    i = {'system': system, 'itype': imgtype, 'tag': tag}
+    try:
+        timeout = None
+        if 'timeout' in request.args:
+            timeout = float(request.args['timeout'])
+        session = mgr.new_session(auth, system)
+        rec = mgr.wait(session, i, state=request.args.get('status'),
+                       timeout=timeout)
+        if rec is None:
+            return not_found('image not found')
+    except:
+        app.logger.exception('Exception in wait')
+        return not_found('%s %s' % (sys.exc_type, sys.exc_value))
+    return jsonify(create_response(rec))
+
+
 # auto expire
 # This will autoexpire images and cleanup stuck pulls
 @app.route('/api/autoexpire/<system>/', methods=["GET"])
@@ -254,13 +458,14 @@ def expire(system, imgtype, tag):
 @app.route('/api/queue/<system>/', methods=["GET"])
 def queue(system):
     """ List images for a specific system. """
-    #auth = request.headers.get(AUTH_HEADER)
+    # Optional, admins also see who requested each pull
+    auth = request.headers.get(AUTH_HEADER)
     app.logger.debug("show queue system=%s" % (system))
     try:
-        session = mgr.new_session(None, system)
+        session = mgr.new_session(auth, system)
         records = mgr.show_queue(session, system)
     except:
         app.logger.exception('Exception in queue')
         return not_found('%s' % (sys.exc_value))
-    resp = {'list': records}
+    resp = {'list': records, 'waits': mgr.queue_waits(records)}
     return jsonify(resp)
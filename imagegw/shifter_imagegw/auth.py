@@ -23,6 +23,10 @@ Module to abstract authentication.  Currently just wraps munge.
 
 import json
 from shifter_imagegw import munge
+from shifter_imagegw.metrics import Histogram
+
+AUTH_LATENCY = Histogram('shifter_imagegw_auth_seconds',
+                         'Time spent authenticating requests', ['type'])
 
 class Authentication(object):
     """
@@ -110,9 +114,10 @@ class Authentication(object):
         authstr is the message to be validated.
         system is required for munge.
         """
-        if self.type == 'munge':
-            return self._authenticate_munge(authstr, system)
-        elif self.type == 'mock':
-            return self._authenticate_mock(authstr, system)
-        else:
-            raise OSError('Unsupported auth type')
+        with AUTH_LATENCY.time(type=self.type):
+            if self.type == 'munge':
+                return self._authenticate_munge(authstr, system)
+            elif self.type == 'mock':
+                return self._authenticate_mock(authstr, system)
+            else:
+                raise OSError('Unsupported auth type')
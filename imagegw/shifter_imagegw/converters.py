@@ -24,19 +24,307 @@ format for shifter.
 """
 
 import os
+import stat
+import struct
 import subprocess
 import shutil
 import tempfile
-from shifter_imagegw.util import program_exists
+from shifter_imagegw.util import program_exists, program_supports, which
 
+MIB = 1024 * 1024
+# mkfs.xfs refuses to make smaller file systems
+XFS_MIN_SIZE = 300 * MIB
+XFS_LOG_SIZE = 64 * MIB
 
-def generate_ext4_image(expand_path, image_path):
+
+def _blocks(nbytes, block_size):
+    """Number of blocks of block_size needed to hold nbytes."""
+    return (nbytes + block_size - 1) // block_size
+
+
+def tree_usage(path, block_size=4096, count_links=False):
+    """
+    Return the (bytes, inodes) a file system with block_size blocks needs
+    to hold the tree at path.  Hard linked files are counted once unless
+    count_links is set (for formats that store every link as a copy),
+    short symlinks are stored in their inode.
+    """
+    nblocks = 0
+    inodes = 0
+    seen = set()
+    for (dirpath, dirnames, filenames) in os.walk(path):
+        inodes += 1
+        entries = dirnames + filenames
+        # directory entries are 8 bytes plus the name padded to 4 bytes
+        dirsize = 24 + sum(8 + (len(x) + 3) // 4 * 4 for x in entries)
+        nblocks += _blocks(dirsize, block_size)
+        for name in entries:
+            fstat = os.lstat(os.path.join(dirpath, name))
+            if stat.S_ISDIR(fstat.st_mode):
+                continue
+            if fstat.st_nlink > 1 and not count_links:
+                if (fstat.st_dev, fstat.st_ino) in seen:
+                    continue
+                seen.add((fstat.st_dev, fstat.st_ino))
+            inodes += 1
+            if stat.S_ISREG(fstat.st_mode):
+                nblocks += _blocks(fstat.st_size, block_size)
+            elif stat.S_ISLNK(fstat.st_mode) and fstat.st_size >= 60:
+                nblocks += 1
+    return (nblocks * block_size, inodes)
+
+
+def _make_sparse(image_path, size):
+    """Create image_path as a sparse file of size bytes."""
+    with open(image_path, 'w') as image_fp:
+        image_fp.truncate(size)
+
+
+def _preallocate(image_path):
+    """Allocate all blocks of image_path on disk."""
+    program_exists('fallocate')
+    size = os.path.getsize(image_path)
+    ret = subprocess.call(['fallocate', '-l', str(size), image_path])
+    if ret != 0:
+        raise OSError('fallocate failed with exit code %d' % ret)
+
+
+def ext4_size(image_path):
+    """
+    Return the size in bytes of the ext4 file system in image_path from its
+    superblock, or None if it does not hold one.
+    """
+    with open(image_path, 'rb') as image_fp:
+        image_fp.seek(1024)
+        sblock = image_fp.read(1024)
+    if len(sblock) < 1024:
+        return None
+    (magic,) = struct.unpack_from('<H', sblock, 0x38)
+    if magic != 0xEF53:
+        return None
+    (count_lo,) = struct.unpack_from('<I', sblock, 0x4)
+    (log_size,) = struct.unpack_from('<I', sblock, 0x18)
+    (incompat,) = struct.unpack_from('<I', sblock, 0x60)
+    count = count_lo
+    # 64bit file systems keep the high half of the block count
+    if incompat & 0x80:
+        (count_hi,) = struct.unpack_from('<I', sblock, 0x150)
+        count += count_hi << 32
+    return count * (1024 << log_size)
+
+
+def ext4_args(options, inodes):
+    """
+    Translate a converter profile into mkfs.ext4 options.  Profiles may
+    set:
+      blockSize: block size in bytes (default 4096)
+      inodeSize: inode size in bytes (default 256)
+      inodeRatio: bytes per inode, instead of sizing the inode table
+                  to the image
+      journal: True to create a journal (read-only images do not need one)
+      extraArgs: list of further options passed as is
+    """
+    args = ['-F', '-q', '-m', '0',
+            '-b', str(options.get('blockSize', 4096)),
+            '-I', str(options.get('inodeSize', 256))]
+    if 'inodeRatio' in options:
+        args.extend(['-i', str(options['inodeRatio'])])
+    else:
+        args.extend(['-N', str(inodes)])
+    if options.get('journal', False) is False:
+        args.extend(['-O', '^has_journal'])
+    args.extend(['-E', 'root_owner=0:0'])
+    args.extend(str(x) for x in options.get('extraArgs', []))
+    return args
+
+
+def _chown_root(path):
+    """
+    Make root the owner of everything below path.  mkfs.ext4 -d copies the
+    owners from the tree and has no option to squash them.
+    """
+    for (dirpath, dirnames, filenames) in os.walk(path):
+        for name in dirnames + filenames:
+            fpath = os.path.join(dirpath, name)
+            fstat = os.lstat(fpath)
+            if fstat.st_uid != 0 or fstat.st_gid != 0:
+                os.lchown(fpath, 0, 0)
+
+
+def generate_ext4_image(expand_path, image_path, options=None):
+    """
+    Creates an ext4 based image without a loop mount by populating it with
+    mkfs.ext4 -d.  The image is sized from the expanded tree and, if
+    resize2fs is available, shrunk to the minimum size afterwards.  It is
+    left sparse unless the profile sets preallocate.  Besides the options
+    of ext4_args, profiles may set slack (extra space as a fraction of the
+    tree, default 0.1), shrink (default True) and preallocate.  Like the
+    other formats everything in the image is owned by root, so the
+    expanded tree is chowned in place.  Raises OSError if the image could
+    not be made.
+    """
+    program_exists('mkfs.ext4')
+    if options is None:
+        options = {}
+    if not os.path.isdir(expand_path):
+        raise OSError('%s is not a directory' % expand_path)
+    block_size = int(options.get('blockSize', 4096))
+    (nbytes, inodes) = tree_usage(expand_path, block_size)
+    # Leave room for the reserved inodes
+    inodes += 16
+    size = nbytes + inodes * int(options.get('inodeSize', 256))
+    size += int(size * float(options.get('slack', 0.1))) + 16 * MIB
+    nblocks = _blocks(size, block_size)
+    _make_sparse(image_path, nblocks * block_size)
+
+    _chown_root(expand_path)
+    cmd = ['mkfs.ext4']
+    cmd.extend(ext4_args(options, inodes))
+    cmd.extend(['-d', expand_path, image_path, str(nblocks)])
+    ret = subprocess.call(cmd)
+    if ret != 0:
+        raise OSError('mkfs.ext4 failed with exit code %d: %s' %
+                      (ret, ' '.join(cmd)))
+
+    if options.get('shrink', True) and which('resize2fs') is not None and \
+            ext4_size(image_path) is not None:
+        with open(os.devnull, 'w') as devnull:
+            ret = subprocess.call(['resize2fs', '-M', image_path],
+                                  stdout=devnull, stderr=devnull)
+        if ret != 0:
+            raise OSError('resize2fs failed with exit code %d' % ret)
+        with open(image_path, 'r+') as image_fp:
+            image_fp.truncate(ext4_size(image_path))
+    if options.get('preallocate', False):
+        _preallocate(image_path)
+    try:
+        shutil.rmtree(expand_path)
+    except:
+        pass
+    return True
+
+
+def _proto_mode(fstat):
+    """Mode string of a protofile entry: type, setuid, setgid, octal."""
+    mode = fstat.st_mode
+    if stat.S_ISDIR(mode):
+        ftype = 'd'
+    elif stat.S_ISLNK(mode):
+        ftype = 'l'
+    elif stat.S_ISCHR(mode):
+        ftype = 'c'
+    elif stat.S_ISBLK(mode):
+        ftype = 'b'
+    elif stat.S_ISFIFO(mode):
+        ftype = 'p'
+    else:
+        ftype = '-'
+    return '%s%s%s%03o' % (ftype, 'u' if mode & stat.S_ISUID else '-',
+                           'g' if mode & stat.S_ISGID else '-',
+                           mode & 0777)
+
+
+def _proto_word(word, what):
+    """Check that word can be stored in a protofile."""
+    if word == '' or word == '$' or len(word.split()) != 1:
+        raise OSError('xfs images cannot hold the %s %r' % (what, word))
+    return word
+
+
+def _write_proto_dir(path, proto_fp):
+    """Write the protofile entries for the contents of directory path."""
+    for name in sorted(os.listdir(path)):
+        fpath = os.path.join(path, name)
+        fstat = os.lstat(fpath)
+        mode = _proto_mode(fstat)
+        entry = '%s %s 0 0' % (_proto_word(name, 'file name'), mode)
+        if stat.S_ISDIR(fstat.st_mode):
+            proto_fp.write('%s\n' % entry)
+            _write_proto_dir(fpath, proto_fp)
+            proto_fp.write('$\n')
+        elif stat.S_ISREG(fstat.st_mode):
+            proto_fp.write('%s %s\n' % (entry, _proto_word(fpath, 'path')))
+        elif stat.S_ISLNK(fstat.st_mode):
+            target = _proto_word(os.readlink(fpath), 'symlink target')
+            proto_fp.write('%s %s\n' % (entry, target))
+        elif stat.S_ISCHR(fstat.st_mode) or stat.S_ISBLK(fstat.st_mode):
+            proto_fp.write('%s %d %d\n' % (entry, os.major(fstat.st_rdev),
+                                           os.minor(fstat.st_rdev)))
+        elif stat.S_ISFIFO(fstat.st_mode):
+            proto_fp.write('%s\n' % entry)
+        # sockets are left out
+
+
+def write_xfs_protofile(expand_path, proto_fp):
+    """
+    Write a mkfs.xfs protofile describing the tree at expand_path with
+    everything owned by root.  The protofile format has no room for the
+    sticky bit, hard links or names containing whitespace.
+    """
+    proto_fp.write('/dev/null\n0 0\n')
+    proto_fp.write('%s 0 0\n' % _proto_mode(os.stat(expand_path)))
+    _write_proto_dir(expand_path, proto_fp)
+    proto_fp.write('$\n')
+
+
+def xfs_args(options):
+    """
+    Translate a converter profile into mkfs.xfs options.  Profiles may
+    set:
+      blockSize: block size in bytes (default 4096)
+      inodeSize: inode size in bytes (default 512)
+      extraArgs: list of further options passed as is
     """
-    Creates an ext4 based image
+    args = ['-f', '-q',
+            '-b', 'size=%d' % int(options.get('blockSize', 4096)),
+            '-i', 'size=%d' % int(options.get('inodeSize', 512))]
+    args.extend(str(x) for x in options.get('extraArgs', []))
+    return args
+
+
+def generate_xfs_image(expand_path, image_path, options=None):
+    """
+    Creates an xfs based image without a loop mount by populating it from a
+    protofile.  The image is sized from the expanded tree (but not below
+    the minimum size mkfs.xfs accepts) and left sparse unless the profile
+    sets preallocate.  Besides the options of xfs_args, profiles may set
+    slack (extra space as a fraction of the tree, default 0.1).  Raises
+    OSError if the image could not be made.
     """
-    message = 'ext4 support is note implemented yet %s %s' % \
-              (expand_path, image_path)
-    raise NotImplementedError(message)
+    program_exists('mkfs.xfs')
+    if options is None:
+        options = {}
+    if not os.path.isdir(expand_path):
+        raise OSError('%s is not a directory' % expand_path)
+    block_size = int(options.get('blockSize', 4096))
+    # the protofile turns every hard link into a copy of the file
+    (nbytes, inodes) = tree_usage(expand_path, block_size, count_links=True)
+    size = nbytes + inodes * int(options.get('inodeSize', 512))
+    size += int(size * float(options.get('slack', 0.1))) + XFS_LOG_SIZE
+    size = max(_blocks(size, block_size) * block_size, XFS_MIN_SIZE)
+    _make_sparse(image_path, size)
+
+    (proto_fd, proto_path) = tempfile.mkstemp('.proto', 'xfs',
+                                              os.path.dirname(image_path))
+    try:
+        with os.fdopen(proto_fd, 'w') as proto_fp:
+            write_xfs_protofile(expand_path, proto_fp)
+        cmd = ['mkfs.xfs']
+        cmd.extend(xfs_args(options))
+        cmd.extend(['-p', proto_path, image_path])
+        ret = subprocess.call(cmd)
+    finally:
+        os.unlink(proto_path)
+    if ret != 0:
+        raise OSError('mkfs.xfs failed with exit code %d: %s' %
+                      (ret, ' '.join(cmd)))
+    if options.get('preallocate', False):
+        _preallocate(image_path)
+    try:
+        shutil.rmtree(expand_path)
+    except:
+        pass
+    return True
 
 
 def generate_cramfs_image(expand_path, image_path):
@@ -58,28 +346,146 @@ def generate_cramfs_image(expand_path, image_path):
     return True
 
 
-def generate_squashfs_image(expand_path, image_path):
+def squashfs_args(options=None, append=False):
+    """
+    Translate a converter profile into mksquashfs options.  When appending
+    to an existing image its compressor and block size are kept.  Profiles
+    may set:
+      compressor: gzip, lzo, lz4, xz or zstd
+      compressionLevel: level for compressors that support one
+      blockSize: block size in bytes (e.g. 131072 or "1M")
+      processors: number of threads mksquashfs should use
+      fragments: False to disable fragment packing of small files
+      duplicates: False to skip duplicate file detection
+      extraArgs: list of further options passed as is
+    """
+    if options is None:
+        options = {}
+    args = ['-all-root']
+    if 'compressor' in options and not append:
+        args.extend(['-comp', str(options['compressor'])])
+    if 'compressionLevel' in options and not append:
+        args.extend(['-Xcompression-level',
+                     str(options['compressionLevel'])])
+    if 'blockSize' in options and not append:
+        args.extend(['-b', str(options['blockSize'])])
+    if 'processors' in options:
+        args.extend(['-processors', str(int(options['processors']))])
+    if options.get('fragments', True) is False:
+        args.append('-no-fragments')
+    if options.get('duplicates', True) is False:
+        args.append('-no-duplicates')
+    args.extend(str(x) for x in options.get('extraArgs', []))
+    return args
+
+
+def generate_squashfs_image(expand_path, image_path, options=None):
     """
-    Creates a SquashFS based image
+    Creates a SquashFS based image using the converter profile options
+    (see squashfs_args).  Raises OSError if mksquashfs fails.
     """
     # This will raise an exception if mksquashfs tool is not found
     # it should be handled by the calling function
     program_exists('mksquashfs')
 
-    ret = subprocess.call(["mksquashfs", expand_path, image_path, "-all-root"])
+    cmd = ["mksquashfs", expand_path, image_path]
+    cmd.extend(squashfs_args(options))
+    ret = subprocess.call(cmd)
+    try:
+        shutil.rmtree(expand_path)
+    except:
+        pass
     if ret != 0:
-        # error handling
+        raise OSError('mksquashfs failed with exit code %d: %s' %
+                      (ret, ' '.join(cmd)))
+
+    return True
+
+
+def erofs_args(options=None):
+    """
+    Translate a converter profile into mkfs.erofs options.  Profiles may
+    set:
+      compressor: lz4, lz4hc or another compressor mkfs.erofs knows
+      compressionLevel: level for compressors that support one
+      pclusterSize: maximum size of a compressed physical cluster in bytes
+      features: list of extended options, e.g. ztailpacking or dedupe
+      extraArgs: list of further options passed as is
+    Without a compressor the image is not compressed.
+    """
+    if options is None:
+        options = {}
+    args = ['--all-root']
+    if 'compressor' in options:
+        compressor = str(options['compressor'])
+        if 'compressionLevel' in options:
+            compressor += ',%d' % int(options['compressionLevel'])
+        args.append('-z%s' % compressor)
+    if 'pclusterSize' in options:
+        args.append('-C%d' % int(options['pclusterSize']))
+    if len(options.get('features', [])) > 0:
+        args.append('-E%s' % ','.join(str(x) for x in options['features']))
+    args.extend(str(x) for x in options.get('extraArgs', []))
+    return args
+
+
+def generate_erofs_image(expand_path, image_path, options=None):
+    """
+    Creates an EROFS based image using the converter profile options (see
+    erofs_args).  Raises IOError if mkfs.erofs is missing or does not
+    support the compressor and OSError if it fails.
+    """
+    program_exists('mkfs.erofs')
+    if options is not None and 'compressor' in options:
+        program_supports('mkfs.erofs', str(options['compressor']))
+
+    cmd = ['mkfs.erofs']
+    cmd.extend(erofs_args(options))
+    cmd.extend([image_path, expand_path])
+    ret = subprocess.call(cmd)
+    try:
+        shutil.rmtree(expand_path)
+    except:
         pass
+    if ret != 0:
+        raise OSError('mkfs.erofs failed with exit code %d: %s' %
+                      (ret, ' '.join(cmd)))
+
+    return True
+
+
+def append_squashfs_image(base_path, expand_path, image_path, options=None):
+    """
+    Creates a SquashFS image by appending the tree at expand_path to a copy
+    of the image base_path.  The entries of expand_path must not clash with
+    the top level of base_path.  Raises OSError if mksquashfs fails.
+    """
+    program_exists('mksquashfs')
+
+    shutil.copyfile(base_path, image_path)
+    ret = 0
+    cmd = []
+    if len(os.listdir(expand_path)) > 0:
+        cmd = ["mksquashfs", expand_path, image_path]
+        cmd.extend(squashfs_args(options, append=True))
+        ret = subprocess.call(cmd)
     try:
         shutil.rmtree(expand_path)
     except:
         pass
+    if ret != 0:
+        raise OSError('mksquashfs failed with exit code %d: %s' %
+                      (ret, ' '.join(cmd)))
 
     return True
 
 
-def convert(fmt, expand_path, image_path):
-    """ do the conversion """
+def convert(fmt, expand_path, image_path, options=None, base=None):
+    """
+    do the conversion
+    options is the converter profile for the format, if any
+    base is an image of the same format to add the tree to (squashfs only)
+    """
     if os.path.exists(image_path):
         print "file already exists"
         return True
@@ -91,12 +497,20 @@ def convert(fmt, expand_path, image_path):
 
     try:
         success = False
-        if fmt == 'squashfs':
-            success = generate_squashfs_image(expand_path, temp_path)
+        if fmt == 'squashfs' and base is not None:
+            success = append_squashfs_image(base, expand_path, temp_path,
+                                            options)
+        elif fmt == 'squashfs':
+            success = generate_squashfs_image(expand_path, temp_path,
+                                              options)
         elif fmt == 'cramfs':
             success = generate_cramfs_image(expand_path, temp_path)
         elif fmt == 'ext4':
-            success = generate_ext4_image(expand_path, temp_path)
+            success = generate_ext4_image(expand_path, temp_path, options)
+        elif fmt == 'xfs':
+            success = generate_xfs_image(expand_path, temp_path, options)
+        elif fmt == 'erofs':
+            success = generate_erofs_image(expand_path, temp_path, options)
         elif fmt == 'mock':
             with open(temp_path, 'w') as f:
                 f.write('bogus')
@@ -33,10 +33,36 @@ import base64
 import tempfile
 import socket
 import tarfile
+import threading
+import calendar
+import copy
+import Queue
+from time import time, strptime
+from shifter_imagegw.layerindex import LayerIndex, plan_extraction
 
 _EMPTY_TAR_SHA256 = \
     'sha256:a3ed95caeb02ffe68cdd9fd84406680ae93d633cb16422d00e8a7c22955b46d4'
 
+# Manifest formats we know how to parse, most preferred first.  Schema 1 is
+# only requested as a fallback for registries that cannot serve the others.
+_MANIFEST_V2 = 'application/vnd.docker.distribution.manifest.v2+json'
+_MANIFEST_LIST_V2 = 'application/vnd.docker.distribution.manifest.list.v2+json'
+_OCI_MANIFEST = 'application/vnd.oci.image.manifest.v1+json'
+_OCI_INDEX = 'application/vnd.oci.image.index.v1+json'
+_MANIFEST_V1_SIGNED = 'application/vnd.docker.distribution.manifest.v1+prettyjws'
+_MANIFEST_ACCEPT = ', '.join([_MANIFEST_V2, _MANIFEST_LIST_V2, _OCI_MANIFEST,
+                              _OCI_INDEX, _MANIFEST_V1_SIGNED])
+
+# Image configuration blobs are immutable, so parsed copies can be reused by
+# later pulls of any image sharing them
+_CONFIG_CACHE_SIZE = 256
+_CONFIG_CACHE = {}
+_CONFIG_CACHE_LOCK = threading.Lock()
+
+# Token servers that omit expires_in are assumed to issue tokens valid for 60
+# seconds (per the Docker registry token specification)
+_DEFAULT_TOKEN_LIFETIME = 60
+
 # Option to use a SOCKS proxy
 if 'all_proxy' in os.environ:
     import socks
@@ -88,6 +114,171 @@ def _verify_manifest_signature(manifest, text, digest):
     return True
 
 
+def _verify_content_digest(data, digest):
+    """
+    Verify that data hashes to digest (e.g. sha256:abcd...)
+    """
+    (hash_type, value) = digest.split(':', 1)
+    if hash_type not in hashlib.algorithms:
+        raise ValueError('Unsupported digest algorithm %s' % hash_type)
+    if hashlib.new(hash_type, data).hexdigest() != value:
+        raise ValueError('Failed to match digest %s to downloaded content'
+                         % digest)
+    return True
+
+
+def _is_manifest_list(manifest):
+    """Return True if manifest is a schema2 manifest list or an OCI index."""
+    media_type = manifest.get('mediaType')
+    if media_type in (_MANIFEST_LIST_V2, _OCI_INDEX):
+        return True
+    # mediaType is optional in OCI indexes
+    return media_type is None and manifest.get('schemaVersion') == 2 and \
+        'manifests' in manifest and 'layers' not in manifest
+
+
+def _select_platform_manifest(manifest_list, arch='amd64', osname='linux',
+                              variant=None):
+    """
+    Pick the manifest for the requested platform out of a manifest list or
+    OCI index.  Returns the digest of the matching manifest.
+    """
+    candidates = []
+    for entry in manifest_list.get('manifests', []):
+        platform = entry.get('platform', {})
+        if platform.get('architecture') != arch or \
+                platform.get('os') != osname:
+            continue
+        if variant is not None and platform.get('variant') != variant:
+            continue
+        candidates.append(entry)
+    if len(candidates) == 0:
+        raise ValueError('No manifest found for platform %s/%s'
+                         % (osname, arch))
+    # Without an explicit variant prefer the generic entry
+    candidates.sort(key=lambda x: 'variant' in x.get('platform', {}))
+    return candidates[0]['digest']
+
+
+def _construct_schema2_metadata(manifest, config_digest, config):
+    """
+    Build the same linked list of layers _construct_image_metadata returns
+    from a schema2 or OCI image manifest and its configuration blob.
+    """
+    if 'layers' not in manifest:
+        raise ValueError('Manifest in incorrect format')
+    eldest = None
+    youngest = None
+    for layer in manifest['layers']:
+        media_type = layer.get('mediaType', '')
+        if 'zstd' in media_type:
+            raise ValueError('Unsupported layer type %s' % media_type)
+        curr = {
+            'id': layer['digest'].split(':', 1)[1],
+            'fsLayer': {'blobSum': layer['digest']},
+            'child': None
+        }
+        if youngest is None:
+            eldest = curr
+        else:
+            youngest['child'] = curr
+        youngest = curr
+
+    if youngest is None:
+        raise ValueError('Manifest contains no layers')
+
+    # As with docker, the image id is the digest of its configuration
+    youngest['id'] = config_digest.split(':', 1)[1]
+    if 'config' in config and config['config'] is not None:
+        youngest['config'] = config['config']
+    return (eldest, youngest)
+
+
+def _parse_issued_at(issued_at):
+    """
+    Convert an RFC3339 issued_at timestamp into seconds since the epoch.
+    Returns None if the timestamp cannot be parsed.
+    """
+    if not isinstance(issued_at, basestring) or len(issued_at) < 19:
+        return None
+    try:
+        stamp = calendar.timegm(strptime(issued_at[:19], '%Y-%m-%dT%H:%M:%S'))
+    except ValueError:
+        return None
+    match_obj = re.search(r'([+-])(\d\d):(\d\d)$', issued_at[19:])
+    if match_obj is not None:
+        (sign, hours, minutes) = match_obj.groups()
+        offset = 3600 * int(hours) + 60 * int(minutes)
+        if sign == '+':
+            stamp -= offset
+        else:
+            stamp += offset
+    return stamp
+
+
+class TokenCache(object):
+    """
+    Cache of registry bearer tokens shared by every DockerV2Handle in a
+    process.  Tokens are keyed by (realm, service, scope, username) and are
+    dropped a few seconds before the expiration advertised by the token
+    server.
+    """
+
+    def __init__(self, margin=5):
+        self.margin = margin
+        self.tokens = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """Return a cached, unexpired token for key or None."""
+        with self.lock:
+            entry = self.tokens.get(key)
+            if entry is None:
+                return None
+            (token, expires) = entry
+            if time() >= expires:
+                del self.tokens[key]
+                return None
+            return token
+
+    def put(self, key, token, expires_in=None, issued_at=None):
+        """Store token for key, honoring expires_in and issued_at."""
+        now = time()
+        try:
+            lifetime = int(expires_in)
+        except (TypeError, ValueError):
+            lifetime = _DEFAULT_TOKEN_LIFETIME
+        issued = _parse_issued_at(issued_at)
+        # Never trust an issue time from the future (clock skew)
+        if issued is None or issued > now:
+            issued = now
+        expires = issued + lifetime - self.margin
+        if expires <= now:
+            return
+        with self.lock:
+            self.tokens[key] = (token, expires)
+
+    def invalidate(self, key, token=None):
+        """
+        Remove the cached token for key.  If token is given only remove the
+        entry if it still holds that token.
+        """
+        with self.lock:
+            entry = self.tokens.get(key)
+            if entry is None:
+                return
+            if token is None or entry[0] == token:
+                del self.tokens[key]
+
+    def clear(self):
+        """Drop all cached tokens."""
+        with self.lock:
+            self.tokens.clear()
+
+
+TOKEN_CACHE = TokenCache()
+
+
 def _setup_http_conn(url, cacert=None):
     """Prepare http connection object and return it."""
     (protocol, url) = url.split('://', 1)
@@ -177,6 +368,140 @@ def _construct_image_metadata(manifest):
     return (no_parent, curr,)
 
 
+def _parse_base_url(base_url):
+    """
+    Split a registry base url into (protocol, server, base_path).
+    """
+    protocol = None
+    server = None
+    base_path = None
+    if base_url.find('http') >= 0:
+        protocol = base_url.split(':')[0]
+        index = base_url.find(':')
+        base_url = base_url[index + 3:]
+    if base_url.find('/') >= 0:
+        index = base_url.find('/')
+        base_path = base_url[index:]
+        server = base_url[:index]
+    else:
+        server = base_url
+
+    if protocol is None or len(protocol) == 0:
+        protocol = 'https'
+
+    if server is None or len(server) == 0:
+        msg = 'unable to parse baseUrl, no server '
+        msg += 'specified, should be like \n'
+        msg += 'https://server.location/optionalBasePath'
+        raise ValueError(msg)
+
+    if base_path is None:
+        base_path = '/v2'
+    return (protocol, server, base_path)
+
+
+class EndpointError(ValueError):
+    """
+    Raised when a registry endpoint fails in a way that another mirror of the
+    same registry might not (throttling, server errors, missing content).
+    """
+
+    def __init__(self, message, status=None, retry_after=None):
+        ValueError.__init__(self, message)
+        self.status = status
+        self.retry_after = retry_after
+
+
+class EndpointStats(object):
+    """
+    Health and latency statistics for registry endpoints, shared by every
+    DockerV2Handle in a process.  Endpoints that fail with a connection
+    error, a server error or a 429 are put in a cooldown and ranked last
+    until it expires.
+    """
+
+    def __init__(self, cooldown=30, alpha=0.3):
+        self.cooldown = cooldown
+        self.alpha = alpha
+        self.stats = {}
+        self.lock = threading.Lock()
+
+    def _entry(self, url):
+        if url not in self.stats:
+            self.stats[url] = {
+                'latency': None,
+                'successes': 0,
+                'failures': 0,
+                'throttled': 0,
+                'last_failure': None,
+                'cooldown_until': 0
+            }
+        return self.stats[url]
+
+    def record_success(self, url, elapsed):
+        """Record a successful response and its latency in seconds."""
+        with self.lock:
+            entry = self._entry(url)
+            entry['successes'] += 1
+            if entry['latency'] is None:
+                entry['latency'] = elapsed
+            else:
+                entry['latency'] = self.alpha * elapsed + \
+                    (1 - self.alpha) * entry['latency']
+
+    def record_failure(self, url, status=None, retry_after=None):
+        """
+        Record a failed request.  Connection errors (status None), 429s and
+        server errors also put the endpoint in a cooldown.
+        """
+        with self.lock:
+            entry = self._entry(url)
+            entry['failures'] += 1
+            entry['last_failure'] = time()
+            if status is not None and status != 429 and status < 500:
+                return
+            if status == 429:
+                entry['throttled'] += 1
+            cooldown = self.cooldown
+            if retry_after is not None:
+                try:
+                    cooldown = int(retry_after)
+                except ValueError:
+                    pass
+            entry['cooldown_until'] = time() + cooldown
+
+    def healthy(self, url):
+        """Return False while an endpoint is cooling down after a failure."""
+        with self.lock:
+            entry = self.stats.get(url)
+            return entry is None or entry['cooldown_until'] <= time()
+
+    def rank(self, urls, by_latency=False):
+        """
+        Order urls for use: healthy endpoints first, then (optionally) by
+        measured latency, otherwise preserving the configured order.
+        """
+        def sort_key(item):
+            (idx, url) = item
+            latency = None
+            entry = self.stats.get(url)
+            if entry is not None:
+                latency = entry['latency']
+            if not by_latency or latency is None:
+                latency = float('inf')
+            return (not self.healthy(url), latency, idx)
+        return [url for (_, url) in sorted(enumerate(urls), key=sort_key)]
+
+    def snapshot(self):
+        """Return a copy of the statistics for reporting."""
+        with self.lock:
+            return dict((url, dict(entry))
+                        for (url, entry) in self.stats.items())
+
+
+ENDPOINT_STATS = EndpointStats()
+
+
 class DockerV2Handle(object):
     """
     A class for fetching and unpacking docker registry (and dockerhub) images.
@@ -192,6 +517,7 @@ class DockerV2Handle(object):
     username = None
     password = None
     token = None
+    token_key = None
     allow_authenticated = True
     check_layer_checksums = True
 
@@ -204,9 +530,16 @@ class DockerV2Handle(object):
         Initialize an instance of the DockerV2 class.
         imageIdent is a tagged repo (e.g., ubuntu:14.04)
         options is a dictionary.  Valid options include:
+            arch/os/variant to select an image from a manifest list
+                (default amd64/linux)
+            cachedir to keep parsed image configurations across pulls
             baseUrl to specify a URL other than dockerhub
+            mirrors to specify an ordered list of mirror URLs to try before
+                baseUrl (e.g. a site-local pull-through cache)
             cacert to specify an approved signing authority
             username/password to specify a login
+            downloadThreads to download up to that many layers at once
+                (default 1)
         """
         # attempt to parse image identifier
         try:
@@ -223,45 +556,40 @@ class DockerV2Handle(object):
         if not isinstance(options, dict):
             raise ValueError('Invalid type for DockerV2 options')
         self.updater = updater
+        self.private = False
+        self.headers = {}
+        self.arch = options.get('arch', 'amd64')
+        self.os = options.get('os', 'linux')
+        self.variant = options.get('variant')
+        self.cachedir = options.get('cachedir')
+        self.download_threads = int(options.get('downloadThreads', 1))
 
         if 'baseUrl' in options:
-            base_url = options['baseUrl']
-            protocol = None
-            server = None
-            base_path = None
-            if base_url.find('http') >= 0:
-                protocol = base_url.split(':')[0]
-                index = base_url.find(':')
-                base_url = base_url[index + 3:]
-            if base_url.find('/') >= 0:
-                index = base_url.find('/')
-                base_path = base_url[index:]
-                server = base_url[:index]
-            else:
-                server = base_url
-
-            if protocol is None or len(protocol) == 0:
-                protocol = 'https'
-
-            if server is None or len(server) == 0:
-                msg = 'unable to parse baseUrl, no server '
-                msg += 'specified, should be like \n'
-                msg += 'https://server.location/optionalBasePath'
-                raise ValueError(msg)
-
-            if base_path is None:
-                base_path = '/v2'
-
-            self.protocol = protocol
-            self.server = server
-            self.base_path = base_path
-            self.private = False
-            self.headers = {}
+            (self.protocol, self.server, self.base_path) = \
+                _parse_base_url(options['baseUrl'])
+
+        # Mirrors are tried in the order given before the registry itself.
+        # Layers are content-addressed so they may come from any of them.
+        self.endpoints = {}
+        self.endpoint_order = []
+        self.endpoint_tokens = {}
+        mirrors = options.get('mirrors') or []
+        if not isinstance(mirrors, list):
+            raise ValueError('mirrors must be a list of registry urls')
+        for endpoint in mirrors + ['%s://%s%s' % (self.protocol, self.server,
+                                                   self.base_path)]:
+            (protocol, server, base_path) = _parse_base_url(endpoint)
+            url = '%s://%s' % (protocol, server)
+            if url not in self.endpoints:
+                self.endpoints[url] = (protocol, server, base_path)
+                self.endpoint_order.append(url)
+        self.registry_url = '%s://%s' % (self.protocol, self.server)
 
         if self.protocol == 'http':
             self.allow_authenticated = False
 
-        self.url = '%s://%s' % (self.protocol, self.server)
+        self.url = self.registry_url
+        self.endpoint = self.registry_url
 
         if self.repo.find('/') == -1 and self.server.endswith('docker.io'):
             self.repo = 'library/%s' % self.repo
@@ -292,6 +620,10 @@ class DockerV2Handle(object):
             self.auth_method = options['authMethod']
         self.eldest = None
         self.youngest = None
+        # seconds spent in merge planning and extraction, and per layer
+        # download statistics, for the worker to report
+        self.timings = {}
+        self.layer_stats = []
 
     def get_eldest_layer(self):
         """Return base layer"""
@@ -333,15 +665,28 @@ class DockerV2Handle(object):
             (key, val) = item.split('=', 2)
             auth_data[key] = val.replace('"', '')
 
+        use_creds = creds and self.username is not None and \
+            self.password is not None
+        if use_creds:
+            print "\nUsing Usernmae/Password: private set to True\n"
+            self.private = True
+
+        token_key = (auth_data['realm'], auth_data.get('service'),
+                     auth_data.get('scope'),
+                     self.username if use_creds else None)
+        token = TOKEN_CACHE.get(token_key)
+        if token is not None:
+            self.token = token
+            self.token_key = token_key
+            return
+
         auth_conn = _setup_http_conn(auth_data['realm'], self.cacert)
         if auth_conn is None:
             raise ValueError('Bad response from registry, ' +
                              'failed to get auth connection')
 
         headers = {}
-        if creds and self.username is not None and self.password is not None:
-            print "\nUsing Usernmae/Password: private set to True\n"
-            self.private = True
+        if use_creds:
             auth = '%s:%s' % (self.username, self.password)
             headers['Authorization'] = 'Basic %s' % base64.b64encode(auth)
 
@@ -361,12 +706,76 @@ class DockerV2Handle(object):
             raise ValueError('Invalid response getting token, not json')
 
         auth_resp = json.loads(resp.read())
-        self.token = auth_resp['token']
+        if 'token' in auth_resp:
+            self.token = auth_resp['token']
+        else:
+            self.token = auth_resp['access_token']
+        self.token_key = token_key
+        TOKEN_CACHE.put(token_key, self.token, auth_resp.get('expires_in'),
+                        auth_resp.get('issued_at'))
+
+    def invalidate_token(self):
+        """Drop the current bearer token, e.g. after it was rejected."""
+        if self.token_key is not None:
+            TOKEN_CACHE.invalidate(self.token_key, self.token)
+        self.token = None
+        self.token_key = None
+
+    def _use_endpoint(self, url):
+        """
+        Point the handle at one of the registry endpoints (a mirror or the
+        registry itself), keeping track of the token held for each.
+        """
+        if url == self.endpoint:
+            return
+        self.endpoint_tokens[self.endpoint] = (self.token, self.token_key)
+        (self.protocol, self.server, self.base_path) = self.endpoints[url]
+        self.url = url
+        self.endpoint = url
+        self.allow_authenticated = self.protocol != 'http'
+        (self.token, self.token_key) = \
+            self.endpoint_tokens.get(url, (None, None))
+        self.headers = {}
+        self._get_auth_header()
+
+    def _endpoint_failed(self, url, err):
+        """Record a failed endpoint and let the updater know."""
+        status = getattr(err, 'status', None)
+        retry_after = getattr(err, 'retry_after', None)
+        ENDPOINT_STATS.record_failure(url, status, retry_after)
+        if len(self.endpoint_order) > 1:
+            self.log("PULLING", 'Registry endpoint %s failed (%s)'
+                     % (url, err))
 
-    def get_image_manifest(self, retrying=False):
+    def get_image_manifest(self):
         """
         Get the image manifest returns a dictionary object of the manifest.
+        Endpoints are tried in the configured order, skipping any that are
+        cooling down after recent failures.
+        """
+        last_error = None
+        for url in ENDPOINT_STATS.rank(self.endpoint_order):
+            self._use_endpoint(url)
+            start = time()
+            try:
+                manifest = self._get_image_manifest()
+            except (EndpointError, socket.error, httplib.HTTPException) \
+                    as err:
+                self._endpoint_failed(url, err)
+                last_error = err
+                continue
+            ENDPOINT_STATS.record_success(url, time() - start)
+            return manifest
+        raise last_error
+
+    def _get_image_manifest(self, retrying=False, reference=None,
+                            from_list=False):
+        """
+        Get the image manifest from the current endpoint.  Manifest lists
+        and OCI indexes are resolved to the manifest for this platform.
         """
+        if reference is None:
+            reference = self.tag
         conn = _setup_http_conn(self.url, self.cacert)
         if conn is None:
             return None
@@ -378,10 +787,11 @@ class DockerV2Handle(object):
         #    auth = '%s:%s' % (self.username, self.password)
         #    headers['Authorization'] = 'Basic %s' % base64.b64encode(auth)
         # Todo: first try unauthenticated then authenticated
-        self._get_auth_header()
+        headers = dict(self._get_auth_header())
+        headers['Accept'] = _MANIFEST_ACCEPT
 
-        req_path = "/v2/%s/manifests/%s" % (self.repo, self.tag)
-        conn.request("GET", req_path, None, self.headers)
+        req_path = "/v2/%s/manifests/%s" % (self.repo, reference)
+        conn.request("GET", req_path, None, headers)
         resp1 = conn.getresponse()
 
         if resp1.status == 401 and not retrying and \
@@ -389,7 +799,8 @@ class DockerV2Handle(object):
             # First try authenticating as public (no creds)
             self.do_token_auth(resp1.getheader('WWW-Authenticate'))
             try:
-                return self.get_image_manifest(retrying=True)
+                return self._get_image_manifest(retrying=True,
+                                                reference=reference)
             except:
                 # Likely failed because it needs a cred, continue
                 pass
@@ -400,30 +811,59 @@ class DockerV2Handle(object):
             # attempt
             self.do_token_auth(resp1.getheader('WWW-Authenticate'),
                                creds=True)
-            return self.get_image_manifest(retrying=True)
+            return self._get_image_manifest(retrying=True,
+                                            reference=reference)
+        if resp1.status == 401 and self.private:
+            # A credentialed token should never be refused, don't hand it
+            # out to the next pull
+            self.invalidate_token()
         if resp1.status != 200:
             msg = "Bad response from registry status=%d" % (resp1.status)
-            raise ValueError(msg)
-        expected_hash = resp1.getheader('docker-content-digest')
-        content_len = int(resp1.getheader('content-length'))
-        if expected_hash is None or len(expected_hash) == 0:
+            raise EndpointError(msg, resp1.status,
+                                resp1.getheader('retry-after'))
+        expected_digest = resp1.getheader('docker-content-digest')
+        if reference.startswith('sha256:'):
+            expected_digest = reference
+        content_len = resp1.getheader('content-length')
+        if expected_digest is None or len(expected_digest) == 0:
             raise ValueError("No docker-content-digest header found")
-        expected_hash = expected_hash.split(':', 1)[1]
         data = resp1.read()
-        if len(data) != content_len:
+        if content_len is not None and len(data) != int(content_len):
             memo = "Failed to read manifest: %d/%d bytes read" \
-                   % (len(data), content_len)
+                   % (len(data), int(content_len))
             raise ValueError(memo)
         jdata = json.loads(data)
 
         # throws exceptions upon failure only
-        _verify_manifest_signature(jdata, data, expected_hash)
+        if jdata.get('schemaVersion') == 1:
+            expected_hash = expected_digest.split(':', 1)[1]
+            _verify_manifest_signature(jdata, data, expected_hash)
+            return jdata
+
+        _verify_content_digest(data, expected_digest)
+        if _is_manifest_list(jdata):
+            if from_list:
+                raise ValueError('Manifest list refers to another list')
+            digest = _select_platform_manifest(jdata, self.arch, self.os,
+                                               self.variant)
+            return self._get_image_manifest(retrying=retrying,
+                                            reference=digest,
+                                            from_list=True)
         return jdata
 
     def examine_manifest(self, manifest):
         """Extract metadata from manifest."""
         self.log("PULLING", 'Constructing manifest')
-        (eldest, youngest) = _construct_image_metadata(manifest)
+        if manifest is not None and manifest.get('schemaVersion') == 2:
+            config_digest = manifest.get('config', {}).get('digest')
+            if config_digest is None:
+                raise ValueError('Manifest is missing its config')
+            config = self.get_image_config(config_digest)
+            (eldest, youngest) = _construct_schema2_metadata(manifest,
+                                                             config_digest,
+                                                             config)
+        else:
+            (eldest, youngest) = _construct_image_metadata(manifest)
 
         self.eldest = eldest
         self.youngest = youngest
@@ -440,22 +880,87 @@ class DockerV2Handle(object):
         return resp
 
     def pull_layers(self, manifest, cachedir):
-        """Download layers to cachedir if they do not exist."""
+        """
+        Download layers to cachedir if they do not exist.  Up to
+        download_threads layers are downloaded at once.
+        """
         # TODO: don't rely on self.eldest to demonstrate that
         # examine_manifest has run
         if self.eldest is None:
             self.examine_manifest(manifest)
+        layers = []
         layer = self.eldest
         while layer is not None:
-            if layer['fsLayer']['blobSum'] in self.excludeBlobSums:
-                layer = layer['child']
-                continue
+            if layer['fsLayer']['blobSum'] not in self.excludeBlobSums:
+                layers.append(layer['fsLayer']['blobSum'])
+            layer = layer['child']
 
-            memo = "Pulling layer %s" % layer['fsLayer']['blobSum']
+        if self.download_threads > 1 and len(set(layers)) > 1:
+            return self._pull_layers_parallel(layers, cachedir)
+        for blobsum in layers:
+            memo = "Pulling layer %s" % blobsum
             self.log("PULLING", memo)
 
-            self.save_layer(layer['fsLayer']['blobSum'], cachedir)
-            layer = layer['child']
+            self.save_layer(blobsum, cachedir)
+        return True
+
+    def _clone(self):
+        """
+        Return a copy of the handle for another thread to download with.
+        Endpoint and token state is per copy, the token cache is shared.
+        """
+        handle = copy.copy(self)
+        handle.headers = dict(self.headers)
+        handle.endpoint_tokens = dict(self.endpoint_tokens)
+        handle.timings = {}
+        handle.layer_stats = []
+        return handle
+
+    def _pull_layers_parallel(self, layers, cachedir):
+        """
+        Download the layers with download_threads threads.  The first error
+        stops the downloads and is raised once all threads are done.
+        """
+        pending = Queue.Queue()
+        for blobsum in sorted(set(layers), key=layers.index):
+            pending.put(blobsum)
+        errors = []
+        lock = threading.Lock()
+        handles = []
+
+        def _download(handle):
+            """ Download layers until none are left or one failed. """
+            while not errors:
+                try:
+                    blobsum = pending.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    with lock:
+                        self.log("PULLING", "Pulling layer %s" % blobsum)
+                    handle.save_layer(blobsum, cachedir)
+                except Exception as err:
+                    errors.append(err)
+
+        threads = []
+        for _ in xrange(min(self.download_threads, pending.qsize())):
+            handle = self._clone()
+            handles.append(handle)
+            thread = threading.Thread(target=_download, args=(handle,))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+
+        stats = []
+        for handle in handles:
+            stats.extend(handle.layer_stats)
+            self.private = self.private or handle.private
+        stats.sort(key=lambda x: layers.index(x['digest']))
+        self.layer_stats.extend(stats)
+        if errors:
+            raise errors[0]
         return True
 
     def _get_auth_header(self):
@@ -472,33 +977,140 @@ class DockerV2Handle(object):
 
     def save_layer(self, layer, cachedir='./'):
         """
-        Save a layer and verify with the digest
+        Save a layer and verify with the digest.  Layers are content
+        addressed, so they are fetched from the fastest healthy endpoint and
+        failed over to the others.
         """
-        path = "/v2/%s/blobs/%s" % (self.repo, layer)
+        filename = '%s/%s.tar' % (cachedir, layer)
+        start = time()
+        if os.path.exists(filename):
+            try:
+                ret = self.check_layer_checksum(layer, filename)
+                self._record_layer(layer, filename, start, True)
+                return ret
+            except ValueError:
+                # there was a checksum mismatch, nuke the file
+                os.unlink(filename)
+
+        last_error = None
+        for url in ENDPOINT_STATS.rank(self.endpoint_order, by_latency=True):
+            self._use_endpoint(url)
+            try:
+                ret = self._fetch_layer(layer, cachedir, filename)
+                self._record_layer(layer, filename, start, False)
+                return ret
+            except (EndpointError, socket.error, httplib.HTTPException) \
+                    as err:
+                self._endpoint_failed(url, err)
+                last_error = err
+        if getattr(last_error, 'status', None) is not None:
+            print 'ERROR: Getting layer recieved status: %d' % \
+                last_error.status
+            return False
+        raise last_error
+
+    def _record_layer(self, layer, filename, start, cached):
+        """Note the size of a layer and the time taken to obtain it."""
+        nbytes = 0
+        if os.path.exists(filename):
+            nbytes = os.path.getsize(filename)
+        self.layer_stats.append({
+            'digest': layer,
+            'bytes': nbytes,
+            'seconds': time() - start,
+            'cached': cached
+        })
+
+    def get_image_config(self, digest):
+        """
+        Fetch and verify the image configuration blob for a schema2 or OCI
+        manifest.  Configurations are content-addressed, so parsed copies
+        are kept in memory (and in cachedir if one was given).
+        """
+        with _CONFIG_CACHE_LOCK:
+            if digest in _CONFIG_CACHE:
+                return _CONFIG_CACHE[digest]
+
+        config = None
+        filename = None
+        if self.cachedir is not None:
+            filename = os.path.join(self.cachedir, '%s.json' % digest)
+            if os.path.exists(filename):
+                with open(filename) as config_fp:
+                    data = config_fp.read()
+                try:
+                    _verify_content_digest(data, digest)
+                    config = json.loads(data)
+                except ValueError:
+                    os.unlink(filename)
+
+        if config is None:
+            data = self._download_blob(digest)
+            config = json.loads(data)
+            if filename is not None:
+                (out_fd, out_fn) = tempfile.mkstemp('.partial', digest,
+                                                    self.cachedir)
+                with os.fdopen(out_fd, 'w') as out_fp:
+                    out_fp.write(data)
+                os.rename(out_fn, filename)
+
+        with _CONFIG_CACHE_LOCK:
+            if len(_CONFIG_CACHE) >= _CONFIG_CACHE_SIZE:
+                _CONFIG_CACHE.clear()
+            _CONFIG_CACHE[digest] = config
+        return config
+
+    def _download_blob(self, digest):
+        """Read a small blob into memory from the best endpoint."""
+        last_error = None
+        for url in ENDPOINT_STATS.rank(self.endpoint_order, by_latency=True):
+            self._use_endpoint(url)
+            try:
+                resp = self._open_blob(digest)
+                if resp is None:
+                    return None
+                data = resp.read()
+                try:
+                    _verify_content_digest(data, digest)
+                except ValueError as err:
+                    raise EndpointError(str(err))
+                return data
+            except (EndpointError, socket.error, httplib.HTTPException) \
+                    as err:
+                self._endpoint_failed(url, err)
+                last_error = err
+        raise last_error
+
+    def _open_blob(self, digest):
+        """
+        Request a blob from the current endpoint, following redirects and
+        re-authenticating as needed.  Returns the successful response.
+        """
+        path = "/v2/%s/blobs/%s" % (self.repo, digest)
         url = self.url
+        first_response = True
         while True:
             conn = _setup_http_conn(url, self.cacert)
             if conn is None:
                 return None
 
-            #headers = self._get_auth_header()
-            filename = '%s/%s.tar' % (cachedir, layer)
-
-            if os.path.exists(filename):
-                try:
-                    return self.check_layer_checksum(layer, filename)
-                except ValueError:
-                    # there was a checksum mismatch, nuke the file
-                    os.unlink(filename)
-
+            start = time()
             conn.request("GET", path, None, self.headers)
             resp1 = conn.getresponse()
+            if first_response and resp1.status < 400:
+                ENDPOINT_STATS.record_success(self.url, time() - start)
+                first_response = False
             location = resp1.getheader('location')
             if resp1.status == 200:
-                break
+                return resp1
 
             elif resp1.status == 401 and self.auth_method == 'token':
-                self.do_token_auth(resp1.getheader('WWW-Authenticate'))
+                # The token we hold was rejected, make sure the next attempt
+                # does not get the same one back from the cache
+                self.invalidate_token()
+                self.do_token_auth(resp1.getheader('WWW-Authenticate'),
+                                   creds=self.private)
+                self._get_auth_header()
                 continue
             elif location is not None:
                 url = location
@@ -507,8 +1119,17 @@ class DockerV2Handle(object):
                                    match_obj.groups()[1])
                 path = match_obj.groups()[2]
             else:
-                print 'ERROR: Getting layer recieved status: %d' % resp1.status
-                return False
+                msg = 'Getting layer recieved status: %d' % resp1.status
+                raise EndpointError(msg, resp1.status,
+                                    resp1.getheader('retry-after'))
+
+    def _fetch_layer(self, layer, cachedir, filename):
+        """
+        Download a layer from the current endpoint into cachedir.
+        """
+        resp1 = self._open_blob(layer)
+        if resp1 is None:
+            return None
         maxlen = int(resp1.getheader('content-length'))
         nread = 0
         (out_fd, out_fn) = tempfile.mkstemp('.partial', layer, cachedir)
@@ -519,13 +1140,19 @@ class DockerV2Handle(object):
             while nread < maxlen:
                 # TODO find a way to timeout a failed read
                 buff = resp1.read(readsz)
-                if buff is None:
+                if not buff:
                     break
 
                 out_fp.write(buff)
                 nread += len(buff)
             out_fp.close()
-            self.check_layer_checksum(layer, out_fn)
+            if nread < maxlen:
+                raise EndpointError('Short read on layer %s: %d/%d bytes'
+                                    % (layer, nread, maxlen))
+            try:
+                self.check_layer_checksum(layer, out_fn)
+            except ValueError as err:
+                raise EndpointError(str(err))
         except:
             os.unlink(out_fn)
             out_fp.close()
@@ -549,100 +1176,78 @@ class DockerV2Handle(object):
             raise ValueError("checksum mismatch, failure")
         return True
 
-    def extract_docker_layers(self, base_path, base_layer, cachedir='./'):
-        """Analyze files in docker layers and extract minimal set to base_path.
+    def get_layer_listings(self, base_layer, cachedir='./'):
         """
-        def filter_layer(layer_members, to_remove):
-            """Remove members and members starting with to_remove from layer"""
-            trailing = '/' if not to_remove.endswith('/') else ''
-            prefix_to_remove = to_remove + trailing
-
-            return [x for x in layer_members
-                    if (not x.name == to_remove and
-                        not x.name.startswith(prefix_to_remove))]
-
-        layer_paths = []
-        tar_file_refs = []
+        Return the digests, tarball paths and listings (see layerindex) of
+        the layers from base_layer up, eldest first, leaving out excluded
+        layers.
+        """
+        index = LayerIndex(cachedir)
+        digests = []
+        layers = []
+        listings = []
         layer = base_layer
         while layer is not None:
             if layer['fsLayer']['blobSum'] in self.excludeBlobSums:
                 layer = layer['child']
                 continue
 
-            tfname = '%s.tar' % layer['fsLayer']['blobSum']
-            tfname = os.path.join(cachedir, tfname)
-            tfp = tarfile.open(tfname, 'r:gz')
-            tar_file_refs.append(tfp)
-
-            # get directory of tar contents
-            members = tfp.getmembers()
-
-            # remove all illegal files
-            members = filter_layer(members, 'dev/')
-            members = filter_layer(members, '/')
-            members = [x for x in members if not x.name.find('..') >= 0]
-
-            # find all whiteouts
-            whiteouts = [x for x in members
-                         if x.name.find('/.wh.') >= 0 or
-                         x.name.startswith('.wh.')]
-
-            # remove the whiteout tags from this layer
-            for wh_ in whiteouts:
-                members.remove(wh_)
-
-            # remove the whiteout targets from all ancestral layers
-            for idx, ancs_layer in enumerate(layer_paths):
-                for wh_ in whiteouts:
-                    path = wh_.name.replace('/.wh.', '/')
-                    if path.startswith('.wh.'):
-                        path = path[4:]
-                    ancs_layer_iter = (x for x in ancs_layer if x.name == path)
-                    ancs_member = next(ancs_layer_iter, None)
-                    if ancs_member:
-                        ancs_layer = filter_layer(ancs_layer, path)
-                layer_paths[idx] = ancs_layer
-
-            # remove identical paths (not dirs) from all ancestral layers
-            notdirs = [x.name for x in members if not x.isdir()]
-            for idx, ancs_layer in enumerate(layer_paths):
-                ancs_layer = [x for x in ancs_layer if x.name not in notdirs]
-                layer_paths[idx] = ancs_layer
-
-            # push this layer into the collection
-            layer_paths.append(members)
-
+            digest = layer['fsLayer']['blobSum']
+            tfname = os.path.join(cachedir, '%s.tar' % digest)
+            digests.append(digest)
+            layers.append(tfname)
+            listings.append(index.lookup(digest, tfname))
             layer = layer['child']
+        return (digests, layers, listings)
+
+    def extract_docker_layers(self, base_path, base_layer, cachedir='./',
+                              first=0, last=None):
+        """Analyze files in docker layers and extract minimal set to base_path.
+
+        The merge plan is built from the layer index, so layers that have
+        been indexed by an earlier pull are not decompressed to plan this
+        one.  Layers that contribute nothing to the final tree are skipped.
+        first and last select a slice of the layers (eldest first) to merge
+        instead of all of them.
+        """
+        start = time()
+        (_, layers, listings) = self.get_layer_listings(base_layer, cachedir)
+        layers = layers[first:last]
+        plan = plan_extraction(listings[first:last])
+        self.timings['plan'] = time() - start
+        start = time()
 
         # extract the selected files
-        layer_idx = 0
-        layer = base_layer
-        while layer is not None:
-            if layer['fsLayer']['blobSum'] in self.excludeBlobSums:
-                layer = layer['child']
+        for (tfname, wanted) in zip(layers, plan):
+            if len(wanted) == 0:
                 continue
-
-            tfp = tar_file_refs[layer_idx]
-            members = layer_paths[layer_idx]
-            tfp.extractall(path=base_path, members=members)
+            extracted = []
+            tfp = tarfile.open(tfname, 'r:*')
+            try:
+                # Stream through the archive once, handing real members to
+                # extractall so directories and hard links are dealt with
+                # the same way as a full extraction
+                def _selected(tfp=tfp, wanted=wanted, extracted=extracted):
+                    for member in tfp:
+                        if member.name in wanted:
+                            extracted.append(member)
+                            yield member
+                tfp.extractall(path=base_path, members=_selected())
+            finally:
+                tfp.close()
             # We need to make sure everything is writeable by the user so
             # subsequent layers can do overwrites
-            for f in members:
+            for f in extracted:
                 path = base_path + '/' + f.name
                 mode = f.mode
                 if not stat.S_ISLNK(mode) and (f.mode & stat.S_IWUSR) == 0:
                     os.chmod(path, mode | stat.S_IWUSR)
 
-            layer_idx += 1
-            layer = layer['child']
-
-        for tfp in tar_file_refs:
-            tfp.close()
-
         # fix permissions on the extracted files
         cmd = ['chmod', '-R', 'a+rX,u+w', base_path]
         pfp = Popen(cmd)
         pfp.communicate()
+        self.timings['extract'] = time() - start
 
 
 # Deprecated: Just use the object above
@@ -662,23 +1267,12 @@ def pull_image(options, repo, tag, cachedir='./', expanddir='./'):
     handle = DockerV2Handle(imageident, options)
 
     manifest = handle.get_image_manifest()
-    (eldest, youngest) = _construct_image_metadata(manifest)
-    layer = eldest
-    while layer is not None:
-        handle.save_layer(layer['fsLayer']['blobSum'], cachedir)
-        layer = layer['child']
-
-    layer = eldest
-    meta = youngest
-    resp = {'id': meta['id']}
-    expandedpath = os.path.join(expanddir, str(meta['id']))
+    resp = handle.examine_manifest(manifest)
+    handle.pull_layers(manifest, cachedir)
+
+    layer = handle.get_eldest_layer()
+    expandedpath = os.path.join(expanddir, str(resp['id']))
     resp['expandedpath'] = expandedpath
-    if 'config' in meta:
-        config = meta['config']
-        if 'Env' in config:
-            resp['env'] = config['Env']
-        if 'Entrypoint' in config:
-            resp['entrypoint'] = config['Entrypoint']
 
     if not os.path.exists(expandedpath):
         os.mkdir(expandedpath)
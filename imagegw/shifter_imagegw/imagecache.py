@@ -0,0 +1,180 @@
+# Shifter, Copyright (c) 2017, The Regents of the University of California,
+# through Lawrence Berkeley National Laboratory (subject to receipt of any
+# required approvals from the U.S. Dept. of Energy).  All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#  1. Redistributions of source code must retain the above copyright notice,
+#     this list of conditions and the following disclaimer.
+#  2. Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions and the following disclaimer in the documentation
+#     and/or other materials provided with the distribution.
+#  3. Neither the name of the University of California, Lawrence Berkeley
+#     National Laboratory, U.S. Dept. of Energy nor the names of its
+#     contributors may be used to endorse or promote products derived from this
+#     software without specific prior written permission.`
+#
+# See LICENSE for full text.
+
+"""
+Cache of converted images keyed by the layers they were built from.
+
+Every stack of layers is identified by its chain digest (the digest of the
+eldest layer, folded with the digest of each layer above it).  An image
+converted from a stack is kept under that chain digest, so a later pull that
+shares a prefix of layers can start from the cached image: mksquashfs
+appends the remaining layers to a copy of it.
+
+mksquashfs can only add entries to the root directory of an existing image
+(clashing names are renamed, not merged), so layers are only appended if
+they add new top level entries and hide nothing.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+
+def chain_ids(digests):
+    """Return the chain digest of each prefix of the layer digests."""
+    chain = []
+    for digest in digests:
+        if len(chain) == 0:
+            chain.append(digest)
+        else:
+            value = hashlib.sha256('%s %s' % (chain[-1], digest))
+            chain.append('sha256:%s' % value.hexdigest())
+    return chain
+
+
+def _top_names(listing):
+    """Top level names a layer listing adds or hides."""
+    names = set()
+    for name in [x[0] for x in listing['members']] + listing['whiteouts']:
+        if name.startswith('./'):
+            name = name[2:]
+        top = name.split('/')[0]
+        if top not in ('', '.'):
+            names.add(top)
+    return names
+
+
+def appendable(base_listings, listings):
+    """
+    Return True if the layers in listings can be appended to an image of
+    the layers in base_listings: they hide nothing and only add top level
+    entries the base does not have.
+    """
+    base = set()
+    for listing in base_listings:
+        base |= _top_names(listing)
+    for listing in listings:
+        if len(listing['whiteouts']) > 0:
+            return False
+        if len(_top_names(listing) & base) > 0:
+            return False
+    return True
+
+
+class ImageCache(object):
+    """
+    Converted images of one format and converter profile, stored under
+    <cachedir>/images.  At most size images are kept; the least recently
+    used are removed first.
+    """
+
+    def __init__(self, cachedir, fmt, options=None, size=20):
+        profile = json.dumps([fmt, options], sort_keys=True)
+        key = hashlib.sha256(profile).hexdigest()[:16]
+        self.path = os.path.join(cachedir, 'images', key)
+        self.fmt = fmt
+        self.size = size
+        if not os.path.exists(self.path):
+            try:
+                os.makedirs(self.path)
+            except OSError:
+                # another worker made it
+                if not os.path.isdir(self.path):
+                    raise
+
+    def _image_path(self, chain_id):
+        return os.path.join(self.path, '%s.%s' % (chain_id.replace(':', '-'),
+                                                  self.fmt))
+
+    def get(self, chain_id):
+        """Return the path of the cached image for chain_id, or None."""
+        path = self._image_path(chain_id)
+        if not os.path.exists(path):
+            return None
+        try:
+            os.utime(path, None)
+        except OSError:
+            return None
+        return path
+
+    def put(self, chain_id, image_path):
+        """Keep a copy of image_path as the image for chain_id."""
+        path = self._image_path(chain_id)
+        (tmp_fd, tmp_path) = tempfile.mkstemp('.partial', '', self.path)
+        os.close(tmp_fd)
+        try:
+            os.unlink(tmp_path)
+            try:
+                os.link(image_path, tmp_path)
+            except OSError:
+                # a different file system
+                shutil.copyfile(image_path, tmp_path)
+            os.rename(tmp_path, path)
+        except:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+        self.prune()
+        return path
+
+    def prune(self):
+        """Remove the least recently used images beyond the cache size."""
+        images = []
+        for fname in os.listdir(self.path):
+            if fname.endswith('.partial'):
+                continue
+            fpath = os.path.join(self.path, fname)
+            try:
+                images.append((os.path.getmtime(fpath), fpath))
+            except OSError:
+                continue
+        images.sort(reverse=True)
+        for (_, fpath) in images[self.size:]:
+            try:
+                os.unlink(fpath)
+            except OSError:
+                pass
+
+    def plan(self, digests, listings):
+        """
+        Decide how to build the image of the layers with digests and
+        listings (eldest first).  Returns a dictionary with
+          chain: the chain digests of the layers
+          base: a cached image to start from, or None
+          first: the number of layers the base image covers
+          split: if not None, the number of layers to convert and cache on
+                 their own before appending the rest, so that a later pull
+                 that only changes the layers above them can reuse them
+        """
+        chain = chain_ids(digests)
+        nlayers = len(digests)
+        plan = {'chain': chain, 'base': None, 'first': 0, 'split': None}
+        for count in xrange(nlayers, 0, -1):
+            base = self.get(chain[count - 1])
+            if base is None:
+                continue
+            if count == nlayers or \
+                    appendable(listings[:count], listings[count:]):
+                plan['base'] = base
+                plan['first'] = count
+                return plan
+        if nlayers > 1 and appendable(listings[:-1], listings[-1:]):
+            plan['split'] = nlayers - 1
+        return plan
@@ -28,14 +28,63 @@ import json
 import sys
 import os
 import logging
+import binascii
+import hashlib
+import hmac
+import socket
+import threading
+import urllib2
+from datetime import datetime, timedelta
 from time import time, sleep
-from pymongo import MongoClient
+from pymongo import MongoClient, ReturnDocument
 import pymongo.errors
 from shifter_imagegw.auth import Authentication
-from shifter_imagegw.imageworker import dopull, initqueue, doexpire
+from shifter_imagegw.imageworker import dopull, initqueue, doexpire, \
+    doexpire_batch, staged_pull
+from shifter_imagegw.metrics import Counter, Gauge, Histogram, \
+    DURATION_BUCKETS
 import bson
 import celery
 
+MONGO_LATENCY = Histogram('shifter_imagegw_mongo_seconds',
+                          'Latency of Mongo operations', ['operation'])
+PULL_STAGE_SECONDS = Histogram('shifter_imagegw_pull_stage_seconds',
+                               'Time spent in each stage of completed pulls',
+                               ['system', 'stage'], buckets=DURATION_BUCKETS)
+PULLS = Counter('shifter_imagegw_pulls_total', 'Finished pull tasks',
+                ['system', 'status'])
+LOOKUPS = Counter('shifter_imagegw_lookups_total',
+                  'Image lookups by whether a READY image was found',
+                  ['system', 'result'])
+LAYERS = Counter('shifter_imagegw_layers_total',
+                 'Layers used by completed pulls by layer cache result',
+                 ['system', 'cache'])
+PULL_BYTES = Counter('shifter_imagegw_pull_bytes_total',
+                     'Bytes downloaded from registries and transferred to '
+                     'systems by completed pulls', ['system', 'direction'])
+CALLBACKS = Counter('shifter_imagegw_callbacks_total',
+                    'Pull completion callbacks by delivery result',
+                    ['result'])
+QUEUE_DEPTH = Gauge('shifter_imagegw_queue_depth',
+                    'Images that are not READY', ['system'])
+TASKS_INFLIGHT = Gauge('shifter_imagegw_tasks_inflight',
+                       'Celery tasks tracked by this process')
+EVICTIONS = Counter('shifter_imagegw_evictions_total',
+                    'Images removed to keep a system within its retention '
+                    'budget', ['system'])
+QUEUE_WAIT = Histogram('shifter_imagegw_queue_wait_seconds',
+                       'Time tasks waited for a worker by priority class',
+                       ['system', 'priority'], buckets=DURATION_BUCKETS)
+
+# Celery priorities of the classes of work, 0 is served first.  Within a
+# class each pull a user already has in flight lowers the priority of their
+# next one by a step (up to PRIORITY_SPREAD steps), so that one user's burst
+# of pulls does not hold up everyone else.
+PRIORITY_CLASSES = {'interactive': 0, 'refresh': 4, 'expiry': 8}
+PRIORITY_SPREAD = 3
+# Pull record states that no longer hold a worker
+DONE_STATES = ['READY', 'SUCCESS', 'FAILURE', 'EXPIRING', 'EXPIRED']
+
 
 # decorator function to re-attempt any mongo operation that may have failed
 # owing to AutoReconnect (e.g., mongod coming back, etc).  This may increase
@@ -43,10 +92,13 @@ import celery
 # for the insert/update functions
 def mongo_reconnect_reattempt(call):
     """Automatically re-attempt potentially failed mongo operations"""
+    operation = call.__name__.lstrip('_')
+
     def _mongo_reconnect_safe(self, *args, **kwargs):
         for _ in xrange(2):
             try:
-                return call(self, *args, **kwargs)
+                with MONGO_LATENCY.time(operation=operation):
+                    return call(self, *args, **kwargs)
             except pymongo.errors.AutoReconnect:
                 self.logger.warn("Error: mongo reconnect attmempt")
                 sleep(2)
@@ -55,6 +107,14 @@ def mongo_reconnect_reattempt(call):
     return _mongo_reconnect_safe
 
 
+class AdmissionError(OSError):
+    """
+    A pull was turned away because the user already has as many pulls in
+    flight as allowed.
+    """
+    pass
+
+
 class ImageMngr(object):
     """
     This class handles most of the backend work for the image gateway.
@@ -83,13 +143,17 @@ class ImageMngr(object):
         self.systems = []
         self.tasks = []
         self.expire_requests = dict()
+        # Batched expire tasks and the image records each one removes
+        self.expire_batches = dict()
         self.task_image_id = dict()
+        # Tasks not started yet by a worker: (system, class, queued at)
+        self.enqueued = dict()
         # Time before another pull can be attempted
         self.pullupdatetimeout = 300
-        if 'PullUpdateTime' in self.config:
+        if 'PullUpdateTimeout' in self.config:
             self.pullupdatetimeout = self.config['PullUpdateTimeout']
-        # Max amount of time to allow for a pull
-        self.pulltimeout = self.pullupdatetimeout
+        # Max amount of time a pull may wait for a worker to start it
+        self.pulltimeout = self.config.get('PullQueueTimeout', 3600)
         # This is not intended to provide security, but just
         # provide a basic check that a session object is correct
         self.magic = 'imagemngrmagic'
@@ -110,6 +174,23 @@ class ImageMngr(object):
         self.metrics = None
         if 'Metrics' in self.config and self.config['Metrics'] is True:
             self.metrics = client[db_].metrics
+        # The version counter changes whenever something lookup or list
+        # could return changes.  It lets the API answer conditional requests
+        # without reading the image records.
+        self.versions = client[db_].versions
+        # Leases let one of several processes run the periodic sweeps
+        self.locks = client[db_].locks
+        self.scheduler = None
+        self._create_indexes()
+        self.image_states = dict()
+        self.touched = dict()
+        # Long polls wait on state_changed, it is notified whenever this
+        # process records a state transition
+        self.update_lock = threading.Lock()
+        self.state_changed = threading.Condition()
+        self.maxwait = self.config.get('MaxWaitTime', 20)
+        # Completion callbacks may only go to these url prefixes
+        self.callback_prefixes = self.config.get('CallbackURLPrefixes', [])
 
         initqueue(config)
         # Initialize data structures
@@ -177,15 +258,20 @@ class ImageMngr(object):
             return True
         return False
 
-    def _resetexpire(self, ident):
-        """Reset the expire time.  (Not fully implemented)."""
-        # Change expire time for image
+    def _expiration(self):
+        """Return the expiration time for an image looked up now."""
         # TODO shore up expire-time parsing
         expire_timeout = self.config['ImageExpirationTimeout']
         (days, hours, minutes, secs) = expire_timeout.split(':')
-        expire = time() + int(secs) + 60 * (int(minutes) +
-                                            60 * (int(hours) + 24 * int(days)))
-        self._images_update({'_id': ident}, {'$set': {'expiration': expire}})
+        return time() + int(secs) + 60 * (int(minutes) +
+                                          60 * (int(hours) + 24 * int(days)))
+
+    def _resetexpire(self, ident):
+        """Reset the expire time.  (Not fully implemented)."""
+        # Change expire time for image
+        expire = self._expiration()
+        self._images_update({'_id': ident}, {'$set': {'expiration': expire,
+                                                      'last_lookup': time()}})
         return expire
 
     def _make_acl(self, acllist, id):
@@ -291,6 +377,8 @@ class ImageMngr(object):
         }
         self.update_states()
         rec = self._images_find_one(query)
+        LOOKUPS.inc(system=image['system'],
+                    result='miss' if rec is None else 'hit')
         if rec is not None:
             if self._checkread(session, rec) is False:
                 return None
@@ -300,41 +388,179 @@ class ImageMngr(object):
             self._add_metrics(session, image, rec)
         return rec
 
-    def imglist(self, session, system):
+    def lookup_batch(self, session, system, itype, tags):
         """
-        list images for a system.
-        Image is dictionary with system defined.
+        Lookup several images of one type with a single query.
+        Returns a dictionary mapping each requested tag to its record, or
+        None if there is no READY image the session may read.
+        """
+        if not self.check_session(session, system):
+            raise OSError("Invalid Session")
+        query = {
+            'status': 'READY',
+            'system': system,
+            'itype': itype,
+            'tag': {'$in': list(tags)}
+        }
+        self.update_states()
+        resp = dict((tag, None) for tag in tags)
+        for rec in self._images_find(query):
+            # Unreadable images are left alone like missing ones
+            if self._checkread(session, rec) is False:
+                continue
+            rec_tags = rec['tag']
+            if not isinstance(rec_tags, list):
+                rec_tags = [rec_tags]
+            for tag in rec_tags:
+                if tag in resp and resp[tag] is None:
+                    resp[tag] = rec
+
+        found = dict((tag, rec) for (tag, rec) in resp.items()
+                     if rec is not None)
+        for tag in tags:
+            LOOKUPS.inc(system=system,
+                        result='hit' if tag in found else 'miss')
+        ids = list(set(rec['_id'] for rec in found.values()))
+        if len(ids) > 0:
+            self._images_update({'_id': {'$in': ids}},
+                                {'$set': {'expiration': self._expiration(),
+                                          'last_lookup': time()}},
+                                multi=True)
+
+        if self.metrics is not None and len(found) > 0:
+            try:
+                self._metrics_insert([{
+                    'user': session['user'],
+                    'uid': session['uid'],
+                    'system': system,
+                    'type': itype,
+                    'tag': tag,
+                    'id': rec['id'],
+                    'time': time()
+                } for (tag, rec) in found.items()])
+            except:
+                self.logger.warn('Failed to log lookup.')
+        return resp
+
+    def _readable_query(self, session):
+        """
+        Build the Mongo equivalent of _checkread so records the session may
+        not read are never returned by the database.
+        """
+        readable = [
+            {'private': False},
+            {'userACL': None, 'groupACL': None},
+            {'userACL': {'$size': 0}, 'groupACL': {'$size': 0}},
+        ]
+        if 'uid' in session:
+            readable.append({'userACL': session['uid']})
+        if 'gid' in session:
+            readable.append({'groupACL': session['gid']})
+        return {'$or': readable}
+
+    def imglist_iter(self, session, system, limit=None, after=None,
+                     fields=None):
+        """
+        Return a cursor over the READY images for a system that the session
+        may read, in _id order.
+        limit is the maximum number of records to return.
+        after is the _id (as a string) of the last record of the previous
+        page.
+        fields is a list of fields to return (plus _id); default is all.
         """
         if not self.check_session(session, system):
             raise OSError("Invalid Session")
         if self._isasystem(system) is False:
             raise OSError("Invalid System")
         query = {'status': 'READY', 'system': system}
+        query.update(self._readable_query(session))
+        if after is not None:
+            try:
+                query['_id'] = {'$gt': bson.objectid.ObjectId(after)}
+            except bson.errors.InvalidId:
+                raise ValueError('Invalid list position %s' % after)
+        projection = None
+        if fields is not None:
+            projection = dict((field, 1) for field in fields)
         self.update_states()
-        records = self._images_find(query)
-        resp = []
-        for record in records:
-            if self._checkread(session, record):
-                resp.append(record)
-        # verify access
-        return resp
+        cursor = self._images_find(query, projection)
+        cursor = cursor.sort('_id', 1)
+        if limit is not None:
+            cursor = cursor.limit(limit)
+        return cursor
+
+    def imglist(self, session, system, limit=None, after=None, fields=None):
+        """
+        list images for a system.
+        Image is dictionary with system defined.
+        See imglist_iter for the paging and projection options.
+        """
+        return list(self.imglist_iter(session, system, limit, after, fields))
 
     def show_queue(self, session, system):
         """
         list queue for a system.
-        Image is dictionary with system defined.
+        Image is dictionary with system defined.  The user that requested
+        each pull is only listed for admins.
         """
         if not self.check_session(session, system):
             raise OSError("Invalid Session")
+        admin = 'user' in session and self._isadmin(session, system)
         query = {'status': {'$ne': 'READY'}, 'system': system}
         self.update_states()
         records = self._images_find(query)
         resp = []
+        now = time()
         for record in records:
-            resp.append({'status': record['status'],
-                        'image': record['pulltag']})
+            item = {'status': record['status'],
+                    'image': record['pulltag'],
+                    'class': record.get('pull_class', 'interactive')}
+            if admin:
+                item['user'] = record.get('user')
+            if record['status'] == 'ENQUEUED' and 'last_pull' in record:
+                item['queued'] = now - record['last_pull']
+            resp.append(item)
         return resp
 
+    def queue_waits(self, records):
+        """
+        Summarize show_queue records by class: the number of pulls waiting
+        for a worker and how long the oldest of them has waited.
+        """
+        waits = dict((name, {'waiting': 0, 'oldest': 0.0}) for name
+                     in PRIORITY_CLASSES if name != 'expiry')
+        for record in records:
+            if 'queued' not in record:
+                continue
+            wait = waits.setdefault(record['class'],
+                                    {'waiting': 0, 'oldest': 0.0})
+            wait['waiting'] += 1
+            wait['oldest'] = max(wait['oldest'], record['queued'])
+        return waits
+
+    def _user_inflight(self, system, user):
+        """ Number of pulls of user on system waiting for or on a worker. """
+        if user is None:
+            return 0
+        query = {'system': system, 'user': user,
+                 'status': {'$nin': DONE_STATES}}
+        return self._images_find(query).count()
+
+    def _pull_limit(self, system):
+        """
+        Return the number of pulls a user may have in flight on system, 0 for
+        no limit.  The platform's maxPullsPerUser overrides MaxPullsPerUser.
+        """
+        limit = self.config.get('MaxPullsPerUser', 0)
+        return self.platforms.get(system, {}).get('maxPullsPerUser', limit)
+
+    def _pull_priority(self, pull_class, inflight):
+        """
+        Return the Celery priority of a pull of pull_class by a user that
+        has inflight pulls already.
+        """
+        return PRIORITY_CLASSES[pull_class] + min(inflight, PRIORITY_SPREAD)
+
     def _isready(self, image):
         """Helper function to determine if an image is READY."""
         query = {
@@ -393,17 +619,37 @@ class ImageMngr(object):
 
         return False
 
-    def new_pull_record(self, image):
+    def _pull_key(self, request):
         """
-        Creates a new image in mongo.  If the pull already exist it removes
-        it first.
+        Key shared by all pull records of a tag on a system.  It has a
+        unique index, so only one of them can be in flight.
+        """
+        return '%s|%s|%s' % (request['system'], request['itype'],
+                             request['pulltag'])
+
+    def _pullable_query(self):
+        """ The _pullable conditions for a pull record, as a Mongo query. """
+        now = time()
+        return {
+            'status': {'$nin': ['READY', 'SUCCESS']},
+            '$or': [
+                {'status': {'$exists': False}},
+                {'status': 'EXPIRED'},
+                {'last_pull': {'$exists': False}},
+                {'status': 'FAILURE',
+                 'last_pull': {'$lt': now - self.pullupdatetimeout}},
+                {'last_heartbeat': {'$lt': now - 3600}}
+            ]
+        }
+
+    def _claim_pull(self, image, current=None):
+        """
+        Atomically claim the pull of image.  If current, the pull record in
+        flight for it, is still pullable it is taken over, otherwise a new
+        record is created unless another one appeared meanwhile.  Returns
+        the pull record and whether this call claimed it, in which case it
+        must enqueue the pull.
         """
-        # Clean out any existing records
-        for rec in self._images_find(image):
-            if rec['status'] == 'READY':
-                continue
-            else:
-                self._images_remove({'_id': rec['_id']})
         newimage = {
             'format': 'invalid',  # <ext4|squashfs|vfs>
             'arch': 'amd64',  # <amd64|...>
@@ -415,8 +661,7 @@ class ImageMngr(object):
             'userACL': [],
             'groupACL': [],
             'private': None,
-            'tag': [],
-            'status': 'INIT'
+            'tag': []
         }
         if 'DefaultImageFormat' in self.config:
             newimage['format'] = self.config['DefaultImageFormat']
@@ -424,8 +669,39 @@ class ImageMngr(object):
             if param is 'tag':
                 continue
             newimage[param] = image[param]
-        self._images_insert(newimage)
-        return newimage
+        claim = binascii.hexlify(os.urandom(8))
+        newimage.update({'status': 'ENQUEUED', 'status_message': '',
+                         'last_pull': time(), 'claim': claim,
+                         'pull_key': self._pull_key(image)})
+
+        if current is not None:
+            query = self._pullable_query()
+            query['_id'] = current['_id']
+            rec = self._images_find_one_and_update(
+                query,
+                {'$set': newimage,
+                 '$unset': {'last_heartbeat': '', 'purge_at': ''}},
+                return_document=ReturnDocument.AFTER)
+            if rec is None:
+                # Someone else claimed it first
+                rec = self._images_find_one({'_id': current['_id']})
+                return (rec or current, False)
+        else:
+            try:
+                rec = self._images_find_one_and_update(
+                    {'pull_key': newimage['pull_key']},
+                    {'$setOnInsert': newimage}, upsert=True,
+                    return_document=ReturnDocument.AFTER)
+            except pymongo.errors.DuplicateKeyError:
+                # Lost the race to insert the record
+                rec = self._images_find_one(
+                    {'pull_key': newimage['pull_key']})
+        if rec is None or rec.get('claim') != claim:
+            return (rec, False)
+        self.image_states[rec['_id']] = 'ENQUEUED'
+        self._bump_version()
+        self._notify_waiters()
+        return (rec, True)
 
     def pull(self, session, image, testmode=0):
         """
@@ -438,32 +714,47 @@ class ImageMngr(object):
             'itype': image['itype'],
             'pulltag': image['tag']
         }
+        # Platforms that are not amd64/linux select their image out of
+        # multi-platform manifest lists
+        if image['system'] in self.platforms:
+            for key in ('arch', 'os'):
+                if key in self.platforms[image['system']]:
+                    request[key] = self.platforms[image['system']][key]
         self.logger.debug('Pull called Test Mode=%d', testmode)
         #self.logger.debug(image)
         if not self.check_session(session, request['system']):
             self.logger.warn('Invalid session on system %s', request['system'])
             raise OSError("Invalid Session")
+        if 'callback' in image:
+            self.check_callback(image['callback'])
+        pull_class = image.get('class', 'interactive')
+        if pull_class not in PRIORITY_CLASSES or pull_class == 'expiry':
+            raise ValueError('Unknown pull class %s' % pull_class)
         # If a pull request exist for this tag
-        #  check to see if it is expired or a failure, if so remove it
+        #  check to see if it is expired or a failure, if so take it over
         # otherwise
         #  return the record
-        rec = None
-        # find any pull record
         self.update_states()
-        # let's lookup the active image
+        # Read the active image and any pull in flight at once
         query = {
-            'status': 'READY',
-            'system': image['system'],
-            'itype': image['itype'],
-            'tag': {'$in': [image['tag']]}
+            '$or': [
+                {'status': 'READY', 'system': image['system'],
+                 'itype': image['itype'], 'tag': {'$in': [image['tag']]}},
+                {'system': image['system'], 'itype': image['itype'],
+                 'pulltag': image['tag'],
+                 'status': {'$nin': ['READY', 'SUCCESS']}}
+            ]
         }
-        rec = self._images_find_one(query)
-        for record in self._images_find(request):
-            status = record['status']
-            if status == 'READY' or status == 'SUCCESS':
-                continue
-            rec = record
-            break
+        rec = None
+        current = None
+        for record in self._images_find(query):
+            if record['status'] == 'READY':
+                if rec is None:
+                    rec = record
+            elif current is None:
+                current = record
+        if current is not None:
+            rec = current
         inflight = False
         recent = False
         if rec is not None and rec['status'] != 'READY':
@@ -499,29 +790,159 @@ class ImageMngr(object):
             self.logger.debug("Pullable image")
             update = True
 
+        claimed = False
         if update:
-            self.logger.debug("Creating New Pull Record")
-            rec = self.new_pull_record(request)
+            user = session.get('user')
+            inflight = self._user_inflight(request['system'], user)
+            limit = self._pull_limit(request['system'])
+            if limit > 0 and inflight >= limit and \
+                    not self._isadmin(session, request['system']):
+                self.logger.warn('Pull limit reached for %s on %s', user,
+                                 request['system'])
+                raise AdmissionError('%s already has %d pulls in flight'
+                                     % (user, inflight))
+            request['user'] = user
+            request['pull_class'] = pull_class
+            self.logger.debug("Claiming Pull Record")
+            (rec, claimed) = self._claim_pull(request, current)
+
+        if claimed:
             ident = rec['_id']
             self.logger.debug("ENQUEUEING Request")
-            self.update_mongo_state(ident, 'ENQUEUED')
             request['tag'] = request['pulltag']
             request['session'] = session
-            self.logger.debug("Calling do pull with queue=%s",
-                              request['system'])
-            pullreq = dopull.apply_async([request], queue=request['system'],
-                                         kwargs={'testmode': testmode})
+            priority = self._pull_priority(pull_class, inflight)
+            if self.config.get('StagedPulls', False) and testmode == 0:
+                # fetch, convert and transfer on their own queues
+                self.logger.debug("Queueing staged pull")
+                pullreq = staged_pull(request, priority)
+            else:
+                self.logger.debug("Calling do pull with queue=%s",
+                                  request['system'])
+                pullreq = dopull.apply_async([request],
+                                             queue=request['system'],
+                                             kwargs={'testmode': testmode},
+                                             priority=priority)
 
             memo = "pull request queued s=%s t=%s" \
                 % (request['system'], request['tag'])
             self.logger.info(memo)
 
-            self.update_mongo(ident, {'last_pull': time()})
             self.task_image_id[pullreq] = ident
+            self.enqueued[pullreq] = (request['system'], pull_class, time())
             self.tasks.append(pullreq)
 
+        if rec is not None and 'callback' in image:
+            self.add_callback(rec, image['callback'])
         return rec
 
+    def get_version(self):
+        """
+        Return the current (version, secret) of the image collection.  The
+        secret is shared by all gateway processes and is used to sign
+        conditional request tags.
+        """
+        rec = self._versions_find_one({'_id': 'images'})
+        if rec is None or 'secret' not in rec:
+            secret = binascii.hexlify(os.urandom(16))
+            self._versions_update({'_id': 'images'},
+                                  {'$setOnInsert': {'version': 0}},
+                                  upsert=True)
+            # The counter may have been bumped before anyone needed a secret,
+            # the first process to set one wins
+            self._versions_update({'_id': 'images',
+                                   'secret': {'$exists': False}},
+                                  {'$set': {'secret': secret}})
+            rec = self._versions_find_one({'_id': 'images'})
+        return (rec['version'], rec['secret'])
+
+    def _bump_version(self):
+        """Note a change that lookup or list results may reflect."""
+        self._versions_update({'_id': 'images'}, {'$inc': {'version': 1}},
+                              upsert=True)
+
+    def touch(self, session, image, image_id):
+        """
+        Account a lookup that was answered without reading the image record:
+        refresh the expiration now and then and log the lookup.
+        """
+        key = (image['system'], image['itype'], image['tag'])
+        # Expiration timeouts are days, refreshing hourly is plenty
+        if time() - self.touched.get(key, 0) > 3600:
+            query = {
+                'status': 'READY',
+                'system': image['system'],
+                'itype': image['itype'],
+                'tag': {'$in': [image['tag']]}
+            }
+            self._images_update(query,
+                                {'$set': {'expiration': self._expiration(),
+                                          'last_lookup': time()}})
+            self.touched[key] = time()
+        LOOKUPS.inc(system=image['system'], result='hit')
+        if self.metrics is not None:
+            self._add_metrics(session, image, {'id': image_id})
+
+    def _sign(self, secret, *parts):
+        """Keyed hash of parts."""
+        msg = '\0'.join(str(x) for x in parts)
+        return hmac.new(str(secret), msg, hashlib.sha1).hexdigest()[:16]
+
+    def lookup_etag(self, session, image, rec):
+        """
+        Return the entity tag for a lookup of image that returned rec.
+
+        The tag is "<version>-<id>-<record hash>-<signature>".  The record
+        hash covers the fields a lookup response depends on; the signature
+        binds the tag to the collection version and the requesting identity
+        so a later request can be answered without reading the record.
+        """
+        (version, secret) = self.get_version()
+        rhash = hashlib.sha1(json.dumps([
+            rec.get('id'), rec.get('last_pull'), rec.get('userACL'),
+            rec.get('groupACL'), rec.get('private'), rec.get('status'),
+            rec.get('tag')], sort_keys=True, default=str)).hexdigest()[:16]
+        sig = self._sign(secret, version, rec.get('id'), rhash,
+                         image['system'], image['itype'], image['tag'],
+                         session.get('uid'), session.get('gid'))
+        return '"%d-%s-%s-%s"' % (version, rec.get('id'), rhash, sig)
+
+    def lookup_unchanged(self, session, image, etag):
+        """
+        Check an entity tag from a previous lookup of image.  If nothing has
+        changed since it was issued the lookup is accounted for as usual and
+        True is returned, otherwise False.  The image record is not read.
+        """
+        if not self.check_session(session, image['system']):
+            raise OSError("Invalid Session")
+        try:
+            (version, image_id, rhash, sig) = etag.strip('"').split('-')
+            version = int(version)
+        except ValueError:
+            return False
+        self.update_states()
+        (current, secret) = self.get_version()
+        if version != current:
+            return False
+        expected = self._sign(secret, version, image_id, rhash,
+                              image['system'], image['itype'], image['tag'],
+                              session.get('uid'), session.get('gid'))
+        if not hmac.compare_digest(str(sig), expected):
+            return False
+        self.touch(session, image, image_id)
+        return True
+
+    def list_etag(self, session, system, *args):
+        """
+        Return the entity tag for a listing of system with the query
+        arguments args.  It changes whenever the collection version does.
+        """
+        (version, secret) = self.get_version()
+        return '"%d-%s"' % (version,
+                            self._sign(secret, version, system,
+                                       session.get('uid'),
+                                       session.get('gid'), *args))
+
     def update_mongo_state(self, ident, state, info=None):
         """
         Helper function to set the mongo state for an image with _id==ident
@@ -530,12 +951,155 @@ class ImageMngr(object):
         if state == 'SUCCESS':
             state = 'READY'
         set_list = {'status': state, 'status_message': ''}
+        update = {'$set': set_list}
+        if state == 'READY':
+            # Let the next pull of the tag claim a new record
+            update['$unset'] = {'pull_key': '', 'claim': ''}
+        if state in ('FAILURE', 'EXPIRED'):
+            # Dead records are removed by Mongo through the TTL index, a
+            # failed pull can be retried after pullupdatetimeout anyway
+            set_list['purge_at'] = datetime.utcnow() + \
+                timedelta(seconds=self.pullupdatetimeout)
         if info is not None and isinstance(info, dict):
             if 'heartbeat' in info:
                 set_list['last_heartbeat'] = info['heartbeat']
             if 'message' in info:
                 set_list['status_message'] = info['message']
-        self._images_update({'_id': ident}, {'$set': set_list})
+        self._images_update({'_id': ident}, update)
+        # Heartbeats repeat the state, only actual transitions matter
+        if self.image_states.get(ident) != state:
+            self.image_states[ident] = state
+            self._bump_version()
+            self._notify_waiters()
+
+    def _notify_waiters(self):
+        """Wake up long polls so they recheck their image."""
+        with self.state_changed:
+            self.state_changed.notify_all()
+
+    def wait(self, session, image, state=None, timeout=None):
+        """
+        Wait for the pull of an image to change state.
+        Image is dictionary with system, itype and tag defined.  Returns the
+        pull or image record as soon as its status differs from state or
+        becomes READY or FAILURE, or once timeout seconds (at most
+        MaxWaitTime) have passed.  Returns None if there is no such image or
+        the user may not read it.
+        """
+        if not self.check_session(session, image['system']):
+            raise OSError("Invalid Session")
+        if timeout is None or timeout > self.maxwait:
+            timeout = self.maxwait
+        deadline = time() + timeout
+        version = None
+        rec = None
+        while True:
+            # Another request may already be polling the tasks
+            self.update_states(blocking=False)
+            current = self.get_version()[0]
+            # The record can only have changed if the version did
+            if current != version:
+                version = current
+                rec = self._find_pull(image)
+                if rec is None:
+                    break
+                # Pulls of private images are as hidden as the images
+                if not self._checkread(session, rec):
+                    rec = None
+                    break
+                status = rec['status']
+                if status in ('READY', 'FAILURE'):
+                    break
+                if state is not None and status != state:
+                    break
+            remaining = deadline - time()
+            if remaining <= 0:
+                break
+            with self.state_changed:
+                self.state_changed.wait(min(remaining, 1.0))
+        return rec
+
+    def _find_pull(self, image):
+        """
+        Return the active pull record for an image if there is one,
+        otherwise the READY image record.
+        """
+        query = {
+            'system': image['system'],
+            'itype': image['itype'],
+            'pulltag': image['tag'],
+            'status': {'$ne': 'READY'}
+        }
+        rec = self._images_find_one(query)
+        if rec is not None:
+            return rec
+        query = {
+            'status': 'READY',
+            'system': image['system'],
+            'itype': image['itype'],
+            'tag': {'$in': [image['tag']]}
+        }
+        return self._images_find_one(query)
+
+    def check_callback(self, url):
+        """Raise ValueError unless url is an allowed callback."""
+        for prefix in self.callback_prefixes:
+            if url.startswith(prefix):
+                return
+        raise ValueError('Callback URL %s is not allowed' % url)
+
+    def add_callback(self, rec, url):
+        """
+        Call url when the pull of rec finishes.  If it is already done the
+        callback is made right away.
+        """
+        query = {'_id': rec['_id'], 'status': {'$nin': ['READY', 'FAILURE']}}
+        ret = self._images_update(query, {'$addToSet': {'callbacks': url}})
+        if ret['n'] == 0:
+            rec = self._images_find_one({'_id': rec['_id']})
+            if rec is None:
+                return
+            rec['callbacks'] = [url]
+            self._send_callbacks(rec, rec['status'], rec.get('id'))
+
+    def _claim_callbacks(self, ident):
+        """
+        Remove the callbacks from a pull record and return the record as it
+        was, so each callback is only made once.
+        """
+        return self._images_find_one_and_update(
+            {'_id': ident, 'callbacks': {'$exists': True}},
+            {'$unset': {'callbacks': ''}})
+
+    def _send_callbacks(self, rec, status, image_id=None):
+        """POST the outcome of a pull to the callbacks of rec."""
+        if rec is None or len(rec.get('callbacks', [])) == 0:
+            return
+        data = json.dumps({
+            'system': rec['system'],
+            'itype': rec['itype'],
+            'tag': rec.get('pulltag'),
+            'status': status,
+            'id': image_id,
+            'status_message': rec.get('status_message', '')
+        })
+
+        def post(url):
+            """ Make one callback, failures are only logged. """
+            try:
+                req = urllib2.Request(url, data,
+                                      {'Content-Type': 'application/json'})
+                urllib2.urlopen(req, timeout=10).close()
+                CALLBACKS.inc(result='success')
+            except Exception:
+                self.logger.warn('Callback to %s failed: %s', url,
+                                 sys.exc_value)
+                CALLBACKS.inc(result='failure')
+
+        for url in rec['callbacks']:
+            thread = threading.Thread(target=post, args=(url,))
+            thread.daemon = True
+            thread.start()
 
     def add_tag(self, ident, system, tag):
         """
@@ -544,6 +1108,7 @@ class ImageMngr(object):
         """
         # Remove the tag first
         self.remove_tag(system, tag)
+        self._bump_version()
         # see if tag isn't a list
         rec = self._images_find_one({'_id': ident})
         if rec is not None and 'tag' in rec and \
@@ -561,8 +1126,39 @@ class ImageMngr(object):
         """
         self._images_update({'system': system, 'tag': {'$in': [tag]}},
                             {'$pull': {'tag': tag}}, multi=True)
+        self._bump_version()
         return True
 
+    def update_queue_metrics(self):
+        """
+        Refresh the queue depth and in-flight task gauges.
+        """
+        depth = dict((system, 0) for system in self.systems)
+        for rec in self._images_find({'status': {'$ne': 'READY'}},
+                                     {'system': 1}):
+            system = rec.get('system')
+            depth[system] = depth.get(system, 0) + 1
+        for (system, count) in depth.items():
+            QUEUE_DEPTH.set(count, system=system)
+        TASKS_INFLIGHT.set(len(self.tasks))
+
+    def _record_pull_metrics(self, system, response):
+        """
+        Fold the timings reported by a worker for a finished pull into the
+        metrics.
+        """
+        PULLS.inc(system=system, status='success')
+        timings = response.get('timings')
+        if not isinstance(timings, dict):
+            return
+        for (stage, seconds) in timings.get('stages', {}).items():
+            PULL_STAGE_SECONDS.observe(seconds, system=system, stage=stage)
+        for layer in timings.get('layers', []):
+            LAYERS.inc(system=system,
+                       cache='hit' if layer.get('cached') else 'miss')
+        for (direction, nbytes) in timings.get('bytes', {}).items():
+            PULL_BYTES.inc(nbytes, system=system, direction=direction)
+
     def update_acls(self, ident, response):
         self.logger.debug("Update ACLs called for %s %s", ident, str(response))
         pullrec = self._images_find_one({'_id': ident})
@@ -570,6 +1166,7 @@ class ImageMngr(object):
             self.logger.error('ERROR: Missing pull request (r=%s)',
                               str(response))
             return
+        self._record_pull_metrics(pullrec['system'], response)
         #Check that this image ident doesn't already exist for this system
         rec = self._images_find_one({'id': response['id'], 'status': 'READY',
                                     'system': pullrec['system']})
@@ -603,6 +1200,7 @@ class ImageMngr(object):
         if pullrec is None:
             self.logger.warn('Missing pull request (r=%s)', str(response))
             return
+        self._record_pull_metrics(pullrec['system'], response)
         #Check that this image ident doesn't already exist for this system
         rec = self._images_find_one({'id': response['id'],
                                     'system': pullrec['system']})
@@ -615,6 +1213,9 @@ class ImageMngr(object):
             update_rec = {
                 'last_pull': time()
             }
+            for key in ('timings', 'size'):
+                if key in response:
+                    update_rec[key] = response[key]
             self.update_mongo(rec['_id'], update_rec)
 
             self._images_remove({'_id': ident})
@@ -644,7 +1245,10 @@ class ImageMngr(object):
             'last_pull': 'last_pull',
             'userACL': 'userACL',
             'groupACL': 'groupACL',
-            'private': 'private'
+            'private': 'private',
+            'timings': 'timings',
+            'profile': 'profile',
+            'size': 'size'
         }
         if 'private' in resp and resp['private'] is False:
             resp['userACL'] = []
@@ -665,6 +1269,7 @@ class ImageMngr(object):
         #     setline['last_pull'] = resp['last_pull']
 
         self._images_update({'_id': ident}, {'$set': setline})
+        self._bump_version()
 
     def get_state(self, ident):
         """
@@ -679,14 +1284,26 @@ class ImageMngr(object):
             return None
         return rec['status']
 
-    def update_states(self):
+    def update_states(self, blocking=True):
         """
         Update the states of all active transactions.
         Cleanup failed transcations after a period
+        If blocking is False and another thread is already updating, return
+        right away.
         """
+        if not self.update_lock.acquire(blocking):
+            return
+        try:
+            self._update_states()
+        finally:
+            self.update_lock.release()
+
+    def _update_states(self):
+        """ Body of update_states, called with update_lock held. """
         #logger.debug("Update_states called")
         i = 0
-        tasks = self.tasks
+        # Finished tasks are removed from self.tasks as we go
+        tasks = list(self.tasks)
 
         for req in tasks:
             state = 'PENDING'
@@ -697,6 +1314,14 @@ class ImageMngr(object):
             elif isinstance(req, bson.objectid.ObjectId):
                 self.logger.debug("Non-Async")
 
+            if req in self.enqueued and state != 'PENDING':
+                # A worker picked it up (as far as this poll can tell)
+                (system, pull_class, queued) = self.enqueued.pop(req)
+                QUEUE_WAIT.observe(time() - queued, system=system,
+                                   priority=pull_class)
+            if req in self.expire_batches:
+                self._update_expire_batch(req, state)
+                continue
             if req in self.expire_requests and state == 'SUCCESS':
                 self.expire_requests.pop(req)
                 self.tasks.remove(req)
@@ -708,76 +1333,267 @@ class ImageMngr(object):
                 continue
             elif state == "FAILURE":
                 self.logger.warn("Pull failed for %s", req)
+                rec = self._images_find_one({'_id': self.task_image_id[req]},
+                                            {'system': 1})
+                if rec is not None:
+                    PULLS.inc(system=rec['system'], status='failure')
+                # The failure is recorded below, there is nothing more to
+                # learn from the task
+                self.tasks.remove(req)
 
             self.update_mongo_state(self.task_image_id[req], state, info)
+            if state == "FAILURE":
+                self._send_callbacks(
+                    self._claim_callbacks(self.task_image_id[req]), state)
             if state == "READY" or state == "SUCCESS":
                 self.logger.debug("Completing pull request %d", i)
                 response = req.get()
                 self.logger.debug(response)
+                # The pull record may go away as it is completed
+                callbacks = self._claim_callbacks(self.task_image_id[req])
                 if 'meta_only' in response:
                     self.logger.debug('Updating ACLs')
                     self.update_acls(self.task_image_id[req], response)
                 else:
                     self.complete_pull(self.task_image_id[req], response)
                 self.logger.debug('meta=%s', str(response))
+                self._send_callbacks(callbacks, 'READY', response.get('id'))
                 # Now save the response
                 self.tasks.remove(req)
+                self._notify_waiters()
             i += 1
-        # Look for failed pulls
-        for rec in self._images_find({'status': 'FAILURE'}):
-            nextpull = self.pullupdatetimeout + rec['last_pull']
-            # It it has been a while then let's clean up
-            if time() > nextpull:
-                self._images_remove({'_id': rec['_id']})
+        # Forget the states of requests that are no longer tracked
+        for req in self.enqueued.keys():
+            if req not in self.tasks:
+                self.enqueued.pop(req)
+        active = set(self.task_image_id.get(req) for req in self.tasks)
+        for ident in self.image_states.keys():
+            if ident not in active:
+                self.image_states.pop(ident)
 
     def autoexpire(self, session, system, testmode=0):
         """Auto expire images and do cleanup"""
         # While this should be safe, let's restrict this to admins
         if not self._isadmin(session, system):
             return False
+        self.update_states()
+        return self.sweep(system)
+
+    def sweep(self, system):
+        """
+        Remove the pull records of the system that are stale, and expire
+        its READY images whose expiration has passed or that do not fit its
+        retention budget.  A pull is stale once its worker has not sent a
+        heartbeat for an hour, or if it has waited for a worker for longer
+        than the pull queue timeout.  Only the affected records are read.
+        Returns the ids of the expired images.
+        """
+        now = time()
         # Cleanup - Lookup for things stuck in non-READY state
+        self._images_remove({
+            'system': system,
+            'status': {'$nin': ['READY', 'EXPIRING']},
+            '$or': [
+                {'status': {'$in': ['FAILURE', 'EXPIRED']},
+                 'last_pull': {'$lt': now - self.pullupdatetimeout}},
+                {'last_heartbeat': {'$lt': now - 3600}},
+                {'last_heartbeat': {'$exists': False},
+                 'last_pull': {'$lt': now - self.pulltimeout}}
+            ]
+        })
+        # Look for READY images that haven't been looked up recently
+        recs = list(self._images_find({'status': 'READY', 'system': system,
+                                       'expiration': {'$lt': now}}))
+        expired = self._expire_records(system, recs,
+                                       self.config.get('ExpireBatchSize', 50))
+        return expired + self.enforce_retention(system)
+
+    def _expire_records(self, system, recs, batch_size):
+        """
+        Expire the image records recs of the system.  The image files are
+        removed by batched worker tasks, except those of images that other
+        READY records still refer to.  Returns the ids of the images whose
+        files are removed.
+        """
+        if len(recs) == 0:
+            return []
+        idents = set(rec['_id'] for rec in recs)
+        shared = set()
+        query = {'status': 'READY', 'system': system,
+                 'id': {'$in': list(set(rec.get('id') for rec in recs))}}
+        for rec in self._images_find(query, {'id': 1}):
+            if rec['_id'] not in idents:
+                shared.add(rec['id'])
+        remove = []
+        for rec in recs:
+            if 'id' not in rec or rec['id'] in shared:
+                self.update_mongo_state(rec['_id'], 'EXPIRED')
+            else:
+                remove.append(rec)
+        for start in xrange(0, len(remove), batch_size):
+            batch = remove[start:start + batch_size]
+            # Lookups should not hand out images that are being removed
+            for rec in batch:
+                self.update_mongo_state(rec['_id'], 'EXPIRING')
+            requests = dict((rec['id'], {'system': system, 'id': rec['id'],
+                                         'format': rec['format']})
+                            for rec in batch)
+            req = doexpire_batch.apply_async(
+                [requests.values()], queue=system,
+                priority=PRIORITY_CLASSES['expiry'])
+            self.logger.info("expire batch queued s=%s count=%d", system,
+                             len(requests))
+            self.expire_batches[req] = [rec['_id'] for rec in batch]
+            self.enqueued[req] = (system, 'expiry', time())
+            self.tasks.append(req)
+        return list(set(rec['id'] for rec in remove))
+
+    def _acquire_lease(self, name, duration):
+        """
+        Take or renew the named lease for duration seconds.  Returns True if
+        this process holds it.
+        """
+        owner = '%s:%d' % (socket.gethostname(), os.getpid())
+        now = time()
+        try:
+            rec = self._locks_find_one_and_update(
+                {'_id': name,
+                 '$or': [{'owner': owner}, {'until': {'$lt': now}}]},
+                {'$set': {'owner': owner, 'until': now + duration}},
+                upsert=True, return_document=ReturnDocument.AFTER)
+        except pymongo.errors.DuplicateKeyError:
+            # Another process holds the lease
+            return False
+        return rec is not None and rec['owner'] == owner
+
+    def run_scheduled(self, interval):
+        """
+        Sweep every platform if this process holds the scheduler lease.
+        Returns the ids expired on each platform, or None if another process
+        holds the lease.
+        """
+        if not self._acquire_lease('scheduler', 3 * interval):
+            return None
+        # Batches queued by earlier sweeps are tracked by this process
         self.update_states()
-        removed = []
-        for rec in self._images_find({'status': {'$ne': 'READY'},
-                                     'system': system}):
-            self.logger.debug(rec)
-            if 'last_pull' not in rec:
-                self.logger.warning('Image missing last_pull for pulltag:' +
-                                    rec['pulltag'])
-                continue
-            if time() > rec['last_pull'] + self.pulltimeout:
-                removed.append(rec['_id'])
-                self._images_remove({'_id': rec['_id']})
-
-        expired = []
-        # Look for READY images that haven't been pulled recently
-        for rec in self._images_find({'status': 'READY', 'system': system}):
-            self.logger.debug(rec)
-            if 'expiration' not in rec:
-                continue
-            elif rec['expiration'] < time():
-                self.logger.debug("expiring %s", rec['id'])
-                ident = rec.pop('_id')
-                self.expire_id(rec, ident)
-                if 'id' in rec:
-                    expired.append(rec['id'])
-                else:
-                    expired.append('unknown')
-            self.logger.debug(rec['expiration'] > time())
+        expired = {}
+        for system in self.systems:
+            expired[system] = self.sweep(system)
+            if len(expired[system]) > 0:
+                self.logger.info("Scheduled sweep expired %d images on %s",
+                                 len(expired[system]), system)
         return expired
 
-    def expire_id(self, rec, ident, testmode=0):
-        """ Helper function to expire by id """
-        memo = "Calling do expire with queue=%s id=%s TM=%d" \
-            % (rec['system'], ident, testmode)
-        self.logger.debug(memo)
+    def start_scheduler(self):
+        """
+        Sweep the platforms every SweepInterval seconds (default 300) in a
+        background thread.  Of the processes sharing the database only the
+        holder of the scheduler lease sweeps.  An interval of 0 leaves the
+        sweeps to the autoexpire API.
+        """
+        interval = self.config.get('SweepInterval', 300)
+        if interval <= 0 or self.scheduler is not None:
+            return None
 
-        req = doexpire.apply_async([rec], queue=rec['system'])
-        self.logger.info("expire request queued s=%s t=%s",
-                         rec['system'], ident)
-        self.task_image_id[req] = ident
-        self.expire_requests[req] = ident
-        self.tasks.append(req)
+        def run():
+            while True:
+                sleep(interval)
+                try:
+                    self.run_scheduled(interval)
+                except:
+                    self.logger.exception('Scheduled sweep failed')
+
+        self.scheduler = threading.Thread(target=run, name='scheduler')
+        self.scheduler.daemon = True
+        self.scheduler.start()
+        return self.scheduler
+
+    def _create_indexes(self):
+        """
+        Index the fields sweeps query by, and let Mongo remove dead records
+        once their purge_at time has passed.
+        """
+        try:
+            self.images.create_index('purge_at', expireAfterSeconds=0)
+            self.images.create_index('pull_key', unique=True, sparse=True)
+            self.images.create_index([('system', 1), ('status', 1),
+                                      ('expiration', 1)])
+        except pymongo.errors.PyMongoError as err:
+            self.logger.warn('Failed to create indexes: %s', err)
+
+    def _retention_plan(self, recs, max_bytes, min_age):
+        """
+        Pick the images to evict from a system so that the READY images in
+        recs fit in max_bytes.  Images are evicted least recently used
+        first, by their last lookup or pull.  Images used in the last
+        min_age seconds are kept, as jobs that looked them up may still be
+        queued.  Images without a recorded size (pulled before sizes were
+        kept) are kept too, since evicting them frees nothing as far as the
+        budget can tell.  Returns the records of the evicted images.
+        """
+        # Records with the same id share the image file
+        images = {}
+        for rec in recs:
+            if 'id' not in rec:
+                continue
+            image = images.setdefault(rec['id'], {'size': None, 'used': 0,
+                                                  'recs': []})
+            if 'size' in rec:
+                image['size'] = max(image['size'] or 0, rec['size'])
+            image['used'] = max(image['used'], rec.get('last_lookup', 0),
+                                rec.get('last_pull', 0))
+            image['recs'].append(rec)
+        unsized = len([x for x in images.values() if x['size'] is None])
+        if unsized > 0:
+            self.logger.warn("%d images have no recorded size and are not "
+                             "counted against the retention budget", unsized)
+        usage = sum(x['size'] for x in images.values()
+                    if x['size'] is not None)
+        evict = []
+        for image in sorted(images.values(), key=lambda x: x['used']):
+            if usage <= max_bytes or image['used'] > time() - min_age:
+                break
+            if image['size'] is None:
+                continue
+            usage -= image['size']
+            evict.extend(image['recs'])
+        if usage > max_bytes:
+            self.logger.warn("Images in use exceed the retention budget by "
+                             "%d bytes", usage - max_bytes)
+        return evict
+
+    def enforce_retention(self, system):
+        """
+        Remove the least recently used images of the system until its READY
+        images fit in the maxBytes of its retention configuration.  The
+        removals are queued in batches of batchSize images.  Returns the
+        ids of the evicted images.
+        """
+        retention = self.platforms[system].get('retention', {})
+        if 'maxBytes' not in retention:
+            return []
+        recs = list(self._images_find({'status': 'READY', 'system': system}))
+        evict = self._retention_plan(recs, retention['maxBytes'],
+                                     retention.get('minAge', 86400))
+        ids = self._expire_records(system, evict,
+                                   retention.get('batchSize', 50))
+        EVICTIONS.inc(len(ids), system=system)
+        return ids
+
+    def _update_expire_batch(self, req, state):
+        """ Record the outcome of a batched expire task. """
+        if state == 'SUCCESS':
+            idents = self.expire_batches.pop(req)
+            self.tasks.remove(req)
+            for ident in idents:
+                self.update_mongo_state(ident, 'EXPIRED')
+        elif state == 'FAILURE':
+            self.logger.warn("Expire batch failed for %s", req)
+            idents = self.expire_batches.pop(req)
+            self.tasks.remove(req)
+            # The images may still be there, let them be evicted again
+            for ident in idents:
+                self.update_mongo_state(ident, 'READY')
 
     def expire(self, session, image, testmode=0):
         """Expire an image.  (Not Implemented)"""
@@ -797,7 +1613,8 @@ class ImageMngr(object):
         self.logger.debug(memo)
 
         req = doexpire.apply_async([rec], queue=image['system'],
-                                   kwargs={'testmode': testmode})
+                                   kwargs={'testmode': testmode},
+                                   priority=PRIORITY_CLASSES['expiry'])
 
         memo = "expire request queued s=%s t=%s" \
             % (image['system'], image['tag'])
@@ -805,14 +1622,27 @@ class ImageMngr(object):
 
         self.task_image_id[req] = ident
         self.expire_requests[req] = ident
+        self.enqueued[req] = (image['system'], 'expiry', time())
         self.tasks.append(req)
 
         return True
 
+    @mongo_reconnect_reattempt
+    def _images_find_one_and_update(self, *args, **kwargs):
+        """ Decorated function to atomically update and return an image """
+        return self.images.find_one_and_update(*args, **kwargs)
+
+    @mongo_reconnect_reattempt
+    def _locks_find_one_and_update(self, *args, **kwargs):
+        """ Decorated function to take a lease """
+        return self.locks.find_one_and_update(*args, **kwargs)
+
     @mongo_reconnect_reattempt
     def _images_remove(self, *args, **kwargs):
         """ Decorated function to remove images from mongo """
-        return self.images.remove(*args, **kwargs)
+        ret = self.images.remove(*args, **kwargs)
+        self._bump_version()
+        return ret
 
     @mongo_reconnect_reattempt
     def _images_update(self, *args, **kwargs):
@@ -834,6 +1664,16 @@ class ImageMngr(object):
         """ Decorated function to insert an image in mongo """
         return self.images.insert(*args, **kwargs)
 
+    @mongo_reconnect_reattempt
+    def _versions_find_one(self, *args, **kwargs):
+        """ Decorated function to read the version counter """
+        return self.versions.find_one(*args, **kwargs)
+
+    @mongo_reconnect_reattempt
+    def _versions_update(self, *args, **kwargs):
+        """ Decorated function to update the version counter """
+        return self.versions.update(*args, **kwargs)
+
     @mongo_reconnect_reattempt
     def _metrics_insert(self, *args, **kwargs):
         """ Decorated function to insert an image in mongo """
@@ -26,15 +26,24 @@ import shutil
 import sys
 import subprocess
 import logging
+import multiprocessing
 import tempfile
 from time import time, sleep
 from random import randint
-from celery import Celery
+from celery import Celery, chain
+from celery.utils import uuid
 from shifter_imagegw import CONFIG_PATH, dockerv2, converters, transfer
+from shifter_imagegw.imagecache import ImageCache
+from shifter_imagegw.inventory import Inventory
+from shifter_imagegw.slots import Slots
 
 
 QUEUE = None
 CONFIG = None
+# Inventories of the image directories of remote platforms, by platform
+INVENTORIES = {}
+# Network and CPU slots shared by the workers on this host, by kind
+SLOTS = {}
 
 if 'GWCONFIG' in os.environ:
     CONFIGFILE = os.environ['GWCONFIG']
@@ -54,12 +63,25 @@ if 'ExpandDirectory' in CONFIG:
         os.mkdir(CONFIG['ExpandDirectory'])
 
 
-# Create Celery Queue and configure serializer
-#
-QUEUE = Celery('tasks', backend=CONFIG['Broker'], broker=CONFIG['Broker'])
-QUEUE.conf.update(CELERY_ACCEPT_CONTENT=['json'])
-QUEUE.conf.update(CELERY_TASK_SERIALIZER='json')
-QUEUE.conf.update(CELERY_RESULT_SERIALIZER='json')
+def _create_queue(config):
+    """
+    Create the Celery Queue and configure the serializer and the number of
+    pulls a worker runs at once (WorkerThreads).
+    """
+    queue = Celery('tasks', backend=config['Broker'], broker=config['Broker'])
+    queue.conf.update(CELERY_ACCEPT_CONTENT=['json'])
+    queue.conf.update(CELERY_TASK_SERIALIZER='json')
+    queue.conf.update(CELERY_RESULT_SERIALIZER='json')
+    # Serve each priority (0-9, 0 first) from its own list in redis
+    queue.conf.update(BROKER_TRANSPORT_OPTIONS={
+        'priority_steps': list(range(10))})
+    if 'WorkerThreads' in config:
+        queue.conf.update(CELERYD_CONCURRENCY=config['WorkerThreads'])
+        # Pulls are long, don't hold tasks another worker could start
+        queue.conf.update(CELERYD_PREFETCH_MULTIPLIER=1)
+    return queue
+
+QUEUE = _create_queue(CONFIG)
 
 
 class Updater(object):
@@ -79,6 +101,67 @@ class Updater(object):
 DEFAULT_UPDATER = Updater(None)
 
 
+class StageTimer(object):
+    """
+    Helper class to record how long each stage of a pull takes.  The report
+    is stored with the image record so slow pulls can be diagnosed.
+    """
+    def __init__(self):
+        self.start = time()
+        self.stages = {}
+        self.layers = []
+        self.bytes = {}
+        self.transfers = []
+
+    def add(self, stage, seconds):
+        """ add seconds to the time spent in stage """
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def add_bytes(self, direction, nbytes):
+        """ add nbytes to the bytes moved in direction """
+        self.bytes[direction] = self.bytes.get(direction, 0) + nbytes
+
+    def timed(self, stage, func, *args, **kwargs):
+        """ call func and account its run time to stage """
+        start = time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.add(stage, time() - start)
+
+    def report(self):
+        """
+        return the stage times (seconds), bytes, layer and transfer
+        statistics
+        """
+        stages = dict(self.stages)
+        stages['total'] = time() - self.start
+        return {'stages': stages, 'layers': self.layers,
+                'bytes': dict(self.bytes), 'transfers': self.transfers}
+
+    @classmethod
+    def resume(cls, report, handed_off=None):
+        """
+        Continue timing a pull from the report of its previous stage.  The
+        time since handed_off, when that stage finished, is counted as
+        queued.
+        """
+        timer = cls()
+        if report is None:
+            return timer
+        timer.stages = dict(report['stages'])
+        total = timer.stages.pop('total', 0.0)
+        timer.layers = list(report['layers'])
+        timer.bytes = dict(report['bytes'])
+        timer.transfers = list(report['transfers'])
+        queued = 0.0
+        if handed_off is not None:
+            queued = max(0.0, time() - handed_off)
+            timer.add('queued', queued)
+        timer.start = time() - total - queued
+        return timer
+
+
 def initqueue(newconfig):
     """
     This is mainly used by the manager to configure the broker
@@ -86,10 +169,9 @@ def initqueue(newconfig):
     """
     global CONFIG, QUEUE
     CONFIG = newconfig
-    QUEUE = Celery('tasks', backend=CONFIG['Broker'], broker=CONFIG['Broker'])
-    QUEUE.conf.update(CELERY_ACCEPT_CONTENT=['json'])
-    QUEUE.conf.update(CELERY_TASK_SERIALIZER='json')
-    QUEUE.conf.update(CELERY_RESULT_SERIALIZER='json')
+    INVENTORIES.clear()
+    SLOTS.clear()
+    QUEUE = _create_queue(CONFIG)
 
 
 def _get_cacert(location):
@@ -107,53 +189,111 @@ def _get_cacert(location):
     return cacert
 
 
-def _pull_dockerv2(request, location, repo, tag, updater):
-    """ Private method to pull a docker images. """
+def _docker_handle(request, location, repo, tag, updater):
+    """ Private method to create the handle to pull a docker image with. """
     cdir = CONFIG['CacheDirectory']
-    edir = CONFIG['ExpandDirectory']
     params = CONFIG['Locations'][location]
     cacert = _get_cacert(location)
 
     url = 'https://%s' % location
     if 'url' in params:
         url = params['url']
+    options = {}
+    if cacert is not None:
+        options['cacert'] = cacert
+    options['baseUrl'] = url
+    if 'mirrors' in params:
+        options['mirrors'] = params['mirrors']
+    options['cachedir'] = cdir
+    for key in ('arch', 'os'):
+        if key in request:
+            options[key] = request[key]
+    if 'authMethod' in params:
+        options['authMethod'] = params['authMethod']
+    options['downloadThreads'] = CONFIG.get('LayerDownloadThreads', 4)
+
+    if ('session' in request and 'tokens' in request['session'] and
+            request['session']['tokens']):
+        if location in request['session']['tokens']:
+            userpass = request['session']['tokens'][location]
+            options['username'] = userpass.split(':')[0]
+            options['password'] = ''.join(userpass.split(':')[1:])
+        elif ('default' in request['session']['tokens']):
+            userpass = request['session']['tokens']['default']
+            options['username'] = userpass.split(':')[0]
+            options['password'] = ''.join(userpass.split(':')[1:])
+    imageident = '%s:%s' % (repo, tag)
+    return dockerv2.DockerV2Handle(imageident, options, updater=updater)
+
+
+def _fetch_layers(dock, manifest, timer):
+    """ Private method to download the layers to the cache directory. """
+    with _slots('network').hold() as waited:
+        timer.add('wait_network', waited)
+        timer.timed('fetch', dock.pull_layers, manifest,
+                    CONFIG['CacheDirectory'])
+    timer.layers.extend(dock.layer_stats)
+    timer.add_bytes('downloaded', sum(x['bytes'] for x in dock.layer_stats
+                                      if not x['cached']))
+
+
+def _extract_layers(dock, request, updater, timer):
+    """ Private method to extract the layers into the expand directory. """
+    cdir = CONFIG['CacheDirectory']
+    edir = CONFIG['ExpandDirectory']
+    expandedpath = tempfile.mkdtemp(suffix='extract',
+                                    prefix=request['id'], dir=edir)
+    request['expandedpath'] = expandedpath
+
+    def extract(path, first=0, last=None):
+        """ Extract a slice of the layers and record the timings. """
+        dock.extract_docker_layers(path, dock.get_eldest_layer(),
+                                   cachedir=cdir, first=first, last=last)
+        for stage in ('plan', 'extract'):
+            timer.add(stage, dock.timings.get(stage, 0.0))
+
+    updater.update_status("PULLING", 'Extracting Layers')
+    with _slots('cpu').hold() as waited:
+        timer.add('wait_cpu', waited)
+        # Only extract the layers a cached image does not already hold
+        cache = _image_cache(request)
+        first = 0
+        if cache is not None:
+            (digests, _, listings) = \
+                dock.get_layer_listings(dock.get_eldest_layer(), cdir)
+            plan = cache.plan(digests, listings)
+            request['incremental'] = plan
+            first = plan['first']
+            if plan['split'] is not None:
+                basepath = tempfile.mkdtemp(suffix='base',
+                                            prefix=request['id'], dir=edir)
+                request['basepath'] = basepath
+                extract(basepath, last=plan['split'])
+                first = plan['split']
+        extract(expandedpath, first=first)
+
+
+def _pull_dockerv2(request, location, repo, tag, updater, timer=None):
+    """ Private method to pull a docker images. """
+    if timer is None:
+        timer = StageTimer()
+    params = CONFIG['Locations'][location]
     try:
-        options = {}
-        if cacert is not None:
-            options['cacert'] = cacert
-        options['baseUrl'] = url
-        if 'authMethod' in params:
-            options['authMethod'] = params['authMethod']
-
-        if ('session' in request and 'tokens' in request['session'] and
-                request['session']['tokens']):
-            if location in request['session']['tokens']:
-                userpass = request['session']['tokens'][location]
-                options['username'] = userpass.split(':')[0]
-                options['password'] = ''.join(userpass.split(':')[1:])
-            elif ('default' in request['session']['tokens']):
-                userpass = request['session']['tokens']['default']
-                options['username'] = userpass.split(':')[0]
-                options['password'] = ''.join(userpass.split(':')[1:])
-        imageident = '%s:%s' % (repo, tag)
-        dock = dockerv2.DockerV2Handle(imageident, options, updater=updater)
+        dock = _docker_handle(request, location, repo, tag, updater)
         updater.update_status("PULLING", 'Getting manifest')
-        manifest = dock.get_image_manifest()
-        request['meta'] = dock.examine_manifest(manifest)
+        manifest = timer.timed('manifest', dock.get_image_manifest)
+        request['meta'] = timer.timed('manifest', dock.examine_manifest,
+                                      manifest)
         request['id'] = str(request['meta']['id'])
 
         if check_image(request):
             return True
 
-        dock.pull_layers(manifest, cdir)
-
-        expandedpath = tempfile.mkdtemp(suffix='extract',
-                                        prefix=request['id'], dir=edir)
-        request['expandedpath'] = expandedpath
-
-        updater.update_status("PULLING", 'Extracting Layers')
-        dock.extract_docker_layers(expandedpath, dock.get_eldest_layer(),
-                                   cachedir=cdir)
+        _fetch_layers(dock, manifest, timer)
+        _extract_layers(dock, request, updater, timer)
+        if 'mirrors' in params:
+            logging.debug("Registry endpoint stats: %s",
+                          dockerv2.ENDPOINT_STATS.snapshot())
         return True
     except:
         logging.warn(sys.exc_value)
@@ -162,15 +302,11 @@ def _pull_dockerv2(request, location, repo, tag, updater):
     return False
 
 
-def pull_image(request, updater=DEFAULT_UPDATER):
+def _parse_tag(request):
     """
-    pull the image down and extract the contents
-
-    Returns True on success
+    Split the request's tag into the location, repository and tag.  Only
+    dockerv2 locations are supported.
     """
-    params = None
-    rtype = None
-
     # See if there is a location specified
     location = CONFIG['DefaultImageLocation']
     tag = request['tag']
@@ -186,8 +322,6 @@ def pull_image(request, updater=DEFAULT_UPDATER):
         (repo, tag) = parts
     else:
         raise OSError('Unable to parse tag %s' % request['tag'])
-    logging.debug("doing image pull for loc=%s repo=%s tag=%s", location,
-                  repo, tag)
 
     if location in CONFIG['Locations']:
         params = CONFIG['Locations'][location]
@@ -195,14 +329,25 @@ def pull_image(request, updater=DEFAULT_UPDATER):
     else:
         raise KeyError('%s not found in configuration' % location)
 
-    if rtype == 'dockerv2':
-        return _pull_dockerv2(request, location, repo, tag, updater)
-    elif rtype == 'dockerhub':
+    if rtype == 'dockerhub':
         logging.warning("Use of depcreated dockerhub type")
         raise NotImplementedError('dockerhub type is depcreated. Use dockerv2')
-    else:
+    elif rtype != 'dockerv2':
         raise NotImplementedError('Unsupported remote type %s' % rtype)
-    return False
+    return (location, repo, tag)
+
+
+def pull_image(request, updater=DEFAULT_UPDATER, timer=None):
+    """
+    pull the image down and extract the contents
+    timer is an optional StageTimer to record the stage timings in
+
+    Returns True on success
+    """
+    (location, repo, tag) = _parse_tag(request)
+    logging.debug("doing image pull for loc=%s repo=%s tag=%s", location,
+                  repo, tag)
+    return _pull_dockerv2(request, location, repo, tag, updater, timer)
 
 
 def examine_image(request):
@@ -226,27 +371,111 @@ def get_image_format(request):
     return fmt
 
 
-def convert_image(request):
+def get_converter_profile(request):
+    """
+    Return the name of the converter profile for the request's platform and
+    its options for the request's format.  The name is None if the platform
+    does not select a profile.
+    """
+    sysconf = CONFIG['Platforms'].get(request['system'], {})
+    name = sysconf.get('converterProfile')
+    if name is None:
+        return (None, None)
+    if name not in CONFIG.get('ConverterProfiles', {}):
+        raise KeyError('Converter profile %s is not defined' % name)
+    profile = CONFIG['ConverterProfiles'][name]
+    return (name, profile.get(get_image_format(request)))
+
+
+def _image_cache(request):
+    """
+    Return the ImageCache for the request's format and converter profile,
+    or None if incremental conversion is not enabled for it.
+    """
+    fmt = get_image_format(request)
+    if not CONFIG.get('IncrementalConversion', False) or fmt != 'squashfs':
+        return None
+    (_, options) = get_converter_profile(request)
+    return ImageCache(CONFIG['CacheDirectory'], fmt, options,
+                      CONFIG.get('IncrementalCacheSize', 20))
+
+
+def _inventory(system):
+    """
+    Return the Inventory of a remote platform's image directory, or None
+    for local platforms (which are checked directly) or if InventoryTTL is
+    0.
+    """
+    sysconf = CONFIG['Platforms'][system]
+    ttl = CONFIG.get('InventoryTTL', 60)
+    if sysconf['accesstype'] != 'remote' or ttl <= 0:
+        return None
+    if system not in INVENTORIES:
+        INVENTORIES[system] = Inventory(sysconf, ttl, logging)
+    return INVENTORIES[system]
+
+
+def _slots(kind):
+    """
+    Return the network or CPU Slots of this host.  NetworkSlots defaults to
+    WorkerThreads and CpuSlots to the number of CPUs, 0 means no limit.
+    """
+    if kind not in SLOTS:
+        if kind == 'network':
+            count = CONFIG.get('NetworkSlots', CONFIG.get('WorkerThreads', 0))
+        else:
+            count = CONFIG.get('CpuSlots', multiprocessing.cpu_count())
+        path = os.path.join(CONFIG['ExpandDirectory'], '.slots')
+        SLOTS[kind] = Slots(path, kind, count)
+    return SLOTS[kind]
+
+
+def convert_image(request, directory=None):
     """
     Convert the image to the required format for the target system
+    The image is written to directory, by default the ExpandDirectory.
 
     Returns True on success
     """
     fmt = get_image_format(request)
     request['format'] = fmt
 
-    edir = CONFIG['ExpandDirectory']
+    edir = directory or CONFIG['ExpandDirectory']
 
     imagefile = os.path.join(edir, '%s.%s' % (request['id'], fmt))
     request['imagefile'] = imagefile
 
-    status = converters.convert(fmt, request['expandedpath'], imagefile)
+    (name, options) = get_converter_profile(request)
+    plan = request.get('incremental')
+    base = None
+    if plan is not None:
+        cache = _image_cache(request)
+        base = plan['base']
+        if plan['split'] is not None:
+            # Convert and keep the lower layers on their own first
+            basefile = '%s.base' % imagefile
+            converters.convert(fmt, request['basepath'], basefile, options)
+            base = cache.put(plan['chain'][plan['split'] - 1], basefile)
+            os.unlink(basefile)
+        logging.info("Worker: converting %d of %d layers",
+                     len(plan['chain']) - (plan['split'] or plan['first']),
+                     len(plan['chain']))
+    status = converters.convert(fmt, request['expandedpath'], imagefile,
+                                options, base=base)
+    if status and plan is not None:
+        cache.put(plan['chain'][-1], imagefile)
+    if name is not None and 'meta' in request:
+        request['meta']['profile'] = {'name': name, 'options': options}
+    if status and 'meta' in request:
+        # Used to keep the platform's images within its retention budget
+        request['meta']['size'] = os.path.getsize(imagefile)
     return status
 
 
-def write_metadata(request):
+def write_metadata(request, directory=None):
     """
-    Write out the metadata file
+    Write out the metadata file in directory, by default the
+    ExpandDirectory.
 
     Returns True on success
     """
@@ -257,7 +486,7 @@ def write_metadata(request):
     if 'groupACL' in request:
         meta['groupACL'] = request['groupACL']
 
-    edir = CONFIG['ExpandDirectory']
+    edir = directory or CONFIG['ExpandDirectory']
 
     # initially write metadata to tempfile
     (fdesc, metafile) = tempfile.mkstemp(prefix=request['id'], suffix='meta',
@@ -290,13 +519,20 @@ def check_image(request):
     image_filename = "%s.%s" % (request['id'], fmt)
     image_metadata = "%s.meta" % (request['id'])
 
+    # Another gateway host may have removed the image since the listing, so
+    # the inventory only saves the check when it shows the image is absent
+    inventory = _inventory(system)
+    if inventory is not None:
+        if inventory.contains(image_filename, image_metadata) is False:
+            return False
     return transfer.imagevalid(sysconf, image_filename, image_metadata,
                                logging)
 
 
-def transfer_image(request, meta_only=False):
+def transfer_image(request, meta_only=False, stats=None):
     """
     Transfers the image to the target system based on the configuration.
+    A record of each file copied is added to the stats list, if given.
 
     Returns True on success
     """
@@ -307,11 +543,19 @@ def transfer_image(request, meta_only=False):
     meta = None
     if 'metafile' in request:
         meta = request['metafile']
+    image = None
     if meta_only:
         request['meta']['meta_only'] = True
-        return transfer.transfer(sysconf, None, meta, logging)
     else:
-        return transfer.transfer(sysconf, request['imagefile'], meta, logging)
+        image = request['imagefile']
+    if not transfer.transfer(sysconf, image, meta, logging, stats):
+        return False
+    inventory = _inventory(system)
+    if inventory is not None:
+        for path in (image, meta):
+            if path is not None:
+                inventory.add(os.path.basename(path), os.path.getsize(path))
+    return True
 
 
 def remove_image(request):
@@ -328,14 +572,29 @@ def remove_image(request):
     meta = request['id'] + '.meta'
     if 'metafile' in request:
         meta = request['metafile']
+    inventory = _inventory(system)
+    if inventory is not None:
+        for path in (imagefile, meta):
+            inventory.remove(os.path.basename(path))
     return transfer.remove(sysconf, imagefile, meta, logging)
 
 
-def cleanup_temporary(request):
+def _staged_directory():
+    """
+    Return the directory in the (shared) CacheDirectory where the stages of
+    staged pulls leave converted images for the transfer stage.
+    """
+    return os.path.join(CONFIG['CacheDirectory'], 'staged')
+
+
+def cleanup_temporary(request, items=None):
     """
     Helper function to cleanup any temporary files or directories.
+    items are the keys of the request to clean up, by default all of them.
     """
-    items = ('expandedpath', 'imagefile', 'metafile')
+    if items is None:
+        items = ('expandedpath', 'basepath', 'imagefile', 'metafile',
+                 'stagedir')
     for item in items:
         if item not in request or request[item] is None:
             continue
@@ -348,7 +607,8 @@ def cleanup_temporary(request):
                              (item, type(cleanitem)))
         if cleanitem == '' or cleanitem == '/':
             raise ValueError('Invalid value for %s: %s' % (item, cleanitem))
-        if not cleanitem.startswith(CONFIG['ExpandDirectory']):
+        if not cleanitem.startswith(CONFIG['ExpandDirectory']) and \
+                not cleanitem.startswith(_staged_directory() + '/'):
             raise ValueError('Invalid location for %s: %s' % (item, cleanitem))
         if os.path.exists(cleanitem):
             logging.info("Worker: removing %s", cleanitem)
@@ -363,6 +623,54 @@ def cleanup_temporary(request):
                               "clean up (%s) %s.", item, cleanitem)
 
 
+def _convert(request, updater, timer, directory=None):
+    """
+    Examine and convert the extracted image and write its metadata into
+    directory (by default the ExpandDirectory).
+    """
+    tag = request['tag']
+    updater.update_status('EXAMINATION', 'Examining image')
+    logging.debug("Worker: examining image %s" % tag)
+    if not timer.timed('examine', examine_image, request):
+        raise OSError('Examine failed')
+    updater.update_status('CONVERSION', 'Converting image')
+    logging.debug("Worker: converting image %s" % tag)
+    with _slots('cpu').hold() as waited:
+        timer.add('wait_cpu', waited)
+        if not timer.timed('convert', convert_image, request, directory):
+            raise OSError('Conversion failed')
+    if not timer.timed('metadata', write_metadata, request, directory):
+        raise OSError('Metadata creation failed')
+
+
+def _transfer(request, updater, timer):
+    """ Transfer the converted image and its metadata. """
+    updater.update_status('TRANSFER', 'Transferring image')
+    logging.debug("Worker: transferring image %s", request['tag'])
+    with _slots('network').hold() as waited:
+        timer.add('wait_network', waited)
+        if not timer.timed('transfer', transfer_image, request,
+                           stats=timer.transfers):
+            raise OSError('Transfer failed')
+    timer.add_bytes('transferred', os.path.getsize(request['imagefile']))
+
+
+def _update_metadata(request, updater, timer):
+    """
+    Write and transfer the metadata of an image that is already on the
+    target system.
+    """
+    request['format'] = get_image_format(request)
+
+    if not timer.timed('metadata', write_metadata, request):
+        raise OSError('Metadata creation failed')
+    updater.update_status('TRANSFER', 'Transferring metadata')
+    logging.debug("Worker: transferring metadata %s", request['tag'])
+    if not timer.timed('transfer', transfer_image, request,
+                       meta_only=True, stats=timer.transfers):
+        raise OSError('Transfer failed')
+
+
 def pull(request, updater, testmode=0):
     """
     Celery task to do the full workflow of pulling an image and transferring it
@@ -386,11 +694,12 @@ def pull(request, updater, testmode=0):
     elif testmode == 2:
         logging.info("Worker: testmode 2 setting failure")
         raise OSError('task failed')
+    timer = StageTimer()
     try:
         # Step 1 - Do the pull
         updater.update_status('PULLING', 'PULLING')
         logging.info(request)
-        if not pull_image(request, updater=updater):
+        if not pull_image(request, updater=updater, timer=timer):
             logging.info("Worker: Pull failed")
             raise OSError('Pull failed')
 
@@ -398,35 +707,16 @@ def pull(request, updater, testmode=0):
             raise OSError('Metadata not populated')
 
         if not check_image(request):
-            # Step 2 - Check the image
-            updater.update_status('EXAMINATION', 'Examining image')
-            logging.debug("Worker: examining image %s" % tag)
-            if not examine_image(request):
-                raise OSError('Examine failed')
-            # Step 3 - Convert
-            updater.update_status('CONVERSION', 'Converting image')
-            logging.debug("Worker: converting image %s" % tag)
-            if not convert_image(request):
-                raise OSError('Conversion failed')
-            if not write_metadata(request):
-                raise OSError('Metadata creation failed')
-            # Step 4 - TRANSFER
-            updater.update_status('TRANSFER', 'Transferring image')
-            logging.debug("Worker: transferring image %s", tag)
-            if not transfer_image(request):
-                raise OSError('Transfer failed')
+            # Step 2 - Examine and convert
+            _convert(request, updater, timer)
+            # Step 3 - TRANSFER
+            _transfer(request, updater, timer)
         else:
             logging.debug("Need to update metadata")
-            request['format'] = get_image_format(request)
-
-            if not write_metadata(request):
-                raise OSError('Metadata creation failed')
-            updater.update_status('TRANSFER', 'Transferring metadata')
-            logging.debug("Worker: transferring metadata %s", request['tag'])
-            if not transfer_image(request, meta_only=True):
-                raise OSError('Transfer failed')
+            _update_metadata(request, updater, timer)
 
         # Done
+        request['meta']['timings'] = timer.report()
         updater.update_status('READY', 'Image ready')
         cleanup_temporary(request)
         return request['meta']
@@ -442,6 +732,125 @@ def pull(request, updater, testmode=0):
         raise
 
 
+def check_stage(request, updater, timer):
+    """
+    First stage of a staged pull, on the transfer queue: get the manifest
+    and, if the image is already on the target system, only update its
+    metadata.  Otherwise the manifest is passed on to the fetch stage.
+    """
+    (location, repo, tag) = _parse_tag(request)
+    dock = _docker_handle(request, location, repo, tag, updater)
+    updater.update_status('PULLING', 'Getting manifest')
+    manifest = timer.timed('manifest', dock.get_image_manifest)
+    request['meta'] = timer.timed('manifest', dock.examine_manifest,
+                                  manifest)
+    request['id'] = str(request['meta']['id'])
+    if check_image(request):
+        logging.debug("Need to update metadata")
+        _update_metadata(request, updater, timer)
+        request['done'] = True
+        cleanup_temporary(request, ('metafile',))
+        request.pop('metafile')
+    else:
+        request['manifest'] = manifest
+
+
+def fetch_stage(request, updater, timer):
+    """
+    Second stage of a staged pull, on the fetch queue: download the layers
+    into the shared CacheDirectory.
+    """
+    (location, repo, tag) = _parse_tag(request)
+    dock = _docker_handle(request, location, repo, tag, updater)
+    dock.examine_manifest(request['manifest'])
+    updater.update_status('PULLING', 'Pulling layers')
+    _fetch_layers(dock, request['manifest'], timer)
+
+
+def convert_stage(request, updater, timer):
+    """
+    Third stage of a staged pull, on the convert queue: extract the cached
+    layers and leave the converted image and its metadata in the shared
+    CacheDirectory for the transfer stage.
+    """
+    (location, repo, tag) = _parse_tag(request)
+    dock = _docker_handle(request, location, repo, tag, updater)
+    dock.examine_manifest(request['manifest'])
+    staged = _staged_directory()
+    if not os.path.exists(staged):
+        try:
+            os.makedirs(staged)
+        except OSError:
+            # another worker made it
+            if not os.path.isdir(staged):
+                raise
+    request['stagedir'] = tempfile.mkdtemp(prefix=request['id'], dir=staged)
+    _extract_layers(dock, request, updater, timer)
+    _convert(request, updater, timer, request['stagedir'])
+    cleanup_temporary(request, ('expandedpath', 'basepath'))
+
+
+def transfer_stage(request, updater, timer):
+    """
+    Last stage of a staged pull, on the transfer queue: transfer the image
+    and its metadata to the target system.
+    """
+    _transfer(request, updater, timer)
+
+
+def _run_stage(task, stage, request):
+    """
+    Run one stage of a staged pull in task.  Progress and failures are
+    reported on the pull's tracked task (the last stage) which is the one
+    the manager follows.  Returns the request for the next stage.
+    """
+    tracked = request['task_id']
+
+    def _update_state(state=None, meta=None):
+        """ Report the state on the tracked task. """
+        task.update_state(task_id=tracked, state=state, meta=meta)
+
+    updater = Updater(_update_state)
+    timer = StageTimer.resume(request.pop('timings', None),
+                              request.pop('handed_off', None))
+    logging.debug("%s system=%s tag=%s", stage.__name__, request['system'],
+                  request['tag'])
+    try:
+        if not request.get('done', False):
+            stage(request, updater, timer)
+    except Exception as err:
+        logging.error("ERROR: %s failed system=%s tag=%s", stage.__name__,
+                      request['system'], request['tag'])
+        cleanup_temporary(request)
+        if task.request.id != tracked:
+            task.backend.mark_as_failure(tracked, err)
+        raise
+    request['timings'] = timer.report()
+    request['handed_off'] = time()
+    return request
+
+
+def staged_pull(request, priority=None):
+    """
+    Queue a pull as a chain of stage tasks: check and transfer on the
+    transfer.<system> queue, fetch and convert on the fetch and convert
+    queues.  All of them get the Celery priority, if given.  Returns the
+    AsyncResult of the last stage, which reports the progress of the whole
+    pull.
+    """
+    transfer_queue = 'transfer.%s' % request['system']
+    request['task_id'] = uuid()
+    options = {}
+    if priority is not None:
+        options['priority'] = priority
+    stages = chain(docheck.s(request).set(queue=transfer_queue, **options),
+                   dofetch.s().set(queue='fetch', **options),
+                   doconvert.s().set(queue='convert', **options),
+                   dotransfer.s().set(queue=transfer_queue,
+                                      task_id=request['task_id'], **options))
+    return stages.apply_async()
+
+
 @QUEUE.task(bind=True)
 def dopull(self, request, testmode=0):
     """
@@ -451,6 +860,43 @@ def dopull(self, request, testmode=0):
     return pull(request, updater, testmode=testmode)
 
 
+@QUEUE.task(bind=True)
+def docheck(self, request):
+    """
+    Celery task for the check stage of a staged pull
+    """
+    return _run_stage(self, check_stage, request)
+
+
+@QUEUE.task(bind=True)
+def dofetch(self, request):
+    """
+    Celery task for the fetch stage of a staged pull
+    """
+    return _run_stage(self, fetch_stage, request)
+
+
+@QUEUE.task(bind=True)
+def doconvert(self, request):
+    """
+    Celery task for the convert stage of a staged pull
+    """
+    return _run_stage(self, convert_stage, request)
+
+
+@QUEUE.task(bind=True)
+def dotransfer(self, request):
+    """
+    Celery task for the transfer stage of a staged pull, its result is the
+    image metadata like that of dopull
+    """
+    request = _run_stage(self, transfer_stage, request)
+    request['meta']['timings'] = request['timings']
+    Updater(self.update_state).update_status('READY', 'Image ready')
+    cleanup_temporary(request)
+    return request['meta']
+
+
 @QUEUE.task(bind=True)
 def doexpire(self, request, testmode=0):
     """
@@ -473,6 +919,32 @@ def doexpire(self, request, testmode=0):
         raise
 
 
+@QUEUE.task(bind=True)
+def doexpire_batch(self, requests, testmode=0):
+    """
+    Celery task to remove several images of one system with one command
+    """
+    system = requests[0]['system']
+    logging.debug("do expire batch system=%s count=%d TM=%d", system,
+                  len(requests), testmode)
+    if system not in CONFIG['Platforms']:
+        raise KeyError('%s is not in the configuration' % system)
+    sysconf = CONFIG['Platforms'][system]
+    self.update_state(state='EXPIRING')
+    files = []
+    for request in requests:
+        files.append('%s.%s' % (request['id'], request['format']))
+        files.append('%s.meta' % request['id'])
+    inventory = _inventory(system)
+    if inventory is not None:
+        for fname in files:
+            inventory.remove(fname)
+    if not transfer.remove_files(files, sysconf, logging):
+        logging.error("ERROR: doexpire_batch failed system=%s", system)
+        raise OSError('Expire failed')
+    return [request['id'] for request in requests]
+
+
 @QUEUE.task(bind=True)
 def doimagevalid(self, request, testmode=0):
     """
@@ -0,0 +1,85 @@
+# Shifter, Copyright (c) 2017, The Regents of the University of California,
+# through Lawrence Berkeley National Laboratory (subject to receipt of any
+# required approvals from the U.S. Dept. of Energy).  All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#  1. Redistributions of source code must retain the above copyright notice,
+#     this list of conditions and the following disclaimer.
+#  2. Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions and the following disclaimer in the documentation
+#     and/or other materials provided with the distribution.
+#  3. Neither the name of the University of California, Lawrence Berkeley
+#     National Laboratory, U.S. Dept. of Energy nor the names of its
+#     contributors may be used to endorse or promote products derived from this
+#     software without specific prior written permission.`
+#
+# See LICENSE for full text.
+
+"""
+Worker side record of the files in a platform's image directory.
+
+Checking whether an image is on a remote platform takes an ssh round trip
+per file.  An Inventory lists the image directory with one command, keeps
+the listing for ttl seconds, and is updated as the worker transfers and
+removes files, so most checks are answered without contacting the platform.
+"""
+
+import threading
+from time import time
+from shifter_imagegw import transfer
+
+
+class Inventory(object):
+    """
+    Names, sizes and modification times of the files in the image directory
+    of one platform.
+    """
+
+    def __init__(self, system, ttl=60, logger=None):
+        self.system = system
+        self.ttl = ttl
+        self.logger = logger
+        self.files = {}
+        self.refreshed = None
+        self.lock = threading.Lock()
+
+    def stale(self):
+        """Return True if the listing is missing or older than the ttl."""
+        return self.refreshed is None or time() - self.refreshed > self.ttl
+
+    def refresh(self):
+        """
+        List the image directory again.  Returns False if it could not be
+        listed, in which case the inventory stays stale.
+        """
+        files = transfer.list_files(self.system, self.logger)
+        with self.lock:
+            if files is None:
+                self.refreshed = None
+                return False
+            self.files = files
+            self.refreshed = time()
+        return True
+
+    def contains(self, *names):
+        """
+        Return True if all the files are in the image directory, or None if
+        that is not known because the directory could not be listed.
+        """
+        if self.stale() and not self.refresh():
+            return None
+        with self.lock:
+            return all(name in self.files for name in names)
+
+    def add(self, name, size, mtime=None):
+        """Record a file that was transferred to the image directory."""
+        if mtime is None:
+            mtime = time()
+        with self.lock:
+            self.files[name] = (size, mtime)
+
+    def remove(self, name):
+        """Record a file that was removed from the image directory."""
+        with self.lock:
+            self.files.pop(name, None)
@@ -0,0 +1,172 @@
+# Shifter, Copyright (c) 2017, The Regents of the University of California,
+# through Lawrence Berkeley National Laboratory (subject to receipt of any
+# required approvals from the U.S. Dept. of Energy).  All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#  1. Redistributions of source code must retain the above copyright notice,
+#     this list of conditions and the following disclaimer.
+#  2. Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions and the following disclaimer in the documentation
+#     and/or other materials provided with the distribution.
+#  3. Neither the name of the University of California, Lawrence Berkeley
+#     National Laboratory, U.S. Dept. of Energy nor the names of its
+#     contributors may be used to endorse or promote products derived from this
+#     software without specific prior written permission.`
+#
+# See LICENSE for full text.
+
+"""
+Persistent index of the contents of docker layers.
+
+Layers are content-addressed, so the member listing and whiteouts of a layer
+never change once it has been downloaded.  The index keeps them next to the
+cached layer (<cachedir>/<digest>.index) so that the merge plan for an image
+can be built without decompressing any layer that has been seen before.
+"""
+
+import json
+import os
+import tarfile
+import tempfile
+
+INDEX_VERSION = 1
+
+
+def _is_whiteout(name):
+    """Return True if name is an AUFS-style whiteout entry."""
+    return name.find('/.wh.') >= 0 or name.startswith('.wh.')
+
+
+def _whiteout_target(name):
+    """Return the path hidden by a whiteout entry."""
+    path = name.replace('/.wh.', '/')
+    if path.startswith('.wh.'):
+        path = path[4:]
+    return path
+
+
+def _is_illegal(name):
+    """Filter out device files, absolute paths and path traversal."""
+    if name.startswith('dev/') or name.startswith('/'):
+        return True
+    return name.find('..') >= 0
+
+
+def scan_layer(tarpath):
+    """
+    Read a layer tarball and return its listing as a dictionary with
+    'members', a list of [name, isdir] pairs in archive order, and
+    'whiteouts', a list of whiteout entry names.
+    """
+    members = []
+    whiteouts = []
+    tfp = tarfile.open(tarpath, 'r:*')
+    try:
+        for member in tfp:
+            if _is_illegal(member.name):
+                continue
+            if _is_whiteout(member.name):
+                whiteouts.append(member.name)
+            else:
+                members.append([member.name, member.isdir()])
+    finally:
+        tfp.close()
+    return {'version': INDEX_VERSION, 'members': members,
+            'whiteouts': whiteouts}
+
+
+class LayerIndex(object):
+    """
+    Index of layer listings stored alongside the cached layer tarballs.
+    """
+
+    def __init__(self, cachedir):
+        self.cachedir = cachedir
+
+    def _path(self, digest):
+        return os.path.join(self.cachedir, '%s.index' % digest)
+
+    def get(self, digest):
+        """Return the stored listing for digest, or None if not indexed."""
+        path = self._path(digest)
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path) as index_fp:
+                entry = json.load(index_fp)
+        except (IOError, ValueError):
+            return None
+        if not isinstance(entry, dict) or \
+                entry.get('version') != INDEX_VERSION:
+            return None
+        return entry
+
+    def put(self, digest, entry):
+        """Atomically store the listing for digest."""
+        (out_fd, out_fn) = tempfile.mkstemp('.partial', digest, self.cachedir)
+        try:
+            with os.fdopen(out_fd, 'w') as out_fp:
+                json.dump(entry, out_fp)
+            os.rename(out_fn, self._path(digest))
+        except:
+            if os.path.exists(out_fn):
+                os.unlink(out_fn)
+            raise
+
+    def lookup(self, digest, tarpath):
+        """
+        Return the listing for digest, scanning tarpath and recording the
+        result if the layer has not been indexed yet.
+        """
+        entry = self.get(digest)
+        if entry is None:
+            entry = scan_layer(tarpath)
+            self.put(digest, entry)
+        return entry
+
+    def remove(self, digest):
+        """Drop the listing for digest."""
+        path = self._path(digest)
+        if os.path.exists(path):
+            os.unlink(path)
+
+
+def plan_extraction(listings):
+    """
+    Build the merge plan for a stack of layers.
+
+    listings is a list of layer listings (as returned by scan_layer), eldest
+    first.  Returns a list with, for each layer, the set of member names that
+    should be extracted from it: whiteouts remove the hidden paths from the
+    layers below them, and files replaced by a later layer are only taken
+    from the later layer.
+    """
+    layer_paths = []
+    for listing in listings:
+        members = listing['members']
+
+        # remove the whiteout targets from all ancestral layers
+        targets = [_whiteout_target(x) for x in listing['whiteouts']]
+        for idx, ancs_layer in enumerate(layer_paths):
+            names = set(x[0] for x in ancs_layer)
+            for path in targets:
+                if path not in names:
+                    continue
+                prefix = path if path.endswith('/') else path + '/'
+                ancs_layer = [x for x in ancs_layer
+                              if x[0] != path and
+                              not x[0].startswith(prefix)]
+                names = set(x[0] for x in ancs_layer)
+            layer_paths[idx] = ancs_layer
+
+        # remove identical paths (not dirs) from all ancestral layers
+        notdirs = set(x[0] for x in members if not x[1])
+        if len(notdirs) > 0:
+            for idx, ancs_layer in enumerate(layer_paths):
+                layer_paths[idx] = [x for x in ancs_layer
+                                    if x[0] not in notdirs]
+
+        layer_paths.append(members)
+
+    return [set(x[0] for x in layer) for layer in layer_paths]
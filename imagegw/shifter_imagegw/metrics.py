@@ -0,0 +1,221 @@
+# Shifter, Copyright (c) 2017, The Regents of the University of California,
+# through Lawrence Berkeley National Laboratory (subject to receipt of any
+# required approvals from the U.S. Dept. of Energy).  All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#  1. Redistributions of source code must retain the above copyright notice,
+#     this list of conditions and the following disclaimer.
+#  2. Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions and the following disclaimer in the documentation
+#     and/or other materials provided with the distribution.
+#  3. Neither the name of the University of California, Lawrence Berkeley
+#     National Laboratory, U.S. Dept. of Energy nor the names of its
+#     contributors may be used to endorse or promote products derived from this
+#     software without specific prior written permission.`
+#
+# See LICENSE for full text.
+
+"""
+Minimal counters, gauges and histograms rendered in the Prometheus text
+exposition format.
+
+Metrics are kept per process.  The API serves them at /metrics; workers
+report pull timings and byte counts back with their task results, which the
+manager folds into the API's metrics when a pull completes.
+"""
+
+import threading
+from time import time
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+DURATION_BUCKETS = (1.0, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0, 1800.0,
+                    3600.0)
+
+
+def _escape(value):
+    """Escape a label value."""
+    value = str(value)
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n',
+                                                                   '\\n')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = ['%s="%s"' % (name, _escape(val))
+             for (name, val) in zip(names, values)]
+    if extra is not None:
+        pairs.append('%s="%s"' % extra)
+    if len(pairs) == 0:
+        return ''
+    return '{%s}' % ','.join(pairs)
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Registry(object):
+    """
+    Collection of metrics that are rendered together.
+    """
+    def __init__(self):
+        self.metrics = []
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        """Add metric, replacing any earlier metric of the same name."""
+        with self.lock:
+            self.metrics = [x for x in self.metrics if x.name != metric.name]
+            self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """Return all metrics in the Prometheus text format."""
+        with self.lock:
+            metrics = list(self.metrics)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+class _Metric(object):
+    mtype = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+        if registry is not None:
+            registry.register(self)
+
+    def _key(self, labels):
+        if set(labels.keys()) != set(self.labelnames):
+            raise ValueError('%s expects labels %s' % (self.name,
+                                                       self.labelnames))
+        return tuple(str(labels[x]) for x in self.labelnames)
+
+    def _header(self):
+        return ['# HELP %s %s' % (self.name, self.documentation),
+                '# TYPE %s %s' % (self.name, self.mtype)]
+
+    def render(self):
+        """Return the lines for this metric."""
+        lines = self._header()
+        with self.lock:
+            items = sorted(self.values.items())
+        for (key, value) in items:
+            lines.append('%s%s %s' % (self.name,
+                                      _format_labels(self.labelnames, key),
+                                      _format_value(value)))
+        return lines
+
+
+class Counter(_Metric):
+    """A value that only goes up."""
+    mtype = 'counter'
+
+    def inc(self, amount=1, **labels):
+        """Increment the counter for labels by amount."""
+        if amount < 0:
+            raise ValueError('Counters can only be incremented')
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0.0) + amount
+
+    def get(self, **labels):
+        """Return the current value for labels."""
+        with self.lock:
+            return self.values.get(self._key(labels), 0.0)
+
+
+class Gauge(_Metric):
+    """A value that can go up and down."""
+    mtype = 'gauge'
+
+    def set(self, value, **labels):
+        """Set the gauge for labels."""
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def get(self, **labels):
+        """Return the current value for labels."""
+        with self.lock:
+            return self.values.get(self._key(labels), 0.0)
+
+
+class _Timer(object):
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+        self.start = None
+
+    def __enter__(self):
+        self.start = time()
+        return self
+
+    def __exit__(self, *args):
+        self.histogram.observe(time() - self.start, **self.labels)
+        return False
+
+
+class Histogram(_Metric):
+    """Counts of observations in cumulative buckets, plus sum and count."""
+    mtype = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(),
+                 buckets=LATENCY_BUCKETS, registry=REGISTRY):
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        super(Histogram, self).__init__(name, documentation, labelnames,
+                                        registry)
+
+    def observe(self, value, **labels):
+        """Record one observation for labels."""
+        key = self._key(labels)
+        with self.lock:
+            if key not in self.values:
+                self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+            entry = self.values[key]
+            for (idx, bound) in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][idx] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def time(self, **labels):
+        """Context manager that observes the time spent in its body."""
+        return _Timer(self, labels)
+
+    def count(self, **labels):
+        """Return the number of observations for labels."""
+        with self.lock:
+            entry = self.values.get(self._key(labels))
+        if entry is None:
+            return 0
+        return entry[2]
+
+    def render(self):
+        lines = self._header()
+        with self.lock:
+            items = sorted((key, ([x for x in val[0]], val[1], val[2]))
+                           for (key, val) in self.values.items())
+        for (key, (counts, total, count)) in items:
+            for (bound, bucket_count) in zip(self.buckets, counts):
+                labels = _format_labels(self.labelnames, key,
+                                        ('le', _format_value(bound)))
+                lines.append('%s_bucket%s %d' % (self.name, labels,
+                                                 bucket_count))
+            labels = _format_labels(self.labelnames, key)
+            lines.append('%s_sum%s %s' % (self.name, labels,
+                                          _format_value(total)))
+            lines.append('%s_count%s %d' % (self.name, labels, count))
+        return lines
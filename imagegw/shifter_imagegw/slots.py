@@ -0,0 +1,93 @@
+# Shifter, Copyright (c) 2017, The Regents of the University of California,
+# through Lawrence Berkeley National Laboratory (subject to receipt of any
+# required approvals from the U.S. Dept. of Energy).  All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#  1. Redistributions of source code must retain the above copyright notice,
+#     this list of conditions and the following disclaimer.
+#  2. Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions and the following disclaimer in the documentation
+#     and/or other materials provided with the distribution.
+#  3. Neither the name of the University of California, Lawrence Berkeley
+#     National Laboratory, U.S. Dept. of Energy nor the names of its
+#     contributors may be used to endorse or promote products derived from this
+#     software without specific prior written permission.`
+#
+# See LICENSE for full text.
+
+"""
+Limits on the stages of pulls running at once on a worker host.
+
+A worker runs up to WorkerThreads pulls at a time, more than it has cores,
+so that pulls waiting on the network do not leave the CPUs idle.  Each
+resource bound stage holds a slot while it runs: downloads and transfers a
+network slot, extraction and conversion a CPU slot.  The slots are lock
+files, so they are shared by all the worker processes on the host.
+"""
+
+import errno
+import fcntl
+import os
+import random
+from contextlib import contextmanager
+from time import time, sleep
+
+
+class Slots(object):
+    """
+    A counting semaphore of count slots shared through lock files named
+    <name>.<n>.lock under path.  A count of 0 means no limit.
+    """
+
+    def __init__(self, path, name, count, poll=0.2):
+        self.path = path
+        self.name = name
+        self.count = count
+        self.poll = poll
+        if count > 0 and not os.path.isdir(path):
+            try:
+                os.makedirs(path)
+            except OSError:
+                # another worker made it
+                if not os.path.isdir(path):
+                    raise
+
+    def _slot_path(self, index):
+        return os.path.join(self.path, '%s.%d.lock' % (self.name, index))
+
+    def _try_acquire(self):
+        """Lock a free slot and return its descriptor, or None."""
+        first = random.randint(0, self.count - 1)
+        for index in range(first, self.count) + range(0, first):
+            fdesc = os.open(self._slot_path(index), os.O_RDWR | os.O_CREAT,
+                            0644)
+            try:
+                fcntl.flock(fdesc, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError as err:
+                os.close(fdesc)
+                if err.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+                continue
+            return fdesc
+        return None
+
+    @contextmanager
+    def hold(self):
+        """
+        Wait for a free slot and hold it for the duration of the with block.
+        The seconds spent waiting are given as the target of the with.
+        """
+        start = time()
+        if self.count <= 0:
+            yield 0.0
+            return
+        fdesc = self._try_acquire()
+        while fdesc is None:
+            sleep(self.poll)
+            fdesc = self._try_acquire()
+        try:
+            yield time() - start
+        finally:
+            # closing the descriptor releases the lock
+            os.close(fdesc)
@@ -22,10 +22,35 @@ Install, remove, and manipulate files on the systems either local or remote
 
 Will use local shell/copy commands to perform needed actions if the system has
 filesystems locally available.  Uses ssh for remote access to platforms.
+Local copies are done in-process unless the platform sets inProcessCopy to
+false.  Remote copies use scp, or with transferMode "stream", ssh sessions
+that write the image with dd, optionally compressed and split into parallel
+streams.
 """
 
+import ctypes
+import errno
+import fcntl
 import os
+import pipes
+import stat
+import tempfile
+import threading
+import zlib
 from subprocess import Popen, PIPE
+from time import time
+
+# ioctl that makes the destination share the data blocks of the source
+# (reflink on btrfs and xfs)
+FICLONE = 0x40049409
+COPY_CHUNK = 8 * 1024 * 1024
+# errors that mean a kernel copy method can not be used for these files
+_UNSUPPORTED = (errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP,
+                errno.ENOTTY, errno.EBADF)
+_LIBC = None
+# streamed chunks start on a multiple of this (the dd block size)
+STREAM_ALIGN = 1024 * 1024
+DEFAULT_COMPRESS_FORMATS = ('meta', 'ext4', 'xfs')
 
 
 def _sh_cmd(system, *args):
@@ -44,7 +69,29 @@ def _cp_cmd(system, localfile, targetfile):
     return ['cp', localfile, targetfile]
 
 
-def _ssh_cmd(system, *args):
+def _ssh_options(system, shared=True):
+    """
+    Helper function for the options ssh and scp have in common.  If shared
+    is False the connection does not go through the control master.
+    """
+    sshconf = system['ssh']
+    opts = []
+    if 'key' in sshconf:
+        opts.extend(['-i', '%s' % sshconf['key']])
+    if 'controlPath' in sshconf:
+        if shared:
+            opts.extend(['-o', 'ControlMaster=auto',
+                         '-o', 'ControlPath=%s' % sshconf['controlPath'],
+                         '-o', 'ControlPersist=%s' %
+                         sshconf.get('controlPersist', 300)])
+        else:
+            opts.extend(['-o', 'ControlPath=none'])
+    if 'cipher' in sshconf:
+        opts.extend(['-c', sshconf['cipher']])
+    return opts
+
+
+def _ssh_cmd(system, *args, **kwargs):
     """
     Helper function to build a remote shell command
     """
@@ -57,8 +104,7 @@ def _ssh_cmd(system, *args):
     # also, is this guaranteed to be an iterable object?
     hostname = system['host'][0]
     username = system['ssh']['username']
-    if 'key' in system['ssh']:
-        ssh.extend(['-i', '%s' % system['ssh']['key']])
+    ssh.extend(_ssh_options(system, kwargs.get('shared', True)))
     if 'sshCmdOptions' in system['ssh']:
         ssh.extend(system['ssh']['sshCmdOptions'])
     ssh.extend(['%s@%s' % (username, hostname)])
@@ -76,8 +122,7 @@ def _scp_cmd(system, localfile, remotefile):
     # also, is this guaranteed to be an iterable object?
     hostname = system['host'][0]
     username = system['ssh']['username']
-    if 'key' in system['ssh']:
-        ssh.extend(['-i', '%s' % system['ssh']['key']])
+    ssh.extend(_ssh_options(system))
     if 'scpCmdOptions' in system['ssh']:
         ssh.extend(system['ssh']['scpCmdOptions'])
     ssh.extend([localfile, '%s@%s:%s' % (username, hostname, remotefile)])
@@ -131,21 +176,302 @@ def pre_create_tempfile(basepath, filename, sh_cmd, system, logger=None):
     return temp_fn
 
 
-def copy_file(filename, system, logger=None):
+def _libc():
+    global _LIBC
+    if _LIBC is None:
+        _LIBC = ctypes.CDLL(None, use_errno=True)
+    return _LIBC
+
+
+def _copy_file_range(src_fd, dst_fd, count):
+    # glibc only has copy_file_range since 2.27
+    func = getattr(_libc(), 'copy_file_range', None)
+    if func is None:
+        return None
+    func.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int,
+                     ctypes.c_void_p, ctypes.c_size_t, ctypes.c_uint]
+    func.restype = ctypes.c_ssize_t
+    return func(src_fd, None, dst_fd, None, count, 0)
+
+
+def _sendfile(src_fd, dst_fd, count):
+    func = getattr(_libc(), 'sendfile', None)
+    if func is None:
+        return None
+    func.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_void_p,
+                     ctypes.c_size_t]
+    func.restype = ctypes.c_ssize_t
+    return func(dst_fd, src_fd, None, count)
+
+
+def _clone(src_fd, dst_fd, size):
+    """
+    Share the data blocks of the source with the destination.  Returns
+    False if the file system can not.
+    """
+    try:
+        fcntl.ioctl(dst_fd, FICLONE, src_fd)
+    except IOError as err:
+        if err.errno in _UNSUPPORTED:
+            return False
+        raise
+    return True
+
+
+def _kernel_copy(call, src_fd, dst_fd, size):
+    """
+    Copy size bytes between the file offsets with a copy system call.
+    Returns False if the C library or the kernel does not support the call
+    for these files.
+    """
+    copied = 0
+    while copied < size:
+        ret = call(src_fd, dst_fd, min(size - copied, 1 << 30))
+        if ret is None:
+            return False
+        if ret < 0:
+            err = ctypes.get_errno()
+            if copied == 0 and err in _UNSUPPORTED:
+                return False
+            raise OSError(err, os.strerror(err))
+        if ret == 0:
+            if copied == 0:
+                return False
+            raise OSError('Short copy, %d of %d bytes' % (copied, size))
+        copied += ret
+    return True
+
+
+def _buffered_copy(src_fd, dst_fd, size):
+    """
+    Copy in large chunks, seeking over chunks of zeros so that sparse
+    images stay sparse.
+    """
+    while True:
+        buf = os.read(src_fd, COPY_CHUNK)
+        if len(buf) == 0:
+            break
+        if buf.count('\0') == len(buf):
+            os.lseek(dst_fd, len(buf), os.SEEK_CUR)
+            continue
+        view = memoryview(buf)
+        while len(view) > 0:
+            view = view[os.write(dst_fd, view):]
+    os.ftruncate(dst_fd, os.lseek(dst_fd, 0, os.SEEK_CUR))
+    return True
+
+
+def _link_copy(filename, basepath, target_fn):
     """
-    Copy a file to the specified system
+    Hard link filename to target_fn through a temporary name.  Returns
+    False if the link can not be made (e.g. different file systems).
+    """
+    image_fn = os.path.split(filename)[1]
+    (temp_fd, temp_fn) = tempfile.mkstemp('.partial', '%s.' % image_fn,
+                                          basepath)
+    os.close(temp_fd)
+    os.unlink(temp_fn)
+    try:
+        os.link(filename, temp_fn)
+    except OSError:
+        return False
+    try:
+        src_fd = os.open(filename, os.O_RDONLY)
+        try:
+            os.fsync(src_fd)
+        finally:
+            os.close(src_fd)
+        os.rename(temp_fn, target_fn)
+    except:
+        if os.path.exists(temp_fn):
+            os.unlink(temp_fn)
+        raise
+    return True
+
+
+def local_copy(filename, basepath, logger=None):
+    """
+    Copy filename into basepath without running any commands.  The data
+    is written to a temporary file that is synced and then renamed over the
+    target, as the command based copy does.  Returns the method used: a
+    hard link if both are on one file system, otherwise a reflink,
+    copy_file_range, sendfile or a buffered copy, whichever works first.
+    """
+    image_fn = os.path.split(filename)[1]
+    target_fn = os.path.join(basepath, image_fn)
+    if os.stat(filename).st_dev == os.stat(basepath).st_dev and \
+            _link_copy(filename, basepath, target_fn):
+        method = 'link'
+    else:
+        (temp_fd, temp_fn) = tempfile.mkstemp('.partial', '%s.' % image_fn,
+                                              basepath)
+        try:
+            src_fd = os.open(filename, os.O_RDONLY)
+            try:
+                size = os.fstat(src_fd).st_size
+                for (method, func, call) in (
+                        ('reflink', _clone, None),
+                        ('copy_file_range', _kernel_copy, _copy_file_range),
+                        ('sendfile', _kernel_copy, _sendfile),
+                        ('buffered', _buffered_copy, None)):
+                    if call is not None:
+                        done = func(call, src_fd, temp_fd, size)
+                    else:
+                        done = func(src_fd, temp_fd, size)
+                    if done:
+                        break
+            finally:
+                os.close(src_fd)
+            os.fsync(temp_fd)
+            os.close(temp_fd)
+            temp_fd = None
+            os.rename(temp_fn, target_fn)
+        except:
+            if temp_fd is not None:
+                os.close(temp_fd)
+            if os.path.exists(temp_fn):
+                os.unlink(temp_fn)
+            raise
+    if logger is not None:
+        logger.info("copied %s to %s (%s)" % (filename, target_fn, method))
+    return method
+
+
+def _stream_chunk(system, filename, remotefile, offset, length, level,
+                  shared, result):
+    """
+    Send length bytes of filename starting at offset to the same offset of
+    remotefile through an ssh session running dd.  If level is not None
+    the data is gzip compressed at that level.  Stores the return code and
+    the number of bytes sent in result.
+    """
+    script = 'dd of=%s bs=%d seek=%d conv=notrunc iflag=fullblock ' \
+             'status=none' % (pipes.quote(remotefile), STREAM_ALIGN,
+                              offset / STREAM_ALIGN)
+    if level is not None:
+        script = 'gzip -dc | %s' % script
+    cmd = _ssh_cmd(system, 'sh', '-c', pipes.quote(script), shared=shared)
+    result['sent'] = 0
+    result['ret'] = None
+    proc = Popen(cmd, stdin=PIPE, stderr=PIPE)
+    try:
+        compressor = None
+        if level is not None:
+            compressor = zlib.compressobj(level, zlib.DEFLATED,
+                                          16 + zlib.MAX_WBITS)
+        with open(filename, 'rb') as src:
+            src.seek(offset)
+            remaining = length
+            while remaining > 0:
+                buf = src.read(min(remaining, STREAM_ALIGN))
+                if len(buf) == 0:
+                    break
+                remaining -= len(buf)
+                if compressor is not None:
+                    buf = compressor.compress(buf)
+                proc.stdin.write(buf)
+                result['sent'] += len(buf)
+            if compressor is not None:
+                buf = compressor.flush()
+                proc.stdin.write(buf)
+                result['sent'] += len(buf)
+        proc.stdin.close()
+    except (IOError, OSError) as err:
+        # a broken pipe means the remote side failed; its status says why
+        result['error'] = str(err)
+    if not proc.stdin.closed:
+        proc.stdin.close()
+    result['stderr'] = proc.stderr.read().strip()
+    result['ret'] = proc.wait()
+
+
+def _stream_copy(system, filename, remotefile, logger=None):
+    """
+    Copy filename to remotefile over ssh sessions.  Files with a format
+    listed in compressFormats are compressed on the wire.  Files larger
+    than parallelThreshold are split over parallelStreams sessions; only
+    the first uses the control master, so each stream gets its own
+    connection (and cipher).  Returns the exit status (0 on success) and
+    the number of bytes sent.
+    """
+    sshconf = system['ssh']
+    size = os.path.getsize(filename)
+    fmt = os.path.splitext(filename)[1][1:]
+    level = None
+    if fmt in sshconf.get('compressFormats', DEFAULT_COMPRESS_FORMATS):
+        level = sshconf.get('compressionLevel', 1)
+    nstreams = 1
+    if size > sshconf.get('parallelThreshold', 256 * 1024 * 1024):
+        nstreams = max(1, int(sshconf.get('parallelStreams', 4)))
+    chunk = (size + nstreams - 1) / nstreams
+    chunk = max(STREAM_ALIGN, (chunk + STREAM_ALIGN - 1) / STREAM_ALIGN *
+                STREAM_ALIGN)
+
+    threads = []
+    results = []
+    offset = 0
+    while offset < size or len(threads) == 0:
+        result = {}
+        args = (system, filename, remotefile, offset,
+                min(chunk, size - offset), level, len(threads) == 0, result)
+        thread = threading.Thread(target=_stream_chunk, args=args)
+        thread.start()
+        threads.append(thread)
+        results.append(result)
+        offset += chunk
+    for thread in threads:
+        thread.join()
+
+    ret = 0
+    sent = 0
+    for result in results:
+        sent += result['sent']
+        if result['ret'] != 0 or 'error' in result:
+            ret = result['ret'] or 1
+            if logger is not None:
+                logger.error("stream of %s failed (%s): %s %s" %
+                             (filename, result['ret'], result.get('error', ''),
+                              result['stderr']))
+    if ret == 0:
+        # gzip failures are hidden by dd's exit status, so check the size
+        cmd = _ssh_cmd(system, 'stat', '-c', '%s', pipes.quote(remotefile))
+        proc = Popen(cmd, stdout=PIPE, stderr=PIPE)
+        (stdout, _) = proc.communicate()
+        if proc.returncode != 0 or stdout.strip() != str(size):
+            if logger is not None:
+                logger.error("stream of %s gave %s bytes, expected %d" %
+                             (filename, stdout.strip(), size))
+            ret = proc.returncode or 1
+    return (ret, sent)
+
+
+def copy_file(filename, system, logger=None, stats=None):
+    """
+    Copy a file to the specified system.  If stats is a list, a record of
+    the bytes sent, the time taken and the method used is appended to it.
     """
     sh_cmd = None
     cp_cmd = None
     basepath = None
+    start = time()
+    size = os.path.getsize(filename)
+    record = {'file': os.path.split(filename)[1], 'bytes': size,
+              'sent': size}
     if system['accesstype'] == 'local':
+        if system['local'].get('inProcessCopy', True):
+            record['method'] = local_copy(filename,
+                                          system['local']['imageDir'], logger)
+            _report(record, start, logger, stats)
+            return True
         sh_cmd = _sh_cmd
         cp_cmd = _cp_cmd
         basepath = system['local']['imageDir']
+        record['method'] = 'cp'
     elif system['accesstype'] == 'remote':
         sh_cmd = _ssh_cmd
         cp_cmd = _scp_cmd
         basepath = system['ssh']['imageDir']
+        record['method'] = system['ssh'].get('transferMode', 'scp')
     else:
         memo = '%s is not supported as a transfer type' % system['accesstype']
         raise NotImplementedError(memo)
@@ -166,8 +492,12 @@ def copy_file(filename, system, logger=None):
 
     copyret = None
     try:
-        copy = cp_cmd(system, filename, temp_fn)
-        copyret = _exec_and_log(copy, logger)
+        if record['method'] == 'stream':
+            (copyret, record['sent']) = _stream_copy(system, filename,
+                                                     temp_fn, logger)
+        else:
+            copy = cp_cmd(system, filename, temp_fn)
+            copyret = _exec_and_log(copy, logger)
     except:
         rm_cmd = sh_cmd(system, 'rm', temp_fn)
         _exec_and_log(rm_cmd, logger)
@@ -177,15 +507,32 @@ def copy_file(filename, system, logger=None):
         try:
             mv_cmd = sh_cmd(system, 'mv', temp_fn, target_fn)
             ret = _exec_and_log(mv_cmd, logger)
+            if ret == 0:
+                _report(record, start, logger, stats)
             return ret == 0
         except:
             # TODO we might also need to remove target_fn in this case
             rm_cmd = sh_cmd(system, 'rm', temp_fn)
             _exec_and_log(rm_cmd, logger)
             raise
+    rm_cmd = sh_cmd(system, 'rm', '-f', temp_fn)
+    _exec_and_log(rm_cmd, logger)
     return False
 
 
+def _report(record, start, logger, stats):
+    """ log the throughput of a finished copy and add it to stats """
+    record['seconds'] = time() - start
+    rate = record['bytes'] / max(record['seconds'], 1e-6) / 1e6
+    if logger is not None:
+        logger.info("transferred %s: %d bytes (%d sent) in %.2fs, "
+                    "%.1f MB/s (%s)" % (record['file'], record['bytes'],
+                                        record['sent'], record['seconds'],
+                                        rate, record['method']))
+    if stats is not None:
+        stats.append(record)
+
+
 def remove_file(filename, system, logger=None):
     """
     Remove the specified file from the system
@@ -205,6 +552,27 @@ def remove_file(filename, system, logger=None):
     return True
 
 
+def remove_files(filenames, system, logger=None):
+    """
+    Remove several files from the system with a single command.  Returns
+    True if they were all removed (or did not exist).
+    """
+    if system['accesstype'] == 'local':
+        sh_cmd = _sh_cmd
+        basepath = system['local']['imageDir']
+    elif system['accesstype'] == 'remote':
+        sh_cmd = _ssh_cmd
+        basepath = system['ssh']['imageDir']
+    else:
+        memo = '%s is not supported as a transfer type' % system['accesstype']
+        raise NotImplementedError(memo)
+    if len(filenames) == 0:
+        return True
+    targets = [os.path.join(basepath, os.path.split(x)[1]) for x in filenames]
+    rm_cmd = sh_cmd(system, 'rm', '-f', *targets)
+    return _exec_and_log(rm_cmd, logger) == 0
+
+
 def check_file(filename, system, logger=None):
     """
     check the validatity of a file on the system
@@ -212,8 +580,9 @@ def check_file(filename, system, logger=None):
     sh_cmd = None
     basepath = None
     if system['accesstype'] == 'local':
-        sh_cmd = _sh_cmd
         basepath = system['local']['imageDir']
+        image_fn = os.path.split(filename)[1]
+        return os.path.isfile(os.path.join(basepath, image_fn))
     elif system['accesstype'] == 'remote':
         sh_cmd = _ssh_cmd
         basepath = system['ssh']['imageDir']
@@ -227,15 +596,62 @@ def check_file(filename, system, logger=None):
     return False
 
 
-def transfer(system, image_path, metadata_path=None, logger=None):
+def list_files(system, logger=None):
+    """
+    List the image directory of the system.  Returns a dictionary of file
+    name to (size, mtime) for the complete files in it, or None if the
+    directory could not be listed.
+    """
+    files = {}
+    if system['accesstype'] == 'local':
+        basepath = system['local']['imageDir']
+        try:
+            names = os.listdir(basepath)
+        except OSError as err:
+            if logger is not None:
+                logger.error("Could not list %s: %s" % (basepath, err))
+            return None
+        for fname in names:
+            try:
+                fstat = os.stat(os.path.join(basepath, fname))
+            except OSError:
+                continue
+            if stat.S_ISREG(fstat.st_mode):
+                files[fname] = (fstat.st_size, fstat.st_mtime)
+    elif system['accesstype'] == 'remote':
+        basepath = system['ssh']['imageDir']
+        cmd = _ssh_cmd(system, 'find', pipes.quote(basepath), '-maxdepth', '1',
+                       '-type', 'f', '-printf', pipes.quote('%f %s %T@\\n'))
+        proc = Popen(cmd, stdout=PIPE, stderr=PIPE)
+        (stdout, stderr) = proc.communicate()
+        if proc.returncode != 0:
+            if logger is not None:
+                logger.error("Could not list %s: %s" % (basepath,
+                                                        stderr.strip()))
+            return None
+        for line in stdout.splitlines():
+            try:
+                (fname, size, mtime) = line.rsplit(' ', 2)
+                files[fname] = (int(size), float(mtime))
+            except ValueError:
+                continue
+    else:
+        memo = '%s is not supported as a transfer type' % system['accesstype']
+        raise NotImplementedError(memo)
+    return dict((name, val) for (name, val) in files.items()
+                if not name.endswith('.partial'))
+
+
+def transfer(system, image_path, metadata_path=None, logger=None,
+             stats=None):
     """
     transfer an image and its metadata to the system
     """
     # TODO: Catch copy_file fail here
     if metadata_path is not None:
-        copy_file(metadata_path, system, logger)
+        copy_file(metadata_path, system, logger, stats)
     # If image path is None then we are just transferring the meatfile
-    if image_path is None or copy_file(image_path, system, logger):
+    if image_path is None or copy_file(image_path, system, logger, stats):
         return True
     if logger is not None:
         logger.error("Transfer of %s failed" % image_path)
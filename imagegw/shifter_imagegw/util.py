@@ -28,6 +28,9 @@
 """
 
 import os
+import subprocess
+
+_USAGE = {}
 
 def program_exists(program):
     """
@@ -37,6 +40,23 @@ def program_exists(program):
         raise IOError('Binary %s not found or not executable.' % str(program))
     return True
 
+def program_supports(program, feature, args=('--help',)):
+    """
+    Checks if the usage text of a program (bin) mentions feature, e.g. a
+    compressor, and raises an exception if not.  The usage text is read
+    once per program and arguments.
+    """
+    program_exists(program)
+    key = (which(program), tuple(args))
+    if key not in _USAGE:
+        proc = subprocess.Popen([program] + list(args),
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT)
+        _USAGE[key] = proc.communicate()[0]
+    if feature not in _USAGE[key]:
+        raise IOError('%s does not support %s.' % (program, feature))
+    return True
+
 def which(program):
     """
     Sees if a program (bin) is executable and returns the path
@@ -17,6 +17,7 @@
 # See LICENSE for full text.
 
 import os
+import shutil
 import unittest
 from shifter_imagegw import converters
 
@@ -60,8 +61,16 @@ class ConvertersTestCase(unittest.TestCase):
         resp = converters.convert('cramfs', path, '/tmp/blah.cramfs')
         self.assertTrue(resp)
 
-        with self.assertRaises(NotImplementedError):
-            resp = converters.convert('ext4', path, '/tmp/blah.ext4')
+        resp = converters.convert('ext4', path, '/tmp/blah.ext4')
+        self.assertTrue(resp)
+        os.remove('/tmp/blah.ext4')
+
+        path = self.make_fake()
+        resp = converters.convert('xfs', path, '/tmp/blah.xfs')
+        self.assertTrue(resp)
+        os.remove('/tmp/blah.xfs')
+
+        path = self.make_fake()
 
         resp = converters.convert('squashfs', path, output)
         self.assertTrue(resp)
@@ -100,8 +109,88 @@ class ConvertersTestCase(unittest.TestCase):
         self.assertGreater(len(meta['ENV']), 0)
 
     def test_ext4(self):
-        with self.assertRaises(NotImplementedError):
-            converters.generate_ext4_image('/tmp', '/tmp')
+        path = self.make_fake()
+        os.mkdir(path + '/dir')
+        with open(path + '/dir/b', 'w') as f:
+            f.write('blah')
+        os.lchown(path + '/dir/b', 1000, 1000)
+        converters.generate_ext4_image(path, '/tmp/blah')
+        self.assertTrue(os.path.exists('/tmp/blah'))
+        self.assertFalse(os.path.exists(path))
+        # The mock lists the owners of the tree it was given
+        with open('/tmp/blah') as f:
+            self.assertIn('dir/b 0:0', f.read().split('\n'))
+        # The mock does not write a real file system
+        self.assertIsNone(converters.ext4_size('/tmp/blah'))
+        os.remove('/tmp/blah')
+        with self.assertRaises(OSError):
+            converters.generate_ext4_image('/tmp/bogus', '/tmp/blah')
+        args = converters.ext4_args({'inodeRatio': 16384, 'journal': True},
+                                    100)
+        self.assertIn('16384', args)
+        self.assertNotIn('-N', args)
+        self.assertNotIn('^has_journal', args)
+        args = converters.ext4_args({}, 100)
+        self.assertEquals(args[args.index('-N') + 1], '100')
+
+    def test_xfs(self):
+        path = self.make_fake()
+        os.mkdir(path + '/dir')
+        os.symlink('a', path + '/dir/link')
+        os.chmod(path + '/a', 04755)
+        converters.generate_xfs_image(path, '/tmp/blah')
+        with open('/tmp/blah') as f:
+            proto = f.read().split('\n')[1:]
+        os.remove('/tmp/blah')
+        self.assertEquals(proto[:3], ['/dev/null', '0 0', 'd--755 0 0'])
+        self.assertEquals(proto[3], 'a -u-755 0 0 %s/a' % path)
+        self.assertEquals(proto[4:7], ['dir d--755 0 0', 'link l--777 0 0 a',
+                                       '$'])
+        path = self.make_fake()
+        with open(path + '/has space', 'w') as f:
+            f.write('blah')
+        with self.assertRaises(OSError):
+            converters.generate_xfs_image(path, '/tmp/blah')
+        shutil.rmtree(path)
+
+    def test_erofs(self):
+        path = self.make_fake()
+        resp = converters.convert('erofs', path, '/tmp/blah.erofs',
+                                  {'compressor': 'lz4hc'})
+        self.assertTrue(resp)
+        self.assertFalse(os.path.exists(path))
+        os.remove('/tmp/blah.erofs')
+        with self.assertRaises(OSError):
+            converters.generate_erofs_image('/tmp/bogus', '/tmp/blah')
+        # The mock only knows lz4 and lz4hc
+        path = self.make_fake()
+        with self.assertRaises(IOError):
+            converters.generate_erofs_image(path, '/tmp/blah',
+                                            {'compressor': 'zstd'})
+        self.assertEquals(converters.erofs_args(), ['--all-root'])
+        options = {'compressor': 'lz4hc', 'compressionLevel': 12,
+                   'pclusterSize': 65536,
+                   'features': ['ztailpacking', 'dedupe']}
+        self.assertEquals(converters.erofs_args(options),
+                          ['--all-root', '-zlz4hc,12', '-C65536',
+                           '-Eztailpacking,dedupe'])
+
+    def test_tree_usage(self):
+        path = self.make_fake()
+        with open(path + '/b', 'w') as f:
+            f.write('x' * 5000)
+        os.link(path + '/b', path + '/c')
+        os.symlink('a', path + '/d')
+        (nbytes, inodes) = converters.tree_usage(path, 1024)
+        # dir, a, b (and c), d
+        self.assertEquals(inodes, 4)
+        # directory block, a and five blocks for b
+        self.assertEquals(nbytes, 7 * 1024)
+        # xfs images store c as a copy of b
+        (nbytes, inodes) = converters.tree_usage(path, 1024, count_links=True)
+        shutil.rmtree(path)
+        self.assertEquals(inodes, 5)
+        self.assertEquals(nbytes, 12 * 1024)
 
     def test_cramfs(self):
         converters.generate_cramfs_image('/tmp/b', '/tmp/blah')
@@ -109,6 +198,43 @@ class ConvertersTestCase(unittest.TestCase):
         os.remove('/tmp/blah')
 
     def test_squashfs(self):
-        converters.generate_squashfs_image('/tmp/b', '/tmp/blah')
+        path = self.make_fake()
+        converters.generate_squashfs_image(path, '/tmp/blah')
         self.assertTrue(os.path.exists('/tmp/blah'))
         os.remove('/tmp/blah')
+        with self.assertRaises(OSError):
+            converters.generate_squashfs_image('/tmp/bogus', '/tmp/blah')
+
+    def test_squashfs_append(self):
+        base = '%s/base.squashfs' % (self.outdir)
+        with open(base, 'w') as f:
+            f.write('base')
+        path = self.make_fake()
+        converters.convert('squashfs', path, '/tmp/blah.squashfs',
+                           {'compressor': 'lz4'}, base=base)
+        with open('/tmp/blah.squashfs') as f:
+            self.assertTrue(f.read().startswith('mock'))
+        os.remove('/tmp/blah.squashfs')
+        # Nothing to add
+        path = self.outdir + '/empty'
+        os.mkdir(path)
+        converters.append_squashfs_image(base, path, '/tmp/blah')
+        with open('/tmp/blah') as f:
+            self.assertEquals(f.read(), 'base')
+        self.assertFalse(os.path.exists(path))
+        os.remove('/tmp/blah')
+        os.remove(base)
+        args = converters.squashfs_args({'compressor': 'lz4',
+                                         'blockSize': '1M'}, append=True)
+        self.assertEquals(args, ['-all-root'])
+
+    def test_squashfs_args(self):
+        self.assertEquals(converters.squashfs_args(), ['-all-root'])
+        options = {'compressor': 'zstd', 'compressionLevel': 3,
+                   'blockSize': '1M', 'processors': 4, 'fragments': False,
+                   'duplicates': False, 'extraArgs': ['-no-xattrs']}
+        args = converters.squashfs_args(options)
+        self.assertEquals(args, ['-all-root', '-comp', 'zstd',
+                                 '-Xcompression-level', '3', '-b', '1M',
+                                 '-processors', '4', '-no-fragments',
+                                 '-no-duplicates', '-no-xattrs'])
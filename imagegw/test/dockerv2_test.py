@@ -21,6 +21,8 @@ from shifter_imagegw import dockerv2
 import unittest
 import tempfile
 import shutil
+import time
+import hashlib
 
 
 class Dockerv2TestCase(unittest.TestCase):
@@ -75,6 +77,225 @@ class Dockerv2TestCase(unittest.TestCase):
             assert(data == 'blah\n')
         return
 
+    def test_token_cache(self):
+        cache = dockerv2.TokenCache()
+        key = ('https://auth.docker.io/token', 'registry.docker.io',
+               'repository:library/ubuntu:pull', None)
+        self.assertIsNone(cache.get(key))
+        cache.put(key, 'abc', expires_in=300)
+        self.assertEquals(cache.get(key), 'abc')
+
+        # A different user must not see the anonymous token
+        other = key[0:3] + ('user',)
+        self.assertIsNone(cache.get(other))
+
+        # Invalidating with a stale token leaves the entry alone
+        cache.invalidate(key, 'old')
+        self.assertEquals(cache.get(key), 'abc')
+        cache.invalidate(key, 'abc')
+        self.assertIsNone(cache.get(key))
+
+    def test_token_cache_expiration(self):
+        cache = dockerv2.TokenCache(margin=5)
+        key = ('realm', 'service', 'scope', None)
+
+        # Shorter than the safety margin, never cached
+        cache.put(key, 'short', expires_in=2)
+        self.assertIsNone(cache.get(key))
+
+        # Issued long enough ago that it has already expired
+        issued = time.strftime('%Y-%m-%dT%H:%M:%SZ',
+                               time.gmtime(time.time() - 600))
+        cache.put(key, 'old', expires_in=300, issued_at=issued)
+        self.assertIsNone(cache.get(key))
+
+        # Default lifetime applies when expires_in is missing
+        cache.put(key, 'default')
+        self.assertEquals(cache.get(key), 'default')
+        cache.tokens[key] = ('default', time.time() - 1)
+        self.assertIsNone(cache.get(key))
+
+    def test_parse_issued_at(self):
+        self.assertEquals(dockerv2._parse_issued_at('1970-01-01T00:01:00Z'),
+                          60)
+        self.assertEquals(
+            dockerv2._parse_issued_at('1970-01-01T01:00:00.123+01:00'), 0)
+        self.assertIsNone(dockerv2._parse_issued_at('garbage'))
+        self.assertIsNone(dockerv2._parse_issued_at(None))
+
+    def test_mirror_endpoints(self):
+        options = {'baseUrl': 'https://registry-1.docker.io',
+                   'mirrors': ['http://cache.local:5000',
+                               'https://registry-1.docker.io/v2']}
+        handle = dockerv2.DockerV2Handle('ubuntu:latest', options)
+        self.assertEquals(handle.endpoint_order,
+                          ['http://cache.local:5000',
+                           'https://registry-1.docker.io'])
+        # Mirrors of dockerhub need the library prefix too
+        self.assertEquals(handle.repo, 'library/ubuntu')
+
+        handle._use_endpoint('http://cache.local:5000')
+        self.assertEquals(handle.server, 'cache.local:5000')
+        self.assertFalse(handle.allow_authenticated)
+        handle._use_endpoint('https://registry-1.docker.io')
+        self.assertTrue(handle.allow_authenticated)
+
+        with self.assertRaises(ValueError):
+            dockerv2.DockerV2Handle('ubuntu:latest',
+                                    {'mirrors': 'http://cache.local'})
+
+    def test_endpoint_stats(self):
+        stats = dockerv2.EndpointStats(cooldown=30)
+        urls = ['https://mirror', 'https://slow', 'https://registry']
+        self.assertEquals(stats.rank(urls), urls)
+
+        stats.record_success('https://mirror', 0.5)
+        stats.record_success('https://slow', 2.0)
+        stats.record_success('https://registry', 0.1)
+        # configured order unless ranking by latency
+        self.assertEquals(stats.rank(urls), urls)
+        self.assertEquals(stats.rank(urls, by_latency=True),
+                          ['https://registry', 'https://mirror',
+                           'https://slow'])
+
+        # a 404 is counted but does not mark the endpoint unhealthy
+        stats.record_failure('https://mirror', 404)
+        self.assertTrue(stats.healthy('https://mirror'))
+
+        # throttled endpoints go to the back of the line
+        stats.record_failure('https://mirror', 429, '120')
+        self.assertFalse(stats.healthy('https://mirror'))
+        self.assertEquals(stats.rank(urls)[-1], 'https://mirror')
+        snap = stats.snapshot()
+        self.assertEquals(snap['https://mirror']['failures'], 2)
+        self.assertEquals(snap['https://mirror']['throttled'], 1)
+
+        # connection errors also trigger a cooldown
+        stats.record_failure('https://registry')
+        self.assertEquals(stats.rank(urls), ['https://slow', 'https://mirror',
+                                             'https://registry'])
+
+    def test_manifest_list_selection(self):
+        mlist = {
+            'schemaVersion': 2,
+            'mediaType': dockerv2._MANIFEST_LIST_V2,
+            'manifests': [
+                {'digest': 'sha256:arm',
+                 'platform': {'architecture': 'arm', 'os': 'linux',
+                              'variant': 'v7'}},
+                {'digest': 'sha256:amd64',
+                 'platform': {'architecture': 'amd64', 'os': 'linux'}},
+                {'digest': 'sha256:ppc',
+                 'platform': {'architecture': 'ppc64le', 'os': 'linux'}},
+            ]
+        }
+        self.assertTrue(dockerv2._is_manifest_list(mlist))
+        self.assertEquals(dockerv2._select_platform_manifest(mlist),
+                          'sha256:amd64')
+        self.assertEquals(
+            dockerv2._select_platform_manifest(mlist, arch='ppc64le'),
+            'sha256:ppc')
+        self.assertEquals(
+            dockerv2._select_platform_manifest(mlist, arch='arm',
+                                               variant='v7'),
+            'sha256:arm')
+        with self.assertRaises(ValueError):
+            dockerv2._select_platform_manifest(mlist, arch='s390x')
+
+        # OCI indexes may omit the mediaType
+        index = {'schemaVersion': 2, 'manifests': mlist['manifests']}
+        self.assertTrue(dockerv2._is_manifest_list(index))
+        self.assertFalse(dockerv2._is_manifest_list({'schemaVersion': 2,
+                                                     'layers': []}))
+
+    def test_schema2_metadata(self):
+        manifest = {
+            'schemaVersion': 2,
+            'mediaType': dockerv2._MANIFEST_V2,
+            'config': {'digest': 'sha256:cfg'},
+            'layers': [
+                {'digest': 'sha256:base'},
+                {'digest': 'sha256:top'},
+            ]
+        }
+        config = {'config': {'Env': ['A=b'], 'Entrypoint': ['/bin/sh']}}
+        (eldest, youngest) = dockerv2._construct_schema2_metadata(
+            manifest, 'sha256:cfg', config)
+        self.assertEquals(eldest['fsLayer']['blobSum'], 'sha256:base')
+        self.assertIs(eldest['child'], youngest)
+        self.assertEquals(youngest['fsLayer']['blobSum'], 'sha256:top')
+        self.assertIsNone(youngest['child'])
+        self.assertEquals(youngest['id'], 'cfg')
+        self.assertEquals(youngest['config']['Env'], ['A=b'])
+
+        manifest['layers'] = []
+        with self.assertRaises(ValueError):
+            dockerv2._construct_schema2_metadata(manifest, 'sha256:cfg',
+                                                 config)
+        manifest['layers'] = [
+            {'digest': 'sha256:z',
+             'mediaType': 'application/vnd.oci.image.layer.v1.tar+zstd'}]
+        with self.assertRaises(ValueError):
+            dockerv2._construct_schema2_metadata(manifest, 'sha256:cfg',
+                                                 config)
+
+    def test_verify_content_digest(self):
+        data = '{"a": 1}'
+        digest = 'sha256:%s' % hashlib.sha256(data).hexdigest()
+        self.assertTrue(dockerv2._verify_content_digest(data, digest))
+        with self.assertRaises(ValueError):
+            dockerv2._verify_content_digest(data + ' ', digest)
+        with self.assertRaises(ValueError):
+            dockerv2._verify_content_digest(data, 'md4:abcd')
+
+    def test_layer_stats(self):
+        cache = tempfile.mkdtemp()
+        self.cleanpaths.append(cache)
+        data = 'layer contents'
+        digest = 'sha256:%s' % hashlib.sha256(data).hexdigest()
+        with open(os.path.join(cache, '%s.tar' % digest), 'w') as out_fp:
+            out_fp.write(data)
+        handle = dockerv2.DockerV2Handle('test/image:latest',
+                                         {'baseUrl': 'https://localhost'})
+        self.assertTrue(handle.save_layer(digest, cache))
+        self.assertEquals(len(handle.layer_stats), 1)
+        stats = handle.layer_stats[0]
+        self.assertEquals(stats['digest'], digest)
+        self.assertEquals(stats['bytes'], len(data))
+        self.assertTrue(stats['cached'])
+
+    def test_parallel_pull_layers(self):
+        cache = tempfile.mkdtemp()
+        self.cleanpaths.append(cache)
+        layer = None
+        digests = []
+        for idx in range(4):
+            data = 'layer %d' % idx
+            digest = 'sha256:%s' % hashlib.sha256(data).hexdigest()
+            with open(os.path.join(cache, '%s.tar' % digest), 'w') as out_fp:
+                out_fp.write(data)
+            digests.append(digest)
+        # the eldest layer is repeated
+        for digest in digests + digests[:1]:
+            layer = {'fsLayer': {'blobSum': digest}, 'child': layer}
+        handle = dockerv2.DockerV2Handle('test/image:latest',
+                                         {'baseUrl': 'https://localhost',
+                                          'downloadThreads': 3})
+        handle.eldest = layer
+        self.assertTrue(handle.pull_layers(None, cache))
+        self.assertEquals([x['digest'] for x in handle.layer_stats],
+                          digests[:1] + list(reversed(digests[1:])))
+        self.assertTrue(all(x['cached'] for x in handle.layer_stats))
+
+        # a failed download is raised
+        handle = dockerv2.DockerV2Handle('test/image:latest',
+                                         {'baseUrl': 'https://localhost',
+                                          'downloadThreads': 3})
+        handle.eldest = layer
+        handle.save_layer = lambda blobsum, cachedir: int('bogus')
+        with self.assertRaises(ValueError):
+            handle.pull_layers(None, cache)
+
 
 if __name__ == '__main__':
     unittest.main()
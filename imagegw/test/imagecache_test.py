@@ -0,0 +1,113 @@
+# Shifter, Copyright (c) 2017, The Regents of the University of California,
+# through Lawrence Berkeley National Laboratory (subject to receipt of any
+# required approvals from the U.S. Dept. of Energy).  All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#  1. Redistributions of source code must retain the above copyright notice,
+#     this list of conditions and the following disclaimer.
+#  2. Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions and the following disclaimer in the documentation
+#     and/or other materials provided with the distribution.
+#  3. Neither the name of the University of California, Lawrence Berkeley
+#     National Laboratory, U.S. Dept. of Energy nor the names of its
+#     contributors may be used to endorse or promote products derived from this
+#     software without specific prior written permission.`
+#
+# See LICENSE for full text.
+
+
+import os
+import time
+import unittest
+import tempfile
+import shutil
+from shifter_imagegw import imagecache
+
+
+def listing(members, whiteouts=None):
+    """ Layer listing with files (or directories ending in /) """
+    return {'members': [[x.rstrip('/'), x.endswith('/')] for x in members],
+            'whiteouts': whiteouts or []}
+
+
+class ImageCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.cachedir = tempfile.mkdtemp()
+        self.cache = imagecache.ImageCache(self.cachedir, 'squashfs',
+                                           {'compressor': 'lz4'}, size=2)
+
+    def tearDown(self):
+        shutil.rmtree(self.cachedir)
+
+    def make_image(self, data):
+        path = os.path.join(self.cachedir, 'image-%s' % data)
+        with open(path, 'w') as image_fp:
+            image_fp.write(data)
+        return path
+
+    def test_chain_ids(self):
+        chain = imagecache.chain_ids(['sha256:a', 'sha256:b', 'sha256:c'])
+        self.assertEquals(chain[0], 'sha256:a')
+        self.assertEquals(len(set(chain)), 3)
+        # The chain depends on the order of the layers
+        self.assertNotEquals(imagecache.chain_ids(['sha256:b',
+                                                   'sha256:a'])[1], chain[1])
+        self.assertEquals(imagecache.chain_ids(['sha256:a', 'sha256:b']),
+                          chain[:2])
+
+    def test_appendable(self):
+        base = [listing(['usr/', 'usr/bin/sh', 'etc/passwd'])]
+        self.assertTrue(imagecache.appendable(base, [listing(['app/',
+                                                              'app/run'])]))
+        self.assertTrue(imagecache.appendable(base, [listing(['./opt/x'])]))
+        # New files in existing top level directories would be renamed
+        self.assertFalse(imagecache.appendable(base,
+                                               [listing(['usr/bin/ls'])]))
+        self.assertFalse(imagecache.appendable(base, [listing(
+            ['app/run'], ['etc/.wh.passwd'])]))
+
+    def test_cache(self):
+        self.assertIsNone(self.cache.get('sha256:a'))
+        path = self.cache.put('sha256:a', self.make_image('a'))
+        self.assertEquals(self.cache.get('sha256:a'), path)
+        with open(path) as image_fp:
+            self.assertEquals(image_fp.read(), 'a')
+        # Other profiles do not share images
+        other = imagecache.ImageCache(self.cachedir, 'squashfs', None)
+        self.assertIsNone(other.get('sha256:a'))
+        # The least recently used image goes first
+        old = time.time() - 100
+        os.utime(path, (old, old))
+        path = self.cache.put('sha256:b', self.make_image('b'))
+        os.utime(path, (old + 50, old + 50))
+        self.cache.get('sha256:a')
+        self.cache.put('sha256:c', self.make_image('c'))
+        self.assertIsNotNone(self.cache.get('sha256:a'))
+        self.assertIsNone(self.cache.get('sha256:b'))
+
+    def test_plan(self):
+        digests = ['sha256:a', 'sha256:b', 'sha256:c']
+        listings = [listing(['usr/bin/sh']), listing(['usr/lib/libc.so']),
+                    listing(['app/run'])]
+        chain = imagecache.chain_ids(digests)
+        # Nothing cached: convert the first two layers on their own
+        plan = self.cache.plan(digests, listings)
+        self.assertEquals(plan, {'chain': chain, 'base': None, 'first': 0,
+                                 'split': 2})
+        # The top layer changed, its replacement is appended
+        base = self.cache.put(chain[1], self.make_image('base'))
+        new = ['sha256:a', 'sha256:b', 'sha256:d']
+        plan = self.cache.plan(new, listings)
+        self.assertEquals(plan['base'], base)
+        self.assertEquals(plan['first'], 2)
+        # The same layers again
+        image = self.cache.put(chain[2], self.make_image('image'))
+        plan = self.cache.plan(digests, listings)
+        self.assertEquals((plan['base'], plan['first']), (image, 3))
+        # A top layer that changes the base is not appended
+        listings[2] = listing(['usr/bin/app'])
+        plan = self.cache.plan(new, listings)
+        self.assertEquals((plan['base'], plan['first'], plan['split']),
+                          (None, 0, None))
@@ -196,6 +196,54 @@ class GWTestCase(unittest.TestCase):
         rv = self.app.get(uri, headers={AUTH_HEADER: self.auth})
         assert rv.status_code == 200
 
+    def test_lookup_etag(self):
+        from shifter_imagegw import api
+        record = self.good_record()
+        ident = self.images.insert(record)
+        uri = '%s/lookup/%s/' % (self.url, self.urlreq)
+        rv = self.app.get(uri, headers={AUTH_HEADER: self.auth})
+        self.assertEquals(rv.status_code, 200)
+        etag = rv.headers['ETag']
+        assert 'Last-Modified' in rv.headers
+        headers = {AUTH_HEADER: self.auth, 'If-None-Match': etag}
+        rv = self.app.get(uri, headers=headers)
+        self.assertEquals(rv.status_code, 304)
+        self.assertEquals(rv.data, '')
+        # A new pull changes the record and the tag
+        api.mgr.update_mongo(ident, {'last_pull': time.time() + 10})
+        rv = self.app.get(uri, headers=headers)
+        self.assertEquals(rv.status_code, 200)
+        self.assertNotEquals(rv.headers['ETag'], etag)
+        # Tags are per user
+        headers[AUTH_HEADER] = self.authadmin
+        headers['If-None-Match'] = rv.headers['ETag']
+        rv = self.app.get(uri, headers=headers)
+        self.assertEquals(rv.status_code, 304)
+        self.assertNotEquals(rv.headers['ETag'], headers['If-None-Match'])
+
+    def test_list_etag(self):
+        record = self.good_record()
+        self.images.insert(record)
+        uri = '%s/list/%s/' % (self.url, self.system)
+        rv = self.app.get(uri, headers={AUTH_HEADER: self.auth})
+        self.assertEquals(rv.status_code, 200)
+        headers = {AUTH_HEADER: self.auth, 'If-None-Match': rv.headers['ETag']}
+        rv = self.app.get(uri, headers=headers)
+        self.assertEquals(rv.status_code, 304)
+        rv = self.app.get(uri + '?limit=1', headers=headers)
+        self.assertEquals(rv.status_code, 200)
+
+    def test_wait(self):
+        record = self.good_record()
+        self.images.insert(record)
+        uri = '%s/wait/%s/?status=PULLING&timeout=5' % (self.url, self.urlreq)
+        rv = self.app.get(uri, headers={AUTH_HEADER: self.auth})
+        self.assertEquals(rv.status_code, 200)
+        self.assertEquals(json.loads(rv.data)['status'], 'READY')
+        uri = '%s/wait/%s/%s/bogus/' % (self.url, self.system, self.type)
+        rv = self.app.get(uri, headers={AUTH_HEADER: self.auth})
+        self.assertEquals(rv.status_code, 404)
+
     def test_expire(self):
         uri = '%s/expire/%s/%s/%s/' % (self.url, self.system, self.type,
                                        self.tag)
@@ -3,6 +3,8 @@ import unittest
 import time
 import json
 import base64
+import threading
+import BaseHTTPServer
 from pymongo import MongoClient
 
 """
@@ -400,8 +402,12 @@ class ImageMngrTestCase(unittest.TestCase):
         # Create a fake record in mongo
         id = self.images.insert(record)
         assert id is not None
+        # Failed pulls are no longer swept on the request path
         self.m.update_states()
         rec = self.images.find_one({'_id': id})
+        assert rec is not None
+        self.m.sweep(self.system)
+        rec = self.images.find_one({'_id': id})
         assert rec is None
 
     def test_lookup(self):
@@ -422,6 +428,134 @@ class ImageMngrTestCase(unittest.TestCase):
         l = self.m.lookup(session, i)
         assert l is None
 
+    def test_lookup_batch(self):
+        record = self.good_record()
+        self.images.insert(record)
+        record2 = self.good_record()
+        record2['id'] = 'fakeid2'
+        record2['tag'] = [self.tag2]
+        record2['private'] = True
+        record2['userACL'] = [1001]
+        record2['expiration'] = 1000
+        self.images.insert(record2)
+        session = self.m.new_session(self.auth, self.system)
+        tags = [self.tag, self.tag2, 'bogus']
+        recs = self.m.lookup_batch(session, self.system, self.itype, tags)
+        self.assertEquals(sorted(recs.keys()), sorted(tags))
+        self.assertEquals(recs[self.tag]['id'], self.id)
+        # No read access to the private image
+        self.assertIsNone(recs[self.tag2])
+        self.assertIsNone(recs['bogus'])
+        r = self.images.find_one({'id': self.id})
+        assert r['expiration'] > time.time()
+        # nor does the lookup keep it from expiring
+        r = self.images.find_one({'id': 'fakeid2'})
+        self.assertEquals(r['expiration'], 1000)
+        self.assertNotIn('last_lookup', r)
+
+    def test_version(self):
+        record = self.good_record()
+        ident = self.images.insert(record)
+        session = self.m.new_session(self.auth, self.system)
+        (version, secret) = self.m.get_version()
+        # Lookups and heartbeats leave the version alone
+        self.m.lookup(session, self.query.copy())
+        self.m.update_mongo_state(ident, 'PULLING')
+        self.m.update_mongo_state(ident, 'PULLING', {'heartbeat': 1})
+        self.assertEquals(self.m.get_version(), (version + 1, secret))
+        self.m.update_mongo(ident, {'last_pull': time.time()})
+        self.assertEquals(self.m.get_version()[0], version + 2)
+        rec = self.images.find_one({'_id': ident})
+        etag = self.m.lookup_etag(session, self.query, rec)
+        self.assertFalse(self.m.lookup_unchanged(session, self.query,
+                                                 'bogus'))
+        self.assertTrue(self.m.lookup_unchanged(session, self.query, etag))
+        other = self.m.new_session(self.authadmin, self.system)
+        self.assertFalse(self.m.lookup_unchanged(other, self.query, etag))
+        self.m.remove_tag(self.system, self.tag)
+        self.assertFalse(self.m.lookup_unchanged(session, self.query, etag))
+
+    def test_wait(self):
+        record = self.good_pullrecord()
+        record['status'] = 'PULLING'
+        ident = self.images.insert(record)
+        session = self.m.new_session(self.auth, self.system)
+        start = time.time()
+        rec = self.m.wait(session, self.query, state='PULLING', timeout=0.5)
+        self.assertEquals(rec['status'], 'PULLING')
+        assert time.time() - start >= 0.5
+        # A different state returns right away
+        rec = self.m.wait(session, self.query, state='ENQUEUED', timeout=5)
+        self.assertEquals(rec['status'], 'PULLING')
+
+        def finish():
+            time.sleep(0.2)
+            self.images.update({'_id': ident}, {'$set': {'tag': [self.tag]}})
+            self.m.update_mongo_state(ident, 'READY')
+        thread = threading.Thread(target=finish)
+        thread.start()
+        start = time.time()
+        rec = self.m.wait(session, self.query, state='PULLING', timeout=5)
+        thread.join()
+        self.assertEquals(rec['status'], 'READY')
+        assert time.time() - start < 2
+        i = self.query.copy()
+        i['tag'] = 'bogus'
+        self.assertIsNone(self.m.wait(session, i, timeout=5))
+        # Nor can other users follow the pull of a private image
+        record = self.good_pullrecord()
+        record.update({'pulltag': self.tag2, 'status': 'PULLING',
+                       'private': True, 'userACL': [1001], 'groupACL': []})
+        self.images.insert(record)
+        i['tag'] = self.tag2
+        start = time.time()
+        self.assertIsNone(self.m.wait(session, i, timeout=5))
+        assert time.time() - start < 2
+
+    def test_callbacks(self):
+        posts = []
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_POST(self):
+                length = int(self.headers['Content-Length'])
+                posts.append(json.loads(self.rfile.read(length)))
+                self.send_response(200)
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        url = 'http://127.0.0.1:%d/done' % server.server_address[1]
+        self.m.callback_prefixes = ['http://127.0.0.1:']
+        try:
+            with self.assertRaises(ValueError):
+                self.m.check_callback('http://example.com/done')
+            record = self.good_pullrecord()
+            record['status'] = 'PULLING'
+            ident = self.images.insert(record)
+            self.m.add_callback({'_id': ident}, url)
+            self.assertEquals(self.images.find_one(ident)['callbacks'], [url])
+            rec = self.m._claim_callbacks(ident)
+            self.assertIsNone(self.m._claim_callbacks(ident))
+            self.m._send_callbacks(rec, 'READY', self.id)
+            # A finished pull is reported right away
+            self.m.update_mongo_state(ident, 'FAILURE')
+            self.m.add_callback({'_id': ident}, url)
+            for _ in range(50):
+                if len(posts) == 2:
+                    break
+                time.sleep(0.1)
+            statuses = sorted(x['status'] for x in posts)
+            self.assertEquals(statuses, ['FAILURE', 'READY'])
+            self.assertEquals(posts[0]['tag'], self.tag)
+        finally:
+            server.shutdown()
+            server.server_close()
+
     def test_list(self):
         record = self.good_record()
         # Create a fake record in mongo
@@ -437,6 +571,36 @@ class ImageMngrTestCase(unittest.TestCase):
         assert self.m.get_state(l['_id']) == 'READY'
         assert l['_id'] == id1
 
+    def test_list_paging(self):
+        ids = []
+        for i in range(5):
+            record = self.good_record()
+            record['id'] = 'fakeid%d' % i
+            record['tag'] = ['test%d' % i]
+            ids.append(self.images.insert(record))
+        # Private images are filtered out by the query unless readable
+        record = self.good_record()
+        record.update({'id': 'private', 'private': True, 'userACL': [1001],
+                       'groupACL': []})
+        self.images.insert(record)
+        record = self.good_record()
+        record.update({'id': 'mine', 'private': True, 'userACL': [100],
+                       'groupACL': []})
+        ids.append(self.images.insert(record))
+        session = self.m.new_session(self.auth, self.system)
+        li = self.m.imglist(session, self.system)
+        self.assertEquals([x['_id'] for x in li], ids)
+        page = self.m.imglist(session, self.system, limit=4,
+                              fields=['id', 'tag'])
+        self.assertEquals(len(page), 4)
+        self.assertNotIn('ENV', page[0])
+        self.assertEquals(page[0]['tag'], ['test0'])
+        page2 = self.m.imglist(session, self.system, limit=4,
+                               after=str(page[-1]['_id']))
+        self.assertEquals([x['_id'] for x in page + page2], ids)
+        with self.assertRaises(ValueError):
+            self.m.imglist(session, self.system, after='bogus')
+
     def test_repull(self):
         # Test a repull
         record = self.good_record()
@@ -961,7 +1125,7 @@ class ImageMngrTestCase(unittest.TestCase):
     def test_autoexpire_stuckpull(self):
         record = self.good_pullrecord()
         record['status'] = 'ENQUEUED'
-        record['last_pull'] = time.time() - 3000
+        record['last_pull'] = time.time() - 7200
         id = self.images.insert(record)
         assert id is not None
         session = self.m.new_session(self.authadmin, self.system)
@@ -998,6 +1162,241 @@ class ImageMngrTestCase(unittest.TestCase):
         self.assertFalse(os.path.exists(file))
         self.assertFalse(os.path.exists(metafile))
 
+    def test_retention_plan(self):
+        now = time.time()
+        recs = []
+        for (id, size, used) in (('old', 100, now - 90000),
+                                 ('older', 100, now - 100000),
+                                 ('recent', 100, now - 600),
+                                 ('unsized', None, now - 200000)):
+            rec = self.good_record()
+            rec['id'] = id
+            rec['last_pull'] = used
+            if size is not None:
+                rec['size'] = size
+            recs.append(rec)
+        # a second tag of the same image was looked up more recently
+        rec = self.good_record()
+        rec['id'] = 'older'
+        rec['last_pull'] = now - 100000
+        rec['last_lookup'] = now - 95000
+        recs.append(rec)
+
+        self.assertEquals(self.m._retention_plan(recs, 300, 86400), [])
+        evict = self.m._retention_plan(recs, 250, 86400)
+        self.assertEquals([x['id'] for x in evict], ['older', 'older'])
+        evict = self.m._retention_plan(recs, 150, 86400)
+        self.assertEquals(set(x['id'] for x in evict), set(['older', 'old']))
+        # images used within min_age are kept even over the budget, and
+        # images of unknown size are never evicted
+        evict = self.m._retention_plan(recs, 0, 86400)
+        self.assertNotIn('recent', [x['id'] for x in evict])
+        self.assertNotIn('unsized', [x['id'] for x in evict])
+        evict = self.m._retention_plan(recs, 0, 60)
+        self.assertIn('recent', [x['id'] for x in evict])
+
+    def test_autoexpire_retention(self):
+        self.config['Platforms'][self.system]['retention'] = {
+            'maxBytes': 150, 'minAge': 3600, 'batchSize': 1}
+        try:
+            self.start_worker()
+            files = []
+            ids = []
+            for (id, age) in (('fakeid1', 7200), ('fakeid2', 10),
+                              ('fakeid3', 9000)):
+                record = self.good_record()
+                record['id'] = id
+                record['tag'] = [id]
+                record['size'] = 100
+                record['last_pull'] = time.time() - age
+                ids.append(self.images.insert(record))
+                files.append(self.create_fakeimage(self.system, id,
+                                                   self.format))
+            session = self.m.new_session(self.authadmin, self.system)
+            expired = self.m.autoexpire(session, self.system, testmode=1)
+            self.assertEquals(sorted(expired), ['fakeid1', 'fakeid3'])
+            self.assertEquals(self.m.get_state(ids[0]), 'EXPIRING')
+            time.sleep(5)
+            self.assertEquals(self.m.get_state(ids[0]), 'EXPIRED')
+            self.assertEquals(self.m.get_state(ids[1]), 'READY')
+            self.assertEquals(self.m.get_state(ids[2]), 'EXPIRED')
+            self.assertFalse(os.path.exists(files[0][0]))
+            self.assertFalse(os.path.exists(files[0][1]))
+            self.assertTrue(os.path.exists(files[1][0]))
+            self.assertFalse(os.path.exists(files[2][0]))
+        finally:
+            self.config['Platforms'][self.system].pop('retention')
+
+    def test_update_states_failures(self):
+        from celery import states
+        from celery.result import EagerResult
+        ids = []
+        for tag in ('scanon/a:latest', 'scanon/b:latest'):
+            record = self.good_pullrecord()
+            record.update({'pulltag': tag, 'status': 'ENQUEUED'})
+            ident = self.images.insert(record)
+            req = EagerResult(str(ident), ValueError('failed'),
+                              states.FAILURE)
+            self.m.tasks.append(req)
+            self.m.task_image_id[req] = ident
+            ids.append(ident)
+        # both failures are handled in one pass
+        self.m.update_states()
+        self.assertEquals(self.m.tasks, [])
+        for ident in ids:
+            self.assertEquals(self.m.get_state(ident), 'FAILURE')
+
+    def test_sweep(self):
+        now = time.time()
+        stuck = self.good_pullrecord()
+        stuck['status'] = 'ENQUEUED'
+        stuck['last_pull'] = now - 7200
+        stuck_id = self.images.insert(stuck)
+        # a large image still being pulled, and one waiting its turn
+        pulling = self.good_pullrecord()
+        pulling.update({'pulltag': 'scanon/a:latest', 'status': 'PULLING',
+                        'last_pull': now - 7200, 'last_heartbeat': now - 60})
+        pulling_id = self.images.insert(pulling)
+        queued = self.good_pullrecord()
+        queued.update({'pulltag': 'scanon/b:latest', 'status': 'ENQUEUED',
+                       'last_pull': now - 600})
+        queued_id = self.images.insert(queued)
+        dead = self.good_pullrecord()
+        dead.update({'pulltag': 'scanon/c:latest', 'status': 'PULLING',
+                     'last_pull': now - 7200, 'last_heartbeat': now - 4000})
+        dead_id = self.images.insert(dead)
+        # two tags of one image, only one of them expired
+        record = self.good_record()
+        record['expiration'] = now - 10
+        expired_id = self.images.insert(record)
+        record = self.good_record()
+        record['tag'] = [self.tag2]
+        record['expiration'] = now + 1000
+        live_id = self.images.insert(record)
+        record = self.good_record()
+        record['system'] = 'systemb'
+        record['expiration'] = now - 10
+        other_id = self.images.insert(record)
+
+        # the image file is still used, so no worker task is needed
+        self.assertEquals(self.m.sweep(self.system), [])
+        self.assertEquals(len(self.m.tasks), 0)
+        self.assertIsNone(self.images.find_one({'_id': stuck_id}))
+        self.assertIsNone(self.images.find_one({'_id': dead_id}))
+        self.assertEquals(self.m.get_state(pulling_id), 'PULLING')
+        self.assertEquals(self.m.get_state(queued_id), 'ENQUEUED')
+        rec = self.images.find_one({'_id': expired_id})
+        self.assertEquals(rec['status'], 'EXPIRED')
+        self.assertIn('purge_at', rec)
+        self.assertEquals(self.m.get_state(live_id), 'READY')
+        self.assertEquals(self.m.get_state(other_id), 'READY')
+        indexes = self.images.index_information()
+        self.assertIn('purge_at_1', indexes)
+        self.assertEquals(indexes['purge_at_1']['expireAfterSeconds'], 0)
+
+    def test_scheduler_lease(self):
+        locks = self.m.locks
+        locks.drop()
+        self.assertTrue(self.m._acquire_lease('test', 60))
+        self.assertTrue(self.m._acquire_lease('test', 60))
+        locks.update({'_id': 'test'}, {'$set': {'owner': 'other'}})
+        self.assertFalse(self.m._acquire_lease('test', 60))
+        # an expired lease can be taken over
+        locks.update({'_id': 'test'}, {'$set': {'until': time.time() - 1}})
+        self.assertTrue(self.m._acquire_lease('test', 60))
+
+        locks.insert({'_id': 'scheduler', 'owner': 'other',
+                      'until': time.time() + 60})
+        self.assertIsNone(self.m.run_scheduled(10))
+        locks.drop()
+        self.assertEquals(self.m.run_scheduled(10),
+                          dict((x, []) for x in self.m.systems))
+
+    def test_claim_pull(self):
+        self.m._create_indexes()
+        request = {'system': self.system, 'itype': self.itype,
+                   'pulltag': self.tag, 'remotetype': 'dockerv2'}
+        (rec, claimed) = self.m._claim_pull(request)
+        self.assertTrue(claimed)
+        self.assertEquals(rec['status'], 'ENQUEUED')
+        ident = rec['_id']
+        # a concurrent pull finds the claimed record
+        (rec, claimed) = self.m._claim_pull(request)
+        self.assertFalse(claimed)
+        self.assertEquals(rec['_id'], ident)
+        (rec, claimed) = self.m._claim_pull(request, rec)
+        self.assertFalse(claimed)
+        self.assertEquals(self.images.find({'pulltag': self.tag}).count(), 1)
+
+        # a failed pull is taken over once it can be retried
+        self.m.update_mongo_state(ident, 'FAILURE')
+        current = self.images.find_one({'_id': ident})
+        self.assertIn('purge_at', current)
+        (rec, claimed) = self.m._claim_pull(request, current)
+        self.assertFalse(claimed)
+        self.images.update({'_id': ident}, {'$set': {'last_pull': 0}})
+        current = self.images.find_one({'_id': ident})
+        (rec, claimed) = self.m._claim_pull(request, current)
+        self.assertTrue(claimed)
+        self.assertEquals(rec['_id'], ident)
+        self.assertEquals(rec['status'], 'ENQUEUED')
+        self.assertNotIn('purge_at', rec)
+
+        # once ready the next pull gets a new record
+        self.m.update_mongo_state(ident, 'READY')
+        (rec, claimed) = self.m._claim_pull(request)
+        self.assertTrue(claimed)
+        self.assertNotEquals(rec['_id'], ident)
+
+    def test_pull_admission(self):
+        from shifter_imagegw.imagemngr import AdmissionError
+        session = self.m.new_session(self.auth, self.system)
+        user = session['user']
+        for tag in ('scanon/a:latest', 'scanon/b:latest'):
+            record = self.good_pullrecord()
+            record.update({'pulltag': tag, 'status': 'ENQUEUED',
+                           'user': user, 'pull_class': 'refresh',
+                           'last_pull': time.time() - 30})
+            self.images.insert(record)
+        record = self.good_pullrecord()
+        record.update({'pulltag': 'scanon/c:latest', 'status': 'EXPIRING',
+                       'pull_class': 'refresh', 'user': user})
+        self.images.insert(record)
+        self.assertEquals(self.m._user_inflight(self.system, user), 2)
+        self.assertEquals(self.m._user_inflight(self.system, 'other'), 0)
+        self.assertEquals(self.m._pull_priority('interactive', 0), 0)
+        self.assertEquals(self.m._pull_priority('interactive', 10), 3)
+        self.assertEquals(self.m._pull_priority('refresh', 1), 5)
+
+        pr = {'system': self.system, 'itype': self.itype, 'tag': self.tag3,
+              'remotetype': 'dockerv2'}
+        self.m.config['MaxPullsPerUser'] = 2
+        try:
+            with self.assertRaises(AdmissionError):
+                self.m.pull(session, pr)
+            self.assertIsNone(self.images.find_one({'pulltag': self.tag3}))
+        finally:
+            self.m.config.pop('MaxPullsPerUser')
+        pr['class'] = 'expiry'
+        with self.assertRaises(ValueError):
+            self.m.pull(session, pr)
+
+        records = self.m.show_queue(session, self.system)
+        self.assertEquals(set(r['class'] for r in records), set(['refresh']))
+        # Only admins see who is pulling what
+        self.assertNotIn('user', records[0])
+        anonymous = self.m.new_session(None, self.system)
+        self.assertNotIn('user', self.m.show_queue(anonymous,
+                                                   self.system)[0])
+        admin = self.m.new_session(self.authadmin, self.system)
+        self.assertEquals(set(r['user'] for r in
+                              self.m.show_queue(admin, self.system)),
+                          set([user]))
+        waits = self.m.queue_waits(records)
+        self.assertEquals(waits['interactive']['waiting'], 0)
+        self.assertEquals(waits['refresh']['waiting'], 2)
+        self.assertGreaterEqual(waits['refresh']['oldest'], 30)
+
     def test_autoexpire_dontexpire(self):
         # A new image shouldn't expire
         record = self.good_record()
@@ -17,6 +17,7 @@
 # See LICENSE for full text.
 
 import os
+import time
 import unittest
 import json
 
@@ -25,6 +26,21 @@ def update_status(state, meta=None):
     print 'state=%s' % (state)
 
 
+class FakeTask(object):
+    """ Stand-in for a bound celery task running a pull stage. """
+    def __init__(self, task_id):
+        self.request = type('Request', (object,), {'id': task_id})()
+        self.backend = self
+        self.states = []
+        self.failures = []
+
+    def update_state(self, task_id=None, state=None, meta=None):
+        self.states.append((task_id, state))
+
+    def mark_as_failure(self, task_id, exc):
+        self.failures.append((task_id, exc))
+
+
 class ImageWorkerTestCase(unittest.TestCase):
 
     def setUp(self):
@@ -58,6 +74,8 @@ class ImageWorkerTestCase(unittest.TestCase):
         if not os.path.exists(idir):
             os.makedirs(idir)
         self.imageDir = idir
+        # the tests change the image directory behind the worker's back
+        imageworker.INVENTORIES.clear()
 
     def cleanup_cache(self):
         for h in [self.hash, self.hash2, self.hash3]:
@@ -194,6 +212,137 @@ class ImageWorkerTestCase(unittest.TestCase):
         #self.imageworker.dopull.apply(request)
         self.imageworker.remove_image(request)
 
+    def test_converter_profile(self):
+        request = {'system': self.system, 'format': 'squashfs'}
+        config = self.imageworker.CONFIG
+        sysconf = config['Platforms'][self.system]
+        self.assertEquals(self.imageworker.get_converter_profile(request),
+                          (None, None))
+        options = {'compressor': 'lz4'}
+        config['ConverterProfiles'] = {'fast': {'squashfs': options}}
+        sysconf['converterProfile'] = 'fast'
+        try:
+            self.assertEquals(
+                self.imageworker.get_converter_profile(request),
+                ('fast', options))
+            sysconf['converterProfile'] = 'bogus'
+            with self.assertRaises(KeyError):
+                self.imageworker.get_converter_profile(request)
+        finally:
+            sysconf.pop('converterProfile')
+            config.pop('ConverterProfiles')
+
+    def test_check_image_inventory(self):
+        request = {'system': self.system, 'id': self.hash3,
+                   'imagefile': self.imagefile,
+                   'metafile': '%s.meta' % self.imagefile[:-9]}
+        for fname in (request['imagefile'], request['metafile']):
+            with open(fname, 'w') as fp:
+                fp.write('bogus')
+        self.assertFalse(self.imageworker.check_image(request))
+        inventory = self.imageworker.INVENTORIES[self.system]
+        refreshed = inventory.refreshed
+
+        # the transfer and removal update the inventory without a listing
+        request['id'] = self.hash
+        self.assertTrue(self.imageworker.transfer_image(request))
+        self.assertTrue(self.imageworker.check_image(request))
+        request['format'] = 'squashfs'
+        self.assertTrue(self.imageworker.remove_image(request))
+        self.assertFalse(self.imageworker.check_image(request))
+        self.assertEquals(inventory.refreshed, refreshed)
+        self.assertFalse(os.path.exists(os.path.join(self.imageDir,
+                                                     '%s.meta' % self.hash)))
+
+        # an image removed by another host is not trusted to the inventory
+        request.pop('format')
+        self.assertTrue(self.imageworker.transfer_image(request))
+        os.unlink(os.path.join(self.imageDir, '%s.squashfs' % self.hash))
+        self.assertFalse(self.imageworker.check_image(request))
+        os.unlink(os.path.join(self.imageDir, '%s.meta' % self.hash))
+        for fname in (request['imagefile'], request['metafile']):
+            os.unlink(fname)
+
+    def test_slots(self):
+        config = self.imageworker.CONFIG
+        self.assertEquals(self.imageworker.QUEUE.conf.CELERYD_CONCURRENCY,
+                          config['WorkerThreads'])
+        self.imageworker.SLOTS.clear()
+        config['CpuSlots'] = 2
+        try:
+            self.assertEquals(self.imageworker._slots('network').count,
+                              config['WorkerThreads'])
+            self.assertEquals(self.imageworker._slots('cpu').count, 2)
+            with self.imageworker._slots('cpu').hold() as waited:
+                self.assertLess(waited, 1)
+        finally:
+            config.pop('CpuSlots')
+            self.imageworker.SLOTS.clear()
+
+    def test_stage_timer(self):
+        timer = self.imageworker.StageTimer()
+        self.assertEquals(timer.timed('convert', max, 1, 2), 2)
+        timer.add('extract', 1.5)
+        timer.add('extract', 0.5)
+        with self.assertRaises(ValueError):
+            timer.timed('transfer', int, 'bogus')
+        report = timer.report()
+        self.assertEquals(report['stages']['extract'], 2.0)
+        self.assertIn('convert', report['stages'])
+        self.assertIn('transfer', report['stages'])
+        self.assertGreaterEqual(report['stages']['total'], 0)
+        self.assertEquals(report['layers'], [])
+        self.assertEquals(report['transfers'], [])
+
+    def test_stage_timer_resume(self):
+        timer = self.imageworker.StageTimer()
+        timer.add('fetch', 2.0)
+        timer.add_bytes('downloaded', 10)
+        report = timer.report()
+        timer = self.imageworker.StageTimer.resume(report,
+                                                   time.time() - 5)
+        timer.add('convert', 1.0)
+        report = timer.report()
+        self.assertEquals(report['stages']['fetch'], 2.0)
+        self.assertEquals(report['stages']['convert'], 1.0)
+        self.assertGreaterEqual(report['stages']['queued'], 5)
+        self.assertGreaterEqual(report['stages']['total'], 5)
+        self.assertEquals(report['bytes'], {'downloaded': 10})
+
+    def test_run_stage(self):
+        request = {'system': self.system, 'tag': self.tag,
+                   'task_id': 'tracked'}
+        task = FakeTask('first')
+
+        def stage(request, updater, timer):
+            updater.update_status('PULLING', 'stage')
+            timer.add('fetch', 1.0)
+            request['id'] = self.hash
+
+        request = self.imageworker._run_stage(task, stage, request)
+        self.assertEquals(task.states, [('tracked', 'PULLING')])
+        self.assertEquals(request['id'], self.hash)
+        self.assertEquals(request['timings']['stages']['fetch'], 1.0)
+        self.assertIn('handed_off', request)
+
+        # stages after the image was found on the system are skipped
+        request['done'] = True
+        request = self.imageworker._run_stage(task, stage, request)
+        self.assertEquals(request['timings']['stages']['fetch'], 1.0)
+        request.pop('done')
+
+        # failures are reported on the tracked task
+        def failed(request, updater, timer):
+            raise OSError('stage failed')
+
+        with self.assertRaises(OSError):
+            self.imageworker._run_stage(task, failed, request)
+        self.assertEquals(task.failures[0][0], 'tracked')
+        task = FakeTask('tracked')
+        with self.assertRaises(OSError):
+            self.imageworker._run_stage(task, failed, request)
+        self.assertEquals(task.failures, [])
+
     def test_unimplemented_fuctions(self):
         pass
 
@@ -0,0 +1,93 @@
+# Shifter, Copyright (c) 2017, The Regents of the University of California,
+# through Lawrence Berkeley National Laboratory (subject to receipt of any
+# required approvals from the U.S. Dept. of Energy).  All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#  1. Redistributions of source code must retain the above copyright notice,
+#     this list of conditions and the following disclaimer.
+#  2. Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions and the following disclaimer in the documentation
+#     and/or other materials provided with the distribution.
+#  3. Neither the name of the University of California, Lawrence Berkeley
+#     National Laboratory, U.S. Dept. of Energy nor the names of its
+#     contributors may be used to endorse or promote products derived from this
+#     software without specific prior written permission.`
+#
+# See LICENSE for full text.
+
+
+import os
+import unittest
+import tempfile
+import shutil
+from shifter_imagegw import inventory, transfer
+
+
+class InventoryTestCase(unittest.TestCase):
+    """uses the mock ssh, ensure it is in PATH prior to running test"""
+
+    def setUp(self):
+        self.image_dir = tempfile.mkdtemp()
+        self.system = {
+            'host': ['localhost'],
+            'accesstype': 'remote',
+            'ssh': {
+                'username': 'nobody',
+                'imageDir': self.image_dir
+            }
+        }
+        for fname in ('a.squashfs', 'a.meta', 'b.squashfs.XXXXXX.partial'):
+            with open(os.path.join(self.image_dir, fname), 'w') as fp:
+                fp.write(fname)
+        os.mkdir(os.path.join(self.image_dir, 'subdir'))
+
+    def tearDown(self):
+        shutil.rmtree(self.image_dir)
+
+    def test_list_files(self):
+        files = transfer.list_files(self.system)
+        self.assertEquals(sorted(files.keys()), ['a.meta', 'a.squashfs'])
+        self.assertEquals(files['a.meta'][0], len('a.meta'))
+        mtime = os.path.getmtime(os.path.join(self.image_dir, 'a.meta'))
+        self.assertAlmostEqual(files['a.meta'][1], mtime, places=2)
+
+        local = dict(self.system)
+        local['accesstype'] = 'local'
+        local['local'] = {'imageDir': self.image_dir}
+        self.assertEquals(transfer.list_files(local), files)
+
+        self.system['ssh']['imageDir'] = '/bogus/images'
+        self.assertIsNone(transfer.list_files(self.system))
+        local['local']['imageDir'] = '/bogus/images'
+        self.assertIsNone(transfer.list_files(local))
+
+    def test_inventory(self):
+        inv = inventory.Inventory(self.system, ttl=60)
+        self.assertTrue(inv.stale())
+        self.assertTrue(inv.contains('a.squashfs', 'a.meta'))
+        self.assertFalse(inv.stale())
+        self.assertFalse(inv.contains('b.squashfs'))
+
+        # changes by others are only seen after the ttl
+        os.unlink(os.path.join(self.image_dir, 'a.meta'))
+        self.assertTrue(inv.contains('a.meta'))
+        inv.refreshed -= 61
+        self.assertFalse(inv.contains('a.squashfs', 'a.meta'))
+
+        # changes made by the worker are seen right away
+        inv.add('b.squashfs', 10)
+        inv.add('b.meta', 10)
+        self.assertTrue(inv.contains('b.squashfs', 'b.meta'))
+        inv.remove('b.meta')
+        self.assertFalse(inv.contains('b.squashfs', 'b.meta'))
+
+        # unknown if the directory can not be listed
+        self.system['ssh']['imageDir'] = '/bogus/images'
+        inv.refreshed = None
+        self.assertIsNone(inv.contains('a.squashfs'))
+        self.assertTrue(inv.stale())
+
+
+if __name__ == '__main__':
+    unittest.main()
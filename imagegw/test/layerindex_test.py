@@ -0,0 +1,129 @@
+# Shifter, Copyright (c) 2017, The Regents of the University of California,
+# through Lawrence Berkeley National Laboratory (subject to receipt of any
+# required approvals from the U.S. Dept. of Energy).  All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#  1. Redistributions of source code must retain the above copyright notice,
+#     this list of conditions and the following disclaimer.
+#  2. Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions and the following disclaimer in the documentation
+#     and/or other materials provided with the distribution.
+#  3. Neither the name of the University of California, Lawrence Berkeley
+#     National Laboratory, U.S. Dept. of Energy nor the names of its
+#     contributors may be used to endorse or promote products derived from this
+#     software without specific prior written permission.`
+#
+# See LICENSE for full text.
+
+import os
+import unittest
+import tempfile
+import tarfile
+import shutil
+from StringIO import StringIO
+from shifter_imagegw import layerindex, dockerv2
+
+
+class LayerIndexTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.cachedir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cachedir)
+
+    def make_layer(self, digest, entries):
+        """
+        Write a gzipped layer tarball; entries is a list of (name, data)
+        with data None for directories.
+        """
+        path = os.path.join(self.cachedir, '%s.tar' % digest)
+        tfp = tarfile.open(path, 'w:gz')
+        for (name, data) in entries:
+            info = tarfile.TarInfo(name)
+            if data is None:
+                info.type = tarfile.DIRTYPE
+                info.mode = 0755
+                tfp.addfile(info)
+            else:
+                info.size = len(data)
+                info.mode = 0444
+                tfp.addfile(info, StringIO(data))
+        tfp.close()
+        return path
+
+    def test_scan_layer(self):
+        path = self.make_layer('sha256:a', [
+            ('etc', None),
+            ('etc/passwd', 'root'),
+            ('dev/null', ''),
+            ('etc/../../x', 'bad'),
+            ('etc/.wh.group', ''),
+        ])
+        entry = layerindex.scan_layer(path)
+        self.assertEquals(entry['version'], layerindex.INDEX_VERSION)
+        self.assertEquals(entry['members'],
+                          [['etc', True], ['etc/passwd', False]])
+        self.assertEquals(entry['whiteouts'], ['etc/.wh.group'])
+
+    def test_lookup(self):
+        path = self.make_layer('sha256:a', [('bin', None), ('bin/sh', 'x')])
+        index = layerindex.LayerIndex(self.cachedir)
+        self.assertIsNone(index.get('sha256:a'))
+        entry = index.lookup('sha256:a', path)
+        self.assertTrue(os.path.exists(
+            os.path.join(self.cachedir, 'sha256:a.index')))
+        # the stored listing is used without reading the layer again
+        os.unlink(path)
+        self.assertEquals(index.lookup('sha256:a', path), entry)
+        # stale or corrupt entries are ignored
+        with open(os.path.join(self.cachedir, 'sha256:a.index'), 'w') as fp:
+            fp.write('{"version": 0}')
+        self.assertIsNone(index.get('sha256:a'))
+        index.remove('sha256:a')
+        self.assertIsNone(index.get('sha256:a'))
+
+    def test_plan_extraction(self):
+        listings = [
+            {'members': [['etc', True], ['etc/passwd', False],
+                         ['opt', True], ['opt/a', False]],
+             'whiteouts': []},
+            {'members': [['etc', True], ['etc/passwd', False]],
+             'whiteouts': ['.wh.opt']},
+            {'members': [['usr', True]], 'whiteouts': []},
+        ]
+        plan = layerindex.plan_extraction(listings)
+        self.assertEquals(plan[0], set(['etc']))
+        self.assertEquals(plan[1], set(['etc', 'etc/passwd']))
+        self.assertEquals(plan[2], set(['usr']))
+
+    def test_extract_docker_layers(self):
+        self.make_layer('sha256:a', [
+            ('etc', None), ('etc/passwd', 'old'),
+            ('opt', None), ('opt/a', 'a'),
+        ])
+        self.make_layer('sha256:b', [
+            ('etc', None), ('etc/passwd', 'new'), ('.wh.opt', ''),
+        ])
+        base = {'fsLayer': {'blobSum': 'sha256:a'},
+                'child': {'fsLayer': {'blobSum': 'sha256:b'},
+                          'child': None}}
+        handle = dockerv2.DockerV2Handle('https://localhost/library/test',
+                                         {'baseUrl': 'https://localhost'})
+        expand = tempfile.mkdtemp()
+        try:
+            for _ in range(2):
+                handle.extract_docker_layers(expand, base, self.cachedir)
+                with open(os.path.join(expand, 'etc/passwd')) as fp:
+                    self.assertEquals(fp.read(), 'new')
+                self.assertFalse(os.path.exists(os.path.join(expand, 'opt')))
+                shutil.rmtree(expand)
+                os.mkdir(expand)
+            self.assertTrue(os.path.exists(
+                os.path.join(self.cachedir, 'sha256:b.index')))
+        finally:
+            shutil.rmtree(expand)
+
+if __name__ == '__main__':
+    unittest.main()
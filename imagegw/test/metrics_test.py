@@ -0,0 +1,84 @@
+# Shifter, Copyright (c) 2017, The Regents of the University of California,
+# through Lawrence Berkeley National Laboratory (subject to receipt of any
+# required approvals from the U.S. Dept. of Energy).  All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#  1. Redistributions of source code must retain the above copyright notice,
+#     this list of conditions and the following disclaimer.
+#  2. Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions and the following disclaimer in the documentation
+#     and/or other materials provided with the distribution.
+#  3. Neither the name of the University of California, Lawrence Berkeley
+#     National Laboratory, U.S. Dept. of Energy nor the names of its
+#     contributors may be used to endorse or promote products derived from this
+#     software without specific prior written permission.`
+#
+# See LICENSE for full text.
+
+import unittest
+from shifter_imagegw import metrics
+
+
+class MetricsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = metrics.Registry()
+
+    def test_counter(self):
+        counter = metrics.Counter('test_total', 'A test counter',
+                                  ['system'], registry=self.registry)
+        counter.inc(system='systema')
+        counter.inc(2, system='systema')
+        self.assertEquals(counter.get(system='systema'), 3)
+        self.assertEquals(counter.get(system='systemb'), 0)
+        with self.assertRaises(ValueError):
+            counter.inc(-1, system='systema')
+        with self.assertRaises(ValueError):
+            counter.inc(bogus='label')
+        text = self.registry.render()
+        self.assertIn('# TYPE test_total counter', text)
+        self.assertIn('test_total{system="systema"} 3.0', text)
+
+    def test_gauge(self):
+        gauge = metrics.Gauge('test_depth', 'A test gauge',
+                              registry=self.registry)
+        gauge.set(4)
+        gauge.set(2)
+        self.assertEquals(gauge.get(), 2)
+        self.assertIn('test_depth 2.0', self.registry.render())
+
+    def test_histogram(self):
+        hist = metrics.Histogram('test_seconds', 'A test histogram',
+                                 ['route'], buckets=(0.1, 1.0),
+                                 registry=self.registry)
+        hist.observe(0.05, route='/a')
+        hist.observe(0.5, route='/a')
+        hist.observe(5, route='/a')
+        with hist.time(route='/b'):
+            pass
+        self.assertEquals(hist.count(route='/a'), 3)
+        self.assertEquals(hist.count(route='/b'), 1)
+        text = self.registry.render()
+        self.assertIn('test_seconds_bucket{route="/a",le="0.1"} 1', text)
+        self.assertIn('test_seconds_bucket{route="/a",le="1.0"} 2', text)
+        self.assertIn('test_seconds_bucket{route="/a",le="+Inf"} 3', text)
+        self.assertIn('test_seconds_sum{route="/a"} 5.55', text)
+        self.assertIn('test_seconds_count{route="/a"} 3', text)
+
+    def test_label_escaping(self):
+        counter = metrics.Counter('test_escape_total', 'Escaping',
+                                  ['tag'], registry=self.registry)
+        counter.inc(tag='a"b\\c\nd')
+        self.assertIn('test_escape_total{tag="a\\"b\\\\c\\nd"} 1.0',
+                      self.registry.render())
+
+    def test_register_replaces(self):
+        metrics.Counter('test_dup_total', 'First', registry=self.registry)
+        metrics.Counter('test_dup_total', 'Second', registry=self.registry)
+        text = self.registry.render()
+        self.assertEquals(text.count('# TYPE test_dup_total'), 1)
+        self.assertIn('Second', text)
+
+if __name__ == '__main__':
+    unittest.main()
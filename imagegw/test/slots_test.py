@@ -0,0 +1,69 @@
+# Shifter, Copyright (c) 2017, The Regents of the University of California,
+# through Lawrence Berkeley National Laboratory (subject to receipt of any
+# required approvals from the U.S. Dept. of Energy).  All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#  1. Redistributions of source code must retain the above copyright notice,
+#     this list of conditions and the following disclaimer.
+#  2. Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions and the following disclaimer in the documentation
+#     and/or other materials provided with the distribution.
+#  3. Neither the name of the University of California, Lawrence Berkeley
+#     National Laboratory, U.S. Dept. of Energy nor the names of its
+#     contributors may be used to endorse or promote products derived from this
+#     software without specific prior written permission.`
+#
+# See LICENSE for full text.
+
+
+import os
+import threading
+import unittest
+import tempfile
+import shutil
+from time import time, sleep
+from shifter_imagegw.slots import Slots
+
+
+class SlotsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_hold(self):
+        slots = Slots(os.path.join(self.path, 'slots'), 'cpu', 2, poll=0.05)
+        held = []
+
+        def _third():
+            with slots.hold() as waited:
+                held.append(waited)
+
+        with slots.hold():
+            with slots.hold():
+                thread = threading.Thread(target=_third)
+                thread.start()
+                sleep(0.3)
+                # both slots are taken
+                self.assertEquals(held, [])
+            thread.join()
+        self.assertEquals(len(held), 1)
+        self.assertGreaterEqual(held[0], 0.3)
+        self.assertEquals(sorted(os.listdir(slots.path)),
+                          ['cpu.0.lock', 'cpu.1.lock'])
+
+    def test_unlimited(self):
+        slots = Slots(os.path.join(self.path, 'slots'), 'network', 0)
+        start = time()
+        with slots.hold():
+            with slots.hold() as waited:
+                self.assertEquals(waited, 0.0)
+        self.assertLess(time() - start, 1)
+        self.assertFalse(os.path.exists(slots.path))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -17,6 +17,7 @@
 # See LICENSE for full text.
 
 import os
+import shutil
 import unittest
 import tempfile
 from shifter_imagegw import transfer
@@ -71,6 +72,25 @@ class TransferTestCase(unittest.TestCase):
         cmd = transfer._ssh_cmd(self.system)
         assert cmd is None
 
+        self.system['ssh']['controlPath'] = '/tmp/ctl-%C'
+        self.system['ssh']['cipher'] = 'aes128-gcm@openssh.com'
+        cmd = transfer._ssh_cmd(self.system, 'echo')
+        self.assertEquals(cmd, ['ssh', '-i', 'somefile',
+                                '-o', 'ControlMaster=auto',
+                                '-o', 'ControlPath=/tmp/ctl-%C',
+                                '-o', 'ControlPersist=300',
+                                '-c', 'aes128-gcm@openssh.com',
+                                'nobody@localhost', 'echo'])
+        cmd = transfer._ssh_cmd(self.system, 'echo', shared=False)
+        self.assertEquals(cmd, ['ssh', '-i', 'somefile',
+                                '-o', 'ControlPath=none',
+                                '-c', 'aes128-gcm@openssh.com',
+                                'nobody@localhost', 'echo'])
+        cmd = transfer._scp_cmd(self.system, 'a', 'b')
+        self.assertIn('ControlPath=/tmp/ctl-%C', cmd)
+        del self.system['ssh']['controlPath']
+        del self.system['ssh']['cipher']
+
 
     def test_cp_cmd(self):
         cmd = transfer._cp_cmd(self.system, 'a', 'b')
@@ -113,6 +133,106 @@ class TransferTestCase(unittest.TestCase):
 
         os.rmdir(tmp_path)
 
+    def test_local_copy(self):
+        src_path = tempfile.mkdtemp()
+        tmp_path = tempfile.mkdtemp()
+        image = os.path.join(src_path, 'test.squashfs')
+        with open(image, 'w') as fp:
+            fp.seek(16 * 1024 * 1024)
+            fp.write('end')
+        target = os.path.join(tmp_path, 'test.squashfs')
+
+        # same file system
+        self.assertEquals(transfer.local_copy(image, tmp_path), 'link')
+        self.assertEquals(os.stat(target).st_ino, os.stat(image).st_ino)
+        os.unlink(target)
+
+        # each copy method, as if they were on different file systems
+        for (func, call) in ((transfer._kernel_copy,
+                              transfer._copy_file_range),
+                             (transfer._kernel_copy, transfer._sendfile),
+                             (transfer._buffered_copy, None)):
+            src_fd = os.open(image, os.O_RDONLY)
+            dst_fd = os.open(target, os.O_WRONLY | os.O_CREAT, 0600)
+            size = os.fstat(src_fd).st_size
+            if call is not None:
+                self.assertTrue(func(call, src_fd, dst_fd, size))
+            else:
+                self.assertTrue(func(src_fd, dst_fd, size))
+            os.close(src_fd)
+            os.close(dst_fd)
+            with open(image) as fp:
+                data = fp.read()
+            with open(target) as fp:
+                self.assertEquals(fp.read(), data)
+            os.unlink(target)
+
+        # the buffered copy keeps holes
+        self.assertLess(os.stat(image).st_blocks * 512, 1024 * 1024)
+        src_fd = os.open(image, os.O_RDONLY)
+        dst_fd = os.open(target, os.O_WRONLY | os.O_CREAT, 0600)
+        transfer._buffered_copy(src_fd, dst_fd, 0)
+        os.close(src_fd)
+        os.close(dst_fd)
+        self.assertEquals(os.path.getsize(target), os.path.getsize(image))
+        self.assertLess(os.stat(target).st_blocks * 512, 1024 * 1024)
+        os.unlink(target)
+
+        # without hard links
+        link = os.link
+        try:
+            def nolink(src, dst):
+                raise OSError(18, 'Invalid cross-device link')
+            os.link = nolink
+            method = transfer.local_copy(image, tmp_path)
+        finally:
+            os.link = link
+        self.assertIn(method, ('reflink', 'copy_file_range', 'sendfile',
+                               'buffered'))
+        self.assertNotEquals(os.stat(target).st_ino, os.stat(image).st_ino)
+        self.assertEquals(os.listdir(tmp_path), ['test.squashfs'])
+        with open(target) as fp:
+            self.assertEquals(len(fp.read()), 16 * 1024 * 1024 + 3)
+
+        shutil.rmtree(src_path)
+        shutil.rmtree(tmp_path)
+
+    def test_local_copy_old_libc(self):
+        src_path = tempfile.mkdtemp()
+        tmp_path = tempfile.mkdtemp()
+        image = os.path.join(src_path, 'test.squashfs')
+        with open(image, 'w') as fp:
+            fp.write('data' * 1024)
+        target = os.path.join(tmp_path, 'test.squashfs')
+
+        # a C library without copy_file_range or sendfile (glibc < 2.27
+        # lacks the former)
+        libc = transfer._LIBC
+        link = os.link
+        try:
+            transfer._LIBC = object()
+            src_fd = os.open(image, os.O_RDONLY)
+            dst_fd = os.open(target, os.O_WRONLY | os.O_CREAT, 0600)
+            for call in (transfer._copy_file_range, transfer._sendfile):
+                self.assertFalse(transfer._kernel_copy(call, src_fd, dst_fd,
+                                                       4096))
+            os.close(src_fd)
+            os.close(dst_fd)
+            os.unlink(target)
+
+            def nolink(src, dst):
+                raise OSError(18, 'Invalid cross-device link')
+            os.link = nolink
+            method = transfer.local_copy(image, tmp_path)
+        finally:
+            os.link = link
+            transfer._LIBC = libc
+        self.assertIn(method, ('reflink', 'buffered'))
+        with open(target) as fp:
+            self.assertEquals(fp.read(), 'data' * 1024)
+        shutil.rmtree(src_path)
+        shutil.rmtree(tmp_path)
+
     def test_copyfile_remote(self):
         """uses mock ssh/scp wrapper to pretend to do the remote
            transfer, ensure it is in PATH prior to running test
@@ -138,6 +258,64 @@ class TransferTestCase(unittest.TestCase):
 
         os.rmdir(tmp_path)
 
+    def test_copyfile_stream(self):
+        """uses the mock ssh to stream into a local directory"""
+        src_path = tempfile.mkdtemp()
+        tmp_path = tempfile.mkdtemp()
+        self.system['ssh']['imageDir'] = tmp_path
+        self.system['accesstype'] = 'remote'
+        self.system['ssh']['transferMode'] = 'stream'
+        self.system['ssh']['parallelThreshold'] = 1024 * 1024
+        self.system['ssh']['parallelStreams'] = 3
+
+        # a compressed format in several streams, and a small metadata file
+        image = os.path.join(src_path, 'test.ext4')
+        with open(image, 'w') as fp:
+            for i in xrange(3 * 1024 + 100):
+                fp.write(('%08d' % i) * 128)
+        meta = os.path.join(src_path, 'test.meta')
+        with open(meta, 'w') as fp:
+            fp.write('FORMAT: ext4\n')
+        stats = []
+        self.assertTrue(transfer.transfer(self.system, image, meta,
+                                          stats=stats))
+        self.assertEquals(sorted(os.listdir(tmp_path)),
+                          ['test.ext4', 'test.meta'])
+        for fname in (image, meta):
+            with open(fname) as fp:
+                data = fp.read()
+            with open(os.path.join(tmp_path, os.path.basename(fname))) as fp:
+                self.assertEquals(fp.read(), data)
+        self.assertEquals([x['file'] for x in stats],
+                          ['test.meta', 'test.ext4'])
+        self.assertEquals(stats[1]['method'], 'stream')
+        self.assertEquals(stats[1]['bytes'], os.path.getsize(image))
+        self.assertLess(stats[1]['sent'], stats[1]['bytes'] / 2)
+
+        # formats that are not listed are sent as is
+        self.system['ssh']['compressFormats'] = ['meta']
+        stats = []
+        self.assertTrue(transfer.copy_file(image, self.system, stats=stats))
+        self.assertEquals(stats[0]['sent'], stats[0]['bytes'])
+
+        # a failed stream leaves no partial files behind
+        os.unlink(os.path.join(tmp_path, 'test.ext4'))
+        stream_chunk = transfer._stream_chunk
+        try:
+            def failed(*args):
+                args[-1].update({'sent': 0, 'ret': 1, 'stderr': 'failed'})
+            transfer._stream_chunk = failed
+            self.assertFalse(transfer.copy_file(image, self.system))
+        finally:
+            transfer._stream_chunk = stream_chunk
+        self.assertEquals(os.listdir(tmp_path), ['test.meta'])
+
+        for item in ('transferMode', 'parallelThreshold', 'parallelStreams',
+                     'compressFormats'):
+            del self.system['ssh'][item]
+        shutil.rmtree(src_path)
+        shutil.rmtree(tmp_path)
+
     def test_copyfile_invalid(self):
         tmp_path = tempfile.mkdtemp()
         self.system['local']['imageDir'] = tmp_path
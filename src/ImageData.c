@@ -224,6 +224,10 @@ int parse_ImageData(char *type, char *identifier, UdiRootConfig *config, ImageDa
             extension = "xfs";
             image->useLoopMount = 1;
             break;
+        case FORMAT_EROFS:
+            extension = "erofs";
+            image->useLoopMount = 1;
+            break;
         case FORMAT_INVALID:
             extension = "invalid";
             image->useLoopMount = 0;
@@ -309,6 +313,7 @@ size_t fprint_ImageData(FILE *fp, ImageData *image) {
         case FORMAT_SQUASHFS: cptr = "SQUASHFS"; break;
         case FORMAT_CRAMFS: cptr = "CRAMFS"; break;
         case FORMAT_XFS: cptr = "XFS"; break;
+        case FORMAT_EROFS: cptr = "EROFS"; break;
         case FORMAT_INVALID: cptr = "INVALID"; break;
     }
     nWrite += fprintf(fp, "Image Format: %s\n", cptr);
@@ -358,6 +363,8 @@ int _ImageData_assign(const char *key, const char *value, void *t_image) {
             image->format = FORMAT_CRAMFS;
         } else if (strcmp(value, "xfs") == 0) {
             image->format = FORMAT_XFS;
+        } else if (strcmp(value, "erofs") == 0) {
+            image->format = FORMAT_EROFS;
         } else {
             image->format = FORMAT_INVALID;
         }
@@ -53,6 +53,7 @@ typedef enum _ImageFormat {
     FORMAT_SQUASHFS,
     FORMAT_CRAMFS,
     FORMAT_XFS,
+    FORMAT_EROFS,
     FORMAT_INVALID
 } ImageFormat;
 
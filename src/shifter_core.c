@@ -1275,6 +1275,13 @@ int loopMount(const char *imagePath, const char *loopMountPath, ImageFormat form
         useAutoclear = 0;
         ready = 1;
         imgType = "xfs";
+    } else if (format == FORMAT_EROFS) {
+        if (supportsFilesystem(fstypes, "erofs") != 0) {
+            LOADKMOD("erofs", "fs/erofs/erofs.ko");
+        }
+        useAutoclear = 1;
+        ready = 1;
+        imgType = "erofs";
     } else {
         fprintf(stderr, "ERROR: unknown image format.\n");
         goto _loopMount_unclean;
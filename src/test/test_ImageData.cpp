@@ -62,6 +62,14 @@ TEST(ImageDataTestGroup, ConfigAssign_basic) {
     ret = _ImageData_assign("ENV", "PATH=/bin:/usr/bin", &image);
     CHECK(ret == 0);
 
+    ret = _ImageData_assign("FORMAT", "erofs", &image);
+    CHECK(ret == 0);
+    CHECK(image.format == FORMAT_EROFS);
+
+    ret = _ImageData_assign("FORMAT", "bogus", &image);
+    CHECK(ret == 0);
+    CHECK(image.format == FORMAT_INVALID);
+
     free_ImageData(&image, 0);
 
 }